@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, Optional
+
+from app.core.config import settings
+from app.core.llm_client import LLMClient, get_llm_client
+
+logger = logging.getLogger(__name__)
+
+
+class BotRuntime:
+    """
+    Долгоживущий event loop для асинхронных задач Telegram-бота.
+
+    Хендлеры telebot остаются синхронными и лишь ставят корутину в очередь.
+    Одновременно выполняется не больше max_tasks задач; задачи одного чата
+    выполняются не более per_chat штук сразу, а очередь чата ограничена per_chat_queue -
+    медленный LLM-запрос одного пользователя не блокирует остальных.
+    """
+    def __init__(self, max_tasks: int, per_chat: int, per_chat_queue: int):
+        self.max_tasks = max_tasks
+        self.per_chat = per_chat
+        self.per_chat_queue = per_chat_queue
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._global_sem: Optional[asyncio.Semaphore] = None
+        self._chat_sems: Dict[int, asyncio.Semaphore] = {}
+        self._pending: Dict[int, int] = defaultdict(int)
+        self._pending_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                self._global_sem = asyncio.Semaphore(self.max_tasks)
+                ready.set()
+                loop.run_forever()
+
+            self._thread = threading.Thread(target=run, name="bot-runtime", daemon=True)
+            self._thread.start()
+            ready.wait()
+            self._loop = loop
+            logger.info(f"🤖 Bot runtime запущен (задач: {self.max_tasks}, на чат: {self.per_chat})")
+
+    def stop(self):
+        with self._start_lock:
+            loop = self._loop
+            if loop is None:
+                return
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join(timeout=10)
+            self._loop = None
+
+    def submit(self, chat_id: int, factory: Callable[[], Awaitable]) -> bool:
+        """
+        Ставит задачу чата в очередь. factory - функция, возвращающая корутину.
+        Возвращает False, если очередь этого чата переполнена.
+        """
+        self.start()
+        with self._pending_lock:
+            if self._pending[chat_id] >= self.per_chat_queue:
+                return False
+            self._pending[chat_id] += 1
+        asyncio.run_coroutine_threadsafe(self._run(chat_id, factory), self._loop)
+        return True
+
+    async def _run(self, chat_id: int, factory: Callable[[], Awaitable]):
+        chat_sem = self._chat_sems.get(chat_id)
+        if chat_sem is None:
+            chat_sem = self._chat_sems[chat_id] = asyncio.Semaphore(self.per_chat)
+        try:
+            async with chat_sem:
+                async with self._global_sem:
+                    await factory()
+        except Exception as e:
+            logger.error(f"Bot task error (chat {chat_id}): {e}", exc_info=True)
+        finally:
+            with self._pending_lock:
+                self._pending[chat_id] -= 1
+                if self._pending[chat_id] <= 0:
+                    del self._pending[chat_id]
+                    self._chat_sems.pop(chat_id, None)
+
+    async def get_llm(self) -> LLMClient:
+        """Общий для процесса LLM клиент (тот же, что у FastAPI)."""
+        return await get_llm_client()
+
+
+bot_runtime = BotRuntime(
+    max_tasks=settings.BOT_MAX_CONCURRENT_TASKS,
+    per_chat=settings.BOT_PER_CHAT_CONCURRENCY,
+    per_chat_queue=settings.BOT_PER_CHAT_QUEUE,
+)
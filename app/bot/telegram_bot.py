@@ -3,24 +3,15 @@ import asyncio
 import logging
 import re
 import time
-import threading
-import requests
-import io
-try:
-    import fitz  # PyMuPDF
-except ImportError:
-    fitz = None
-
-try:
-    import pypdf
-except ImportError:
-    pypdf = None
 
 from telebot import types
 from app.core.config import settings
-from app.core.llm_client import LLMClient
-from app.services.rag_system import RAGSystem
 from app.services.sql_service import sql_service
+from app.services import async_service
+from app.bot.runtime import bot_runtime
+from app.core.llm_client import LLMStreamError
+from app.services.answer_cache import answer_cache
+from app.services.analysis_queue import analysis_queue
 
 # Настройка логгера
 logging.basicConfig(level=logging.INFO)
@@ -30,7 +21,6 @@ logger = logging.getLogger(__name__)
 print("--- [DEBUG] Инициализация бота... ---")
 bot = telebot.TeleBot(settings.TELEGRAM_TOKEN)
 print(f"--- [DEBUG] Бот инициализирован с токеном: {settings.TELEGRAM_TOKEN[:5]}... ---")
-rag_system = RAGSystem()
 
 # === Хранение состояний (State Machine на минималках) ===
 # user_state[chat_id] = {
@@ -40,6 +30,8 @@ rag_system = RAGSystem()
 # }
 user_context = {}
 
+BUSY_MESSAGE = "⏳ Предыдущие запросы ещё обрабатываются, подождите немного."
+
 def get_user_context(chat_id):
     if chat_id not in user_context:
         # Пытаемся найти первую доступную таблицу
@@ -252,7 +244,7 @@ def handle_text(message):
         table = ctx["table"]
         
         bot.send_chat_action(chat_id, "typing")
-        results = sql_service.search_books(field, text, table)
+        results = sql_service.search_books(field, text, table, ranked=True)
         
         if not results:
             bot.send_message(chat_id, f"❌ В каталоге '{table}' ничего не найдено.")
@@ -299,70 +291,10 @@ def handle_text(message):
         bot.send_message(chat_id, "Поиск завершен. Выберите действие.", reply_markup=get_main_menu())
         return
 
-    # 3. Режим RAG (AI)
+    # 3. Режим RAG (AI) - в общем event loop бота, поток polling не блокируется
     if ctx["mode"] == "rag":
-        asyncio.run(process_ai_answer(chat_id, text))
-
-def is_garbage_text(text: str) -> bool:
-    """Проверяет, похож ли текст на мусор (мало кириллицы)."""
-    if not text or len(text) < 50: return True
-    cyrillic_count = len(re.findall(r'[а-яА-ЯёЁ]', text))
-    # Если кириллицы меньше 5%, считаем что кодировка битая (для русских книг)
-    if cyrillic_count / len(text) < 0.05:
-        return True
-    return False
-
-def download_pdf_text(url: str) -> str:
-    """Скачивает PDF и извлекает текст (fitz -> pypdf)."""
-    if not fitz and not pypdf:
-        raise ImportError("Библиотеки fitz и pypdf не установлены.")
-        
-    try:
-        # Скачиваем файл
-        response = requests.get(url, timeout=30, verify=False)
-        response.raise_for_status()
-        content = response.content
-        
-        extracted_text = ""
-        
-        # 1. Пробуем fitz (PyMuPDF)
-        if fitz:
-            try:
-                with fitz.open(stream=content, filetype="pdf") as doc:
-                    pages = []
-                    for i, page in enumerate(doc):
-                        if i >= 40: break
-                        blocks = page.get_text("blocks", sort=True)
-                        page_text = "\n".join([b[4] for b in blocks])
-                        pages.append(page_text)
-                    extracted_text = "\n".join(pages)
-            except Exception as e:
-                logger.error(f"Fitz extract error: {e}")
-
-        # 2. Если fitz не справился (мусор или пусто), пробуем pypdf
-        if is_garbage_text(extracted_text) and pypdf:
-            logger.info("Fitz returned garbage/empty. Trying pypdf...")
-            try:
-                reader = pypdf.PdfReader(io.BytesIO(content))
-                pages = []
-                for i, page in enumerate(reader.pages):
-                    if i >= 40: break
-                    pages.append(page.extract_text() or "")
-                extracted_text = "\n".join(pages)
-            except Exception as e:
-                logger.error(f"pypdf extract error: {e}")
-        
-        # 3. Финальная проверка
-        if is_garbage_text(extracted_text):
-            logger.warning(f"Failed to extract readable text from {url}")
-            return "⚠️ Не удалось извлечь читаемый текст из PDF (проблема с кодировкой или защитой)."
-            
-        logger.info(f"PDF Text Preview (200 chars): {extracted_text[:200]}")
-        return extracted_text
-
-    except Exception as e:
-        logger.error(f"Error downloading PDF {url}: {e}")
-        raise e
+        if not bot_runtime.submit(chat_id, lambda: process_ai_answer(chat_id, text)):
+            bot.send_message(chat_id, BUSY_MESSAGE)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('anl:'))
 def handle_analyze_pdf(call):
@@ -371,89 +303,113 @@ def handle_analyze_pdf(call):
         _, table, book_id = call.data.split(':')
         chat_id = call.message.chat.id
         
-        bot.answer_callback_query(call.id, "Загружаю текст книги...")
-        bot.send_chat_action(chat_id, "typing")
-        
-        # 1. Получаем текст и URL из БД
-        text, url = sql_service.get_book_text(int(book_id), table)
-        
-        # Если текста нет в БД, пробуем скачать PDF
-        if not text and url and url.lower().startswith('http'):
-            bot.send_message(chat_id, "📥 Текста нет в базе. Скачиваю PDF с сайта (это займет время)...")
-            try:
-                text = download_pdf_text(url)
-            except Exception as e:
-                logger.error(f"Download error: {e}")
-                bot.send_message(chat_id, f"⚠️ Не удалось скачать PDF: {e}")
-                return
-
-        if not text:
-            bot.send_message(chat_id, "⚠️ Не удалось получить текст книги для анализа.")
+        # Скачивание, разбор PDF и запрос к LLM - в фоновой очереди анализа
+        if not bot_runtime.submit(chat_id, lambda: process_pdf_analysis(chat_id, table, int(book_id))):
+            bot.answer_callback_query(call.id, BUSY_MESSAGE)
             return
-            
-        # Ограничиваем длину текста для анализа
-        analyze_text = text[:8000] 
-        
-        bot.send_message(chat_id, f"📝 Анализирую текст (первые {len(analyze_text)} симв.)... Подождите 1-2 минуты.")
-        
-        # 2. Формируем запрос к LLM
-        prompt = f"""Проанализируй следующий текст из книги и составь краткое содержание (summary) на русском языке.
-
-ТВОЯ ЗАДАЧА:
-Напиши краткое содержание книги.
-НИКАКОГО АНАЛИЗА ПЕРЕД ОТВЕТОМ.
-
-НАЧИНАЙ ОТВЕТ СРАЗУ С ФРАЗЫ: "Краткое содержание:"
-
-Текст:
-{analyze_text}"""
-
-
-        # 3. Отправляем в LLM (в отдельном потоке, чтобы не блокировать бота)
-        def run_analysis():
-            asyncio.run(process_ai_analysis(chat_id, prompt))
-            
-        threading.Thread(target=run_analysis).start()
+        bot.answer_callback_query(call.id, "Ставлю книгу на анализ...")
         
     except Exception as e:
         logger.error(f"Error analyzing PDF: {e}")
         bot.send_message(call.message.chat.id, "⚠️ Произошла ошибка при анализе.")
 
-async def process_ai_analysis(chat_id, prompt):
-    """Асинхронная отправка запроса на анализ"""
-    llm_client = LLMClient()
+async def process_pdf_analysis(chat_id, table, book_id):
+    """Ставит анализ книги в общую очередь; результат придет уведомлением (notify_analysis_done)."""
+    await asyncio.to_thread(bot.send_chat_action, chat_id, "typing")
+    
     try:
-        messages = [{"role": "user", "content": prompt}]
-        
-        answer = await llm_client.chat_completion(
-            messages,
-            temperature=0.3,
-            max_tokens=1000
-        )
-        
-        # Очищаем ответ
-        clean_answer = clean_llm_response(answer)
-        
-        send_long_message(chat_id, f"📋 **Результат анализа:**\n\n{clean_answer}")
-        
+        job = await analysis_queue.submit(table, book_id, chat_id=chat_id)
     except Exception as e:
-        logger.error(f"LLM Error during analysis: {e}")
-        bot.send_message(chat_id, "⚠️ Ошибка при обращении к нейросети.")
-    finally:
-        await llm_client.close()
+        logger.error(f"Analysis enqueue error: {e}")
+        await asyncio.to_thread(bot.send_message, chat_id, "⚠️ Не удалось поставить книгу в очередь на анализ.")
+        return
+    
+    # Книгу уже анализировали - отдаем сохраненное резюме
+    if job["status"] == "done":
+        await asyncio.to_thread(send_long_message, chat_id, f"📋 **Результат анализа:**\n\n{job['result']}")
+        return
+    
+    await asyncio.to_thread(
+        bot.send_message, chat_id,
+        f"📝 Книга поставлена в очередь на анализ (задача №{job['job_id']}). Пришлю результат, когда он будет готов - обычно 1-2 минуты."
+    )
+
+def notify_analysis_done(job):
+    """Рассылает результат задачи анализа чатам, которые её запросили (вызывается очередью)."""
+    for chat_id in job.get("notify_chats") or []:
+        try:
+            if job["status"] == "done":
+                send_long_message(chat_id, f"📋 **Результат анализа:**\n\n{job['result']}")
+            else:
+                bot.send_message(chat_id, f"⚠️ Не удалось проанализировать книгу: {job['error']}")
+        except Exception as e:
+            logger.error(f"Analysis notify error (chat {chat_id}): {e}")
 
+analysis_queue.on_complete(notify_analysis_done)
 
+async def stream_llm_to_message(llm_client, chat_id, message, messages, **kwargs) -> str:
+    """
+    Потоковая генерация ответа с постепенным обновлением сообщения message.
+    Правки идут не чаще BOT_STREAM_EDIT_INTERVAL (лимиты Telegram), в сообщении -
+    очищенный частичный ответ. Возвращает полный сырой ответ LLM;
+    если генерация оборвалась - пробрасывает LLMStreamError.
+    """
+    answer = ""
+    shown = ""
+    last_edit = time.monotonic()
+    
+    async for chunk in llm_client.stream_chat_completion(messages, **kwargs):
+        answer += chunk
+        if not message or time.monotonic() - last_edit < settings.BOT_STREAM_EDIT_INTERVAL:
+            continue
+        
+        partial = clean_llm_response(answer)[:4000]
+        if not partial or partial == shown:
+            continue
+        last_edit = time.monotonic()
+        try:
+            await asyncio.to_thread(bot.edit_message_text, partial + " ▌", chat_id, message.message_id)
+            shown = partial
+        except Exception as e:
+            # "message is not modified" и т.п. - не повод прерывать генерацию
+            logger.debug(f"Stream edit skipped: {e}")
+    
+    return answer
+
+async def finish_stream_message(chat_id, message, text):
+    """Заменяет промежуточное сообщение итоговым ответом (длинный - отправляется частями)."""
+    if message and len(text) <= 4000:
+        try:
+            await asyncio.to_thread(bot.edit_message_text, text, chat_id, message.message_id)
+            return
+        except Exception as e:
+            logger.debug(f"Final edit failed: {e}")
+    if message:
+        try:
+            await asyncio.to_thread(bot.delete_message, chat_id, message.message_id)
+        except Exception:
+            pass
+    await asyncio.to_thread(send_long_message, chat_id, text)
 
 async def process_ai_answer(chat_id, query):
-    bot.send_chat_action(chat_id, "typing")
+    await asyncio.to_thread(bot.send_chat_action, chat_id, "typing")
     
-    llm_client = LLMClient() 
+    llm_client = await bot_runtime.get_llm()
     
-    wait_msg = bot.send_message(chat_id, "🔎 Анализирую запрос и ищу книги... Это может занять 1-2 минуты.")
+    wait_msg = await asyncio.to_thread(bot.send_message, chat_id, "🔎 Анализирую запрос и ищу книги... Это может занять 1-2 минуты.")
     
     try:
-        # 1. Используем гибкий поиск
-        context = rag_system.search_flexible(query, top_k=5)
+        # 1. Используем гибкий поиск (эмбеддинг + Chroma - в пуле потоков RAG)
+        found = await async_service.rag_retrieve(query, top_k=5, flexible=True)
+        context = found["context"]
+        
+        # Тот же вопрос с тем же контекстом уже отвечали - отдаем из кэша
+        cache_args = ("bot", query, found["doc_ids"], found["version"])
+        cached = answer_cache.get(*cache_args, embedding=found["embedding"])
+        if cached is not None:
+            logger.info(f"Answer cache hit: '{query}'")
+            await finish_stream_message(chat_id, wait_msg, cached)
+            return
         
         # Логирование
         logger.info(f"Query: '{query}'")
@@ -501,12 +457,18 @@ async def process_ai_answer(chat_id, query):
             {"role": "user", "content": query}
         ]
         
-        # 3. Запрос
-        raw_answer = await llm_client.chat_completion(
-            messages, 
-            temperature=0.2,
-            max_tokens=1024
-        )
+        # 3. Запрос (ответ появляется в сообщении ожидания по мере генерации)
+        try:
+            raw_answer = await stream_llm_to_message(
+                llm_client, chat_id, wait_msg, messages,
+                temperature=0.2,
+                max_tokens=1024
+            )
+        except LLMStreamError as e:
+            # Частичный ответ не показываем и не кэшируем
+            logger.error(f"LLM stream failed: {e}")
+            await finish_stream_message(chat_id, wait_msg, f"⚠️ Не удалось получить ответ: {e}")
+            return
         
         # 4. Логирование
         logger.info(f"Raw LLM response (full): {raw_answer}")
@@ -523,27 +485,21 @@ async def process_ai_answer(chat_id, query):
                 # Извлекаем библиографические записи напрямую из контекста
                 clean_answer = extract_bibliographic_records(context)
         
-        # Удаляем сообщение о ожидании
-        if wait_msg:
-            try:
-                bot.delete_message(chat_id, wait_msg.message_id)
-            except Exception:
-                pass
+        if clean_answer:
+            answer_cache.put(*cache_args, clean_answer, embedding=found["embedding"])
         
-        # Отправляем с разбивкой на части
-        send_long_message(chat_id, clean_answer)
+        # Итоговый ответ - на месте сообщения ожидания (длинный - с разбивкой на части)
+        await finish_stream_message(chat_id, wait_msg, clean_answer)
         
     except Exception as e:
         logger.error(f"AI Error: {e}", exc_info=True)
         # Если была ошибка, тоже удаляем сообщение ожидания (если оно есть)
         if wait_msg:
             try:
-                bot.delete_message(chat_id, wait_msg.message_id)
+                await asyncio.to_thread(bot.delete_message, chat_id, wait_msg.message_id)
             except Exception:
                 pass
-        bot.send_message(chat_id, "⚠️ Произошла ошибка при генерации ответа.")
-    finally:
-        await llm_client.close()
+        await asyncio.to_thread(bot.send_message, chat_id, "⚠️ Произошла ошибка при генерации ответа.")
 
 
 def send_long_message(chat_id, text):
@@ -6,6 +6,7 @@
 # отдельно от кода.
 # =============================================================================
 import os
+from typing import Dict
 from pydantic_settings import BaseSettings
 from pydantic import Field
 
@@ -24,6 +25,16 @@ class Settings(BaseSettings):
     LLM_BASE_URL: str = Field(default="http://localhost:8080", env="LLM_BASE_URL")
     LLM_MODEL_NAME: str = Field(default="chatgpt-oss-20b", env="LLM_MODEL_NAME")
     LLM_MODEL_PATH: str = Field(default="./models/chatgpt-oss-20b-F16.gguf", env="LLM_MODEL_PATH")
+
+    # --- Пул соединений и очередь к LLM ---
+    # Макс. одновременных генераций по провайдерам (для llama.cpp = число слотов сервера)
+    LLM_MAX_INFLIGHT: Dict[str, int] = Field(
+        default={"local": 2, "openrouter": 8, "agentrouter": 8, "sberchat": 4}, env="LLM_MAX_INFLIGHT"
+    )
+    LLM_QUEUE_TIMEOUT: float = Field(default=180.0, env="LLM_QUEUE_TIMEOUT")  # Ожидание слота, сек
+    LLM_MAX_CONNECTIONS: int = Field(default=16, env="LLM_MAX_CONNECTIONS")
+    LLM_KEEPALIVE_EXPIRY: float = Field(default=120.0, env="LLM_KEEPALIVE_EXPIRY")
+    LLM_HTTP2: bool = Field(default=True, env="LLM_HTTP2")  # Нужен пакет h2
     
     # --- Ключи для API ---
     OPENROUTER_API_KEY: str = Field(default="", env="OPENROUTER_API_KEY")
@@ -37,12 +48,21 @@ class Settings(BaseSettings):
     
     # Настройки Telegram
     TELEGRAM_TOKEN: str = Field(default="", env="TELEGRAM_TOKEN")
+    BOT_MAX_CONCURRENT_TASKS: int = Field(default=16, env="BOT_MAX_CONCURRENT_TASKS")  # Одновременных задач бота
+    BOT_PER_CHAT_CONCURRENCY: int = Field(default=1, env="BOT_PER_CHAT_CONCURRENCY")   # Одновременных задач на чат
+    BOT_PER_CHAT_QUEUE: int = Field(default=3, env="BOT_PER_CHAT_QUEUE")               # Макс. задач чата в очереди
+    BOT_STREAM_EDIT_INTERVAL: float = Field(default=1.5, env="BOT_STREAM_EDIT_INTERVAL")  # Пауза между правками сообщения при потоковом ответе (с)
 
     # Настройки PostgreSQL (для поиска книг)
     DB_HOST: str = Field(default="localhost", env="DB_HOST")
     DB_NAME: str = Field(default="books-db", env="DB_NAME")
     DB_USER: str = Field(default="postgres", env="DB_USER")
     DB_PASS: str = Field(default="1", env="DB_PASS")
+
+    # Пул соединений PostgreSQL (общий для FastAPI и бота)
+    DB_POOL_MIN_SIZE: int = Field(default=1, env="DB_POOL_MIN_SIZE")
+    DB_POOL_MAX_SIZE: int = Field(default=10, env="DB_POOL_MAX_SIZE")
+    DB_POOL_TIMEOUT: float = Field(default=10.0, env="DB_POOL_TIMEOUT")  # Ожидание свободного соединения, сек
     
 # === ПУТИ (ВСЁ ВНУТРИ UPLOADS) ===
     BASE_DIR: str = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -59,7 +79,37 @@ class Settings(BaseSettings):
     CLEAN_TXT_DIR: str = os.path.join(UPLOAD_ROOT, "clean_texts")    # Итог OCR
     
     CHROMA_PATH: str = os.path.join(BASE_DIR, "chromadb_store")
-    
+
+    # === Кэш текста PDF (анализ книг по ссылке) ===
+    PDF_TEXT_CACHE_DIR: str = Field(default=os.path.join(UPLOAD_ROOT, "pdf_text_cache"), env="PDF_TEXT_CACHE_DIR")
+    PDF_TEXT_CACHE_REVALIDATE: int = Field(default=7 * 24 * 3600, env="PDF_TEXT_CACHE_REVALIDATE")  # Через сколько сек перепроверять условным GET
+    PDF_MAX_DOWNLOAD_MB: int = Field(default=200, env="PDF_MAX_DOWNLOAD_MB")        # Больше - скачивание прерывается
+    PDF_ANALYSIS_CHARS: int = Field(default=8000, env="PDF_ANALYSIS_CHARS")          # Сколько символов текста книги отдаем LLM на анализ
+
+    # === Очередь задач анализа книг ===
+    ANALYSIS_WORKERS: int = Field(default=2, env="ANALYSIS_WORKERS")                 # Одновременных анализов
+    ANALYSIS_MAX_ATTEMPTS: int = Field(default=3, env="ANALYSIS_MAX_ATTEMPTS")
+    ANALYSIS_POLL_INTERVAL: float = Field(default=10.0, env="ANALYSIS_POLL_INTERVAL")  # Опрос очереди, сек (новые задачи будят воркеры сразу)
+    ANALYSIS_RETRY_DELAY: float = Field(default=30.0, env="ANALYSIS_RETRY_DELAY")    # Отсрочка повтора, сек (удваивается с каждой попыткой)
+
+    # === Настройки пакетной индексации RAG ===
+    RAG_ENCODE_BATCH_SIZE: int = Field(default=64, env="RAG_ENCODE_BATCH_SIZE")    # Пачка для SentenceTransformer.encode
+    RAG_UPSERT_BATCH_SIZE: int = Field(default=1024, env="RAG_UPSERT_BATCH_SIZE")  # Пачка для collection.upsert
+
+    # === Пулы потоков для async API (эмбеддинги + Chroma, разбор PDF) ===
+    RAG_EXECUTOR_WORKERS: int = Field(default=2, env="RAG_EXECUTOR_WORKERS")
+    PDF_EXECUTOR_WORKERS: int = Field(default=2, env="PDF_EXECUTOR_WORKERS")
+
+    # === Кэш эмбеддингов запросов ===
+    EMBEDDING_CACHE_SIZE: int = Field(default=5000, env="EMBEDDING_CACHE_SIZE")
+    EMBEDDING_CACHE_TTL: int = Field(default=7 * 24 * 3600, env="EMBEDDING_CACHE_TTL")  # сек
+    EMBEDDING_CACHE_PATH: str = Field(default="", env="EMBEDDING_CACHE_PATH")  # Пусто - без сохранения на диск
+
+    # === Кэш ответов RAG ===
+    ANSWER_CACHE_SIZE: int = Field(default=1000, env="ANSWER_CACHE_SIZE")            # 0 - кэш выключен
+    ANSWER_CACHE_TTL: int = Field(default=24 * 3600, env="ANSWER_CACHE_TTL")         # сек
+    ANSWER_CACHE_SIMILARITY: float = Field(default=0.96, env="ANSWER_CACHE_SIMILARITY")  # Порог косинуса для близких запросов, 0 - только точное совпадение
+
     # === Настройки OCR движка ===
     OCR_ENGINE_DIR: str = os.path.join(BASE_DIR, "ocr_engine")
     
@@ -70,6 +120,15 @@ class Settings(BaseSettings):
     MODELS_DIR: str = os.path.join(BASE_DIR, "models")
     MODEL_NAME: str = "YandexGPT-5-Lite-8B-instruct-Q4_K_M.gguf"
     MODEL_PATH: str = os.path.join(MODELS_DIR, MODEL_NAME)
+
+    # Очистка OCR: server - llama.cpp HTTP-сервер с несколькими слотами, local - llama-cpp-python в процессе
+    OCR_LLM_BACKEND: str = Field(default="server", env="OCR_LLM_BACKEND")
+    OCR_LLM_URL: str = Field(default="http://localhost:8080", env="OCR_LLM_URL")
+    OCR_LLM_PARALLEL: int = Field(default=4, env="OCR_LLM_PARALLEL")              # = --parallel у llama-server
+    OCR_CHUNK_CHARS: int = Field(default=2000, env="OCR_CHUNK_CHARS")
+    OCR_MAX_TOKENS_RATIO: float = Field(default=1.3, env="OCR_MAX_TOKENS_RATIO")  # max_tokens относительно длины части
+    OCR_PREFILTER: bool = Field(default=True, env="OCR_PREFILTER")                  # Не отправлять в LLM уже чистые части
+    OCR_DICTIONARY_PATH: str = Field(default="", env="OCR_DICTIONARY_PATH")          # Доп. словарь для оценки качества (слово на строку)
     
     class Config:
         env_file = ".env"
@@ -86,7 +145,8 @@ folders = [
     settings.BOOKS_DIR,
     settings.TEMP_TXT_DIR,
     settings.CLEAN_TXT_DIR,
-    settings.CHROMA_PATH
+    settings.CHROMA_PATH,
+    settings.PDF_TEXT_CACHE_DIR
 ]
 # Создаем папки автоматом
 for p in folders:
@@ -3,15 +3,34 @@
 # Назначение: Универсальный клиент для отправки запросов к разным LLM.
 # =============================================================================
 
+import asyncio
+import json
 import logging
+import threading
 import httpx
 import os
-from typing import List, Dict, Any, Optional
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Dict, Any, Optional
 
 from app.core.config import get_settings
 
 logger = logging.getLogger(__name__)
 
+QUEUE_TIMEOUT_MESSAGE = "Ошибка клиента: LLM перегружена, попробуйте позже."
+
+
+def is_error_response(text: str) -> bool:
+    """Ошибки chat_completion возвращает текстом - такие ответы нельзя кэшировать."""
+    return not text or text.startswith(("Ошибка API:", "Ошибка клиента:"))
+
+
+class LLMStreamError(Exception):
+    """
+    Генерация в stream_chat_completion не завершилась (ошибка API, таймаут, обрыв).
+    Выбрасывается после последнего полученного фрагмента: уже отданный текст - неполный.
+    str(e) - сообщение для пользователя в том же формате, что у chat_completion.
+    """
+
 class LLMClient:
     """
     Универсальный клиент для работы с LLM.
@@ -64,13 +83,45 @@ class LLMClient:
 
         logger.info(f"Используемый API Key: {settings.AGENTROUTER_API_KEY[:8] if settings.AGENTROUTER_API_KEY else 'N/A'}...")
         
+        # Пул соединений: keep-alive, чтобы не платить за TCP/TLS на каждый запрос,
+        # HTTP/2 - если установлен пакет h2 и он включен в настройках
+        http2 = settings.LLM_HTTP2 and _h2_available()
         self.http_client = httpx.AsyncClient(
             base_url=self.base_url, 
             headers=headers, 
             timeout=300.0, 
-            verify=self.ssl_verify
+            verify=self.ssl_verify,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=settings.LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.LLM_MAX_CONNECTIONS,
+                keepalive_expiry=settings.LLM_KEEPALIVE_EXPIRY,
+            )
         )
 
+        # Ограничение одновременных генераций для провайдера (остальные ждут в очереди)
+        self.max_inflight = settings.LLM_MAX_INFLIGHT.get(self.provider, 4)
+        self.queue_timeout = settings.LLM_QUEUE_TIMEOUT
+        self._semaphore = asyncio.Semaphore(self.max_inflight)
+        # Клиент привязан к event loop, в котором создан; вызовы из других loop'ов
+        # (например, из потока Telegram-бота) перенаправляются сюда
+        self._loop = asyncio.get_running_loop()
+        self.stats = {"in_flight": 0, "waiting": 0, "completed": 0, "errors": 0, "queue_timeouts": 0}
+        logger.info(f"LLM пул: max_inflight={self.max_inflight}, http2={http2}")
+
+    async def _on_home_loop(self, factory):
+        """Выполняет корутину в "родном" loop'е клиента."""
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            return await factory()
+        if self._loop.is_closed():
+            raise RuntimeError("Event loop LLM клиента уже закрыт")
+        future = asyncio.run_coroutine_threadsafe(factory(), self._loop)
+        return await asyncio.wrap_future(future)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"provider": self.provider, "max_inflight": self.max_inflight, **self.stats}
+
     # --- Основной метод для общения с LLM ---
     async def chat_completion(
         self, 
@@ -79,6 +130,11 @@ class LLMClient:
         max_tokens: int = 500
     ) -> str:
         """Выполняет запрос к LLM и возвращает текстовый ответ."""
+        return await self._on_home_loop(
+            lambda: self._chat_completion(messages, temperature, max_tokens)
+        )
+
+    def _payload(self, messages, temperature, max_tokens, stream=False) -> Dict[str, Any]:
         payload = {
             "model": self.model_name,
             "messages": messages,
@@ -87,47 +143,177 @@ class LLMClient:
             # Оставляем без стоп-токенов, так как модель начинает с анализа
             # "stop": ["<|end|>", "<think>", "</think>", "analysis:", "thinking:", "<|channel|>analysis"]
         }
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    def _endpoint(self) -> str:
+        endpoint = "/chat/completions"
+        if self.provider == 'local':
+            endpoint = "/v1/chat/completions"
+        return endpoint
+
+    @asynccontextmanager
+    async def _slot(self):
+        """Занимает слот генерации; ждет не дольше queue_timeout (иначе asyncio.TimeoutError)."""
+        self.stats["waiting"] += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.stats["queue_timeouts"] += 1
+            logger.warning(f"LLM очередь: не дождались слота за {self.queue_timeout} с")
+            raise
+        finally:
+            self.stats["waiting"] -= 1
         
+        self.stats["in_flight"] += 1
         try:
-            endpoint = "/chat/completions"
-            if self.provider == 'local':
-                endpoint = "/v1/chat/completions"
-            
-            response = await self.http_client.post(endpoint, json=payload)
-            response.raise_for_status()
-            
-            data = response.json()
-            content = data["choices"][0]["message"]["content"]
-            return content
+            yield
+        finally:
+            self.stats["in_flight"] -= 1
+            self._semaphore.release()
+
+    async def _chat_completion(self, messages, temperature, max_tokens) -> str:
+        payload = self._payload(messages, temperature, max_tokens)
+        
+        try:
+            async with self._slot():
+                response = await self.http_client.post(self._endpoint(), json=payload)
+                response.raise_for_status()
+                
+                data = response.json()
+                content = data["choices"][0]["message"]["content"]
+                self.stats["completed"] += 1
+                return content
             
+        except asyncio.TimeoutError:
+            return QUEUE_TIMEOUT_MESSAGE
         except httpx.HTTPStatusError as e:
+            self.stats["errors"] += 1
             logger.error(f"Ошибка API запроса к LLM: {e.response.text}")
             return f"Ошибка API: {e.response.text}"
         except Exception as e:
+            self.stats["errors"] += 1
             logger.error(f"Неожиданная ошибка в LLM клиенте: {e}")
             return f"Ошибка клиента: {str(e)}"
 
+    # --- Потоковый вариант (stream: true) ---
+    async def stream_chat_completion(
+        self, 
+        messages: List[Dict[str, Any]], 
+        temperature: float = 0.7, 
+        max_tokens: int = 500
+    ) -> AsyncIterator[str]:
+        """
+        Выполняет запрос к LLM со stream: true и отдает фрагменты текста по мере генерации.
+        Ошибки не смешиваются с текстом ответа: генератор завершается исключением LLMStreamError.
+        """
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            async for chunk in self._stream_chat_completion(messages, temperature, max_tokens):
+                yield chunk
+            return
+
+        # Вызов из другого event loop: генерация идет в "родном" loop'е клиента,
+        # фрагменты передаются через очередь вызывающего loop'а
+        queue: asyncio.Queue = asyncio.Queue()
+        end = object()
+
+        async def pump():
+            try:
+                async for chunk in self._stream_chat_completion(messages, temperature, max_tokens):
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, end)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self._loop)
+        try:
+            while True:
+                item = await queue.get()
+                if item is end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()
+
+    async def _stream_chat_completion(self, messages, temperature, max_tokens) -> AsyncIterator[str]:
+        payload = self._payload(messages, temperature, max_tokens, stream=True)
+        
+        try:
+            async with self._slot():
+                async with self.http_client.stream("POST", self._endpoint(), json=payload) as response:
+                    if response.is_error:
+                        body = (await response.aread()).decode("utf-8", errors="replace")
+                        self.stats["errors"] += 1
+                        logger.error(f"Ошибка API запроса к LLM: {body}")
+                        raise LLMStreamError(f"Ошибка API: {body}")
+                    
+                    # Server-Sent Events: строки "data: {...}", конец - "data: [DONE]"
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        try:
+                            choices = json.loads(data).get("choices") or [{}]
+                        except ValueError:
+                            continue
+                        delta = (choices[0].get("delta") or {}).get("content")
+                        if delta:
+                            yield delta
+                    self.stats["completed"] += 1
+            
+        except LLMStreamError:
+            raise
+        except asyncio.TimeoutError:
+            raise LLMStreamError(QUEUE_TIMEOUT_MESSAGE)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Неожиданная ошибка в LLM клиенте: {e}")
+            raise LLMStreamError(f"Ошибка клиента: {str(e)}") from e
+
     async def close(self):
         """Закрывает HTTP-клиент."""
-        await self.http_client.aclose()
+        await self._on_home_loop(self.http_client.aclose)
+
+
+def _h2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        logger.info("Пакет h2 не установлен - LLM клиент работает по HTTP/1.1.")
+        return False
 
 
-# Глобальный экземпляр для FastAPI (чтобы не создавать клиент при каждом запросе)
+# Глобальный экземпляр на процесс: общий для FastAPI и Telegram-бота
+# (один пул соединений и один лимит одновременных генераций)
 _llm_client: Optional[LLMClient] = None
+_llm_lock = threading.Lock()
 
 async def get_llm_client() -> LLMClient:
-    """Зависимость для FastAPI, которая предоставляет LLM клиент."""
+    """Зависимость для FastAPI (и бота), которая предоставляет общий LLM клиент."""
     global _llm_client
-    # Пересоздаем клиент, если он не совпадает с настройками
-    if _llm_client is None or _llm_client.provider != get_settings().LLM_PROVIDER:
-        if _llm_client:
-            await _llm_client.close()
-        _llm_client = LLMClient()
-    return _llm_client
+    stale = None
+    with _llm_lock:
+        # Пересоздаем клиент, если он не совпадает с настройками
+        if _llm_client is None or _llm_client.provider != get_settings().LLM_PROVIDER:
+            stale = _llm_client
+            _llm_client = LLMClient()
+        client = _llm_client
+    if stale:
+        await stale.close()
+    return client
 
 async def close_llm_client():
     """Функция для корректного закрытия соединения при остановке сервера."""
     global _llm_client
-    if _llm_client:
-        await _llm_client.close()
-        _llm_client = None
\ No newline at end of file
+    with _llm_lock:
+        client, _llm_client = _llm_client, None
+    if client:
+        await client.close()
@@ -1,26 +1,33 @@
+import asyncio
+import json
 import threading
 import logging
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel
 
-from app.core.llm_client import get_llm_client, close_llm_client
-from app.services.rag_system import RAGSystem
+from app.core.llm_client import get_llm_client, close_llm_client, is_error_response, LLMStreamError
 from app.services.sql_service import sql_service
+from app.services import async_service
+from app.services.embedding_cache import query_embedding_cache
+from app.services.answer_cache import answer_cache
+from app.services.analysis_queue import analysis_queue, UnknownTableError
 from app.bot.telegram_bot import bot
+from app.bot.runtime import bot_runtime
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Инициализируем систему поиска один раз
-rag_system = RAGSystem()
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("🚀 Запуск приложения...")
     await get_llm_client()
+    # Воркеры фоновой очереди анализа книг (в этом event loop)
+    await analysis_queue.start()
+    # Общая для API и бота модель эмбеддингов + Chroma (загружается один раз на процесс)
+    await async_service.warmup_rag()
     
     # Бот в фоне
     # Бот в фоне
@@ -33,11 +40,18 @@ async def lifespan(app: FastAPI):
         except Exception as e:
             logger.error(f"--- [ERROR] Ошибка при запуске бота: {e}")
             
+    bot_runtime.start()
     bot_thread = threading.Thread(target=run_bot, daemon=True)
     bot_thread.start()
     
     yield
+    bot.stop_polling()
+    bot_runtime.stop()
+    await analysis_queue.stop()
     await close_llm_client()
+    async_service.shutdown()
+    sql_service.close()
+    query_embedding_cache.save()
 
 app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -50,18 +64,39 @@ class SearchRequest(BaseModel):
 def home():
     return FileResponse("static/index.html")
 
+# Кэш ответов: scope различает промпты (ответы API и бота не взаимозаменяемы)
+ANSWER_SCOPE = "api"
+
+def _rag_messages(query: str, context: str) -> list:
+    return [
+        {"role": "system", "content": f"Ответь на вопрос по книгам. Контекст:\n{context}"},
+        {"role": "user", "content": query}
+    ]
+
+def _cached_answer(query: str, found: dict):
+    return answer_cache.get(ANSWER_SCOPE, query, found["doc_ids"], found["version"], found["embedding"])
+
+def _store_answer(query: str, found: dict, answer: str):
+    if not is_error_response(answer):
+        answer_cache.put(ANSWER_SCOPE, query, found["doc_ids"], found["version"], answer, found["embedding"])
+
+async def _rag_answer(query: str) -> tuple:
+    """Контекст из RAG + ответ LLM (повторные вопросы отдаются из кэша ответов)."""
+    # Ищем в базе (эмбеддинг + Chroma - в отдельном пуле, не на event loop)
+    found = await async_service.rag_retrieve(query)
+    context = found["context"]
+    
+    answer = _cached_answer(query, found)
+    if answer is None:
+        llm = await get_llm_client()
+        answer = await llm.chat_completion(_rag_messages(query, context))
+        _store_answer(query, found, answer)
+    return answer, context
+
 # 1. API для RAG (Умный ответ)
 @app.post("/api/ask")
 async def ask(req: SearchRequest):
-    # Ищем в базе
-    context = rag_system.search(req.query)
-    
-    llm = await get_llm_client()
-    messages = [
-        {"role": "system", "content": f"Ответь на вопрос по книгам. Контекст:\n{context}"},
-        {"role": "user", "content": req.query}
-    ]
-    answer = await llm.chat_completion(messages)
+    answer, context = await _rag_answer(req.query)
     return {"answer": answer, "context": context}
 
 # 2. API для SQL (Точный поиск по каталогу)
@@ -80,54 +115,161 @@ class AdvancedSearchRequest(BaseModel):
     mode: str = "rag" # rag или sql
     table: str = "unit"
     field: str = "title"
+    ranked: bool = False # Сортировка по релевантности (pg_trgm / ts_rank)
 
 @app.post("/api/search")
 async def search_v2(req: AdvancedSearchRequest):
     if req.mode == "sql":
-        books = sql_service.search_books(req.field, req.query, req.table)
+        books = await async_service.search_books(req.field, req.query, req.table, req.ranked)
         return {"results": books, "mode": "sql"}
     else:
-        context = rag_system.search(req.query)
-        llm = await get_llm_client()
-        messages = [
-            {"role": "system", "content": f"Ответь на вопрос по книгам. Контекст:\n{context}"},
-            {"role": "user", "content": req.query}
-        ]
-        answer = await llm.chat_completion(messages)
+        answer, context = await _rag_answer(req.query)
         return {"answer": answer, "context": context, "mode": "rag"}
 
 @app.get("/api/tables")
 async def get_tables():
-    return {"tables": sql_service.get_available_tables()}
+    return {"tables": await async_service.get_available_tables()}
+
+@app.get("/api/db_stats")
+async def get_db_stats():
+    return sql_service.get_pool_stats()
+
+@app.get("/api/llm_stats")
+async def get_llm_stats():
+    llm = await get_llm_client()
+    return llm.get_stats()
+
+@app.get("/api/cache_stats")
+async def get_cache_stats():
+    return {
+        "query_embeddings": query_embedding_cache.stats(),
+        "answers": answer_cache.stats(),
+    }
 
 class AnalyzeRequest(BaseModel):
     book_id: int
     table: str
 
+def _job_response(job: dict) -> dict:
+    response = {"job_id": job["job_id"], "status": job["status"]}
+    if job["status"] == "done":
+        response["analysis"] = job["result"]
+    return response
+
+# Анализ выполняется в фоновой очереди: ответ - номер задачи, результат - через /api/jobs/{id}.
+# Одновременные запросы по одной книге получают одну и ту же задачу.
 @app.post("/api/analyze")
 async def analyze_book(req: AnalyzeRequest):
-    from app.bot.telegram_bot import download_pdf_text, clean_llm_response
-    
-    # 1. Получаем текст/url
-    text, url = sql_service.get_book_text(req.book_id, req.table)
+    try:
+        job = await analysis_queue.submit(req.table, req.book_id)
+    except UnknownTableError as e:
+        return {"error": str(e)}
+    return _job_response(job)
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: int):
+    job = await async_service.get_analysis_job(job_id)
+    if not job:
+        return {"error": "Задача не найдена"}
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "table": job["catalog_table"],
+        "book_id": job["book_id"],
+        "attempts": job["attempts"],
+        "analysis": job["result"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+
+# ==============================================================================
+# ПОТОКОВЫЕ ВАРИАНТЫ (Server-Sent Events)
+# ==============================================================================
+# Ответ LLM отдается по мере генерации: события context/status, delta (фрагменты), done/error.
+
+# Если событий от очереди нет столько секунд - проверяем статус задачи в БД
+JOB_STATUS_POLL = 5.0
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _sse_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/search/stream")
+async def search_stream(req: AdvancedSearchRequest):
+    async def events():
+        if req.mode == "sql":
+            books = await async_service.search_books(req.field, req.query, req.table, req.ranked)
+            yield _sse("done", {"results": books, "mode": "sql"})
+            return
+        
+        found = await async_service.rag_retrieve(req.query)
+        context = found["context"]
+        yield _sse("context", {"context": context})
+        
+        answer = _cached_answer(req.query, found)
+        if answer is not None:
+            yield _sse("delta", {"text": answer})
+            yield _sse("done", {"answer": answer, "mode": "rag", "cached": True})
+            return
+        
+        llm = await get_llm_client()
+        answer = ""
+        try:
+            async for chunk in llm.stream_chat_completion(_rag_messages(req.query, context)):
+                answer += chunk
+                yield _sse("delta", {"text": chunk})
+        except LLMStreamError as e:
+            # Оборванный ответ в кэш не попадает
+            yield _sse("error", {"error": str(e)})
+            return
+        _store_answer(req.query, found, answer)
+        yield _sse("done", {"answer": answer, "mode": "rag"})
     
-    if not text and url:
+    return _sse_response(events())
+
+@app.post("/api/analyze/stream")
+async def analyze_book_stream(req: AnalyzeRequest):
+    """Тот же анализ через очередь, но с ходом выполнения задачи в виде SSE."""
+    async def events():
         try:
-            text = download_pdf_text(url)
-        except Exception as e:
-            return {"error": f"Ошибка загрузки PDF: {str(e)}"}
-            
-    if not text:
-        return {"error": "Текст недоступен для анализа"}
+            job = await analysis_queue.submit(req.table, req.book_id)
+        except UnknownTableError as e:
+            yield _sse("error", {"error": str(e)})
+            return
+        if job["status"] == "done":
+            yield _sse("done", {"analysis": job["result"], "cached": True})
+            return
         
-    # 2. Анализ
-    llm = await get_llm_client()
-    prompt = f"Проанализируй текст и составь краткое содержание на русском языке:\n\n{text[:8000]}"
-    messages = [{"role": "user", "content": prompt}]
-    answer = await llm.chat_completion(messages)
+        job_id = job["job_id"]
+        yield _sse("status", {"message": f"Задача №{job_id} в очереди...", "job_id": job_id})
+        queue = analysis_queue.subscribe(job_id)
+        try:
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=JOB_STATUS_POLL)
+                except asyncio.TimeoutError:
+                    # Страховка от пропущенного события: проверяем статус в БД
+                    state = await async_service.get_analysis_job(job_id)
+                    if state and state["status"] == "done":
+                        event, data = "done", {"analysis": state["result"]}
+                    elif state and state["status"] == "failed":
+                        event, data = "error", {"error": state["error"]}
+                    else:
+                        continue
+                yield _sse(event, data)
+                if event in ("done", "error"):
+                    return
+        finally:
+            analysis_queue.unsubscribe(job_id, queue)
     
-    clean_answer = clean_llm_response(answer)
-    return {"analysis": clean_answer}
+    return _sse_response(events())
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,231 @@
+"""
+Фоновая очередь анализа книг (краткое содержание по тексту/PDF).
+
+Задачи хранятся в PostgreSQL (таблица analysis_jobs), выполняются пулом воркеров
+в event loop FastAPI. Повторные запросы по той же книге присоединяются к активной
+задаче, неудачные попытки повторяются до ANALYSIS_MAX_ATTEMPTS раз с растущей
+отсрочкой (ANALYSIS_RETRY_DELAY * 2^(попытка-1)).
+Готовый результат попадает в кэш кратких содержаний, подписчики (SSE) получают
+фрагменты ответа по мере генерации, обработчики on_complete - итог (уведомления бота).
+"""
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from app.core.config import settings
+from app.core.llm_client import get_llm_client
+from app.services import async_service
+from app.services.pdf_service import EXTRACT_FAILED_MESSAGE, PDFTooLargeError
+
+logger = logging.getLogger(__name__)
+
+# Вид промпта в кэше кратких содержаний
+SUMMARY_KIND = "analysis"
+
+ANALYSIS_PROMPT = """Проанализируй следующий текст из книги и составь краткое содержание (summary) на русском языке.
+
+ТВОЯ ЗАДАЧА:
+Напиши краткое содержание книги.
+НИКАКОГО АНАЛИЗА ПЕРЕД ОТВЕТОМ.
+
+НАЧИНАЙ ОТВЕТ СРАЗУ С ФРАЗЫ: "Краткое содержание:"
+
+Текст:
+{text}"""
+
+
+class PermanentJobError(Exception):
+    """Ошибка, которую бессмысленно повторять (у книги нет текста)."""
+
+
+class UnknownTableError(ValueError):
+    """Запрошенной таблицы-каталога нет в БД - задача не создается."""
+
+
+class AnalysisQueue:
+    def __init__(self, workers: int, max_attempts: int, poll_interval: float, retry_delay: float):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        # Подписчики на ход выполнения задач: job_id -> очереди событий (event, data)
+        self._subscribers: Dict[int, List[asyncio.Queue]] = {}
+        self._partial: Dict[int, str] = {}
+        self._callbacks: List[Callable[[Dict[str, Any]], None]] = []
+
+    async def start(self):
+        """Запускает воркеры в текущем event loop."""
+        if self._tasks:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        try:
+            requeued = await async_service.requeue_running_jobs()
+            if requeued:
+                logger.info(f"📋 Возвращено в очередь незавершенных задач анализа: {requeued}")
+        except Exception as e:
+            logger.error(f"Очередь анализа: не удалось восстановить задачи: {e}")
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"📋 Очередь анализа запущена (воркеров: {self.workers})")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def wake(self):
+        """Будит воркеры (можно вызывать из любого потока/loop'а)."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def on_complete(self, callback: Callable[[Dict[str, Any]], None]):
+        """Регистрирует синхронный обработчик завершенных задач (вызывается в пуле потоков)."""
+        self._callbacks.append(callback)
+
+    async def submit(self, table: str, book_id: int, chat_id: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Ставит анализ книги в очередь. Если краткое содержание уже есть в кэше,
+        задача не создается: возвращается {"job_id": None, "status": "done", "result": ...}.
+        Таблица приходит от клиента и дальше подставляется в SQL - только из списка каталогов,
+        иначе UnknownTableError.
+        """
+        if table not in await async_service.get_available_tables():
+            raise UnknownTableError(f"Неизвестная таблица: {table}")
+        cached = await async_service.get_cached_summary(book_id, table, SUMMARY_KIND)
+        if cached:
+            return {"job_id": None, "status": "done", "result": cached}
+        job = await async_service.enqueue_analysis_job(table, book_id, chat_id)
+        self.wake()
+        return {"job_id": job["id"], "status": job["status"], "result": job["result"]}
+
+    # --- Подписка на ход выполнения (только из loop'а очереди) ---
+
+    def subscribe(self, job_id: int) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        if self._partial.get(job_id):
+            queue.put_nowait(("delta", {"text": self._partial[job_id]}))
+        self._subscribers.setdefault(job_id, []).append(queue)
+        return queue
+
+    def unsubscribe(self, job_id: int, queue: asyncio.Queue):
+        queues = self._subscribers.get(job_id, [])
+        if queue in queues:
+            queues.remove(queue)
+        if not queues:
+            self._subscribers.pop(job_id, None)
+
+    def _publish(self, job_id: int, event: str, data: Dict[str, Any]):
+        for queue in self._subscribers.get(job_id, ()):
+            queue.put_nowait((event, data))
+
+    # --- Воркеры ---
+
+    async def _worker(self, n: int):
+        while True:
+            try:
+                job = await async_service.claim_analysis_job()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Очередь анализа: ошибка БД: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self._execute(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Например, БД недоступна при записи результата - воркер продолжает работу
+                logger.error(f"Очередь анализа: задача #{job['id']}: {e}", exc_info=True)
+
+    async def _execute(self, job: Dict[str, Any]):
+        job_id = job["id"]
+        logger.info(f"📋 Задача анализа #{job_id}: {job['catalog_table']}/{job['book_id']} (попытка {job['attempts']})")
+        try:
+            result = await self._analyze(job)
+        except asyncio.CancelledError:
+            # Остановка приложения - задача вернется в очередь при следующем старте
+            raise
+        except Exception as e:
+            retry = not isinstance(e, PermanentJobError) and job["attempts"] < self.max_attempts
+            logger.warning(f"Задача анализа #{job_id} не выполнена ({'повтор' if retry else 'отказ'}): {e}")
+            self._partial.pop(job_id, None)
+            if retry:
+                # Отсрочка растет с каждой попыткой: LLM/сайт с PDF могут быть перегружены
+                delay = self.retry_delay * 2 ** (job["attempts"] - 1)
+                await async_service.finish_analysis_job(job_id, "queued", error=str(e), delay=delay)
+                self._publish(job_id, "status", {"message": f"Повторная попытка через {delay:.0f} с..."})
+                return
+            finished = await async_service.finish_analysis_job(job_id, "failed", error=str(e))
+            self._publish(job_id, "error", {"error": str(e)})
+            await self._notify(finished)
+            return
+
+        self._partial.pop(job_id, None)
+        finished = await async_service.finish_analysis_job(job_id, "done", result=result)
+        self._publish(job_id, "done", {"analysis": result})
+        await self._notify(finished)
+
+    async def _analyze(self, job: Dict[str, Any]) -> str:
+        from app.bot.telegram_bot import clean_llm_response
+
+        job_id, table, book_id = job["id"], job["catalog_table"], job["book_id"]
+
+        # 1. Текст из БД или из PDF по ссылке (с дисковым кэшем)
+        text, url = await async_service.get_book_text(book_id, table)
+        if not text and url and url.lower().startswith("http"):
+            self._publish(job_id, "status", {"message": "Загрузка PDF..."})
+            try:
+                text = await async_service.download_pdf_text(url)
+            except PDFTooLargeError as e:
+                raise PermanentJobError(str(e))
+        if not text or text == EXTRACT_FAILED_MESSAGE:
+            raise PermanentJobError(text or "Текст недоступен для анализа")
+
+        # 2. Краткое содержание (фрагменты ответа уходят подписчикам).
+        # Оборванная генерация выбрасывает LLMStreamError - до сохранения дело не доходит.
+        self._publish(job_id, "status", {"message": "Анализ нейросетью..."})
+        llm = await get_llm_client()
+        messages = [{"role": "user", "content": ANALYSIS_PROMPT.format(text=text[:settings.PDF_ANALYSIS_CHARS])}]
+        answer = ""
+        self._partial[job_id] = ""
+        async for chunk in llm.stream_chat_completion(messages, temperature=0.3, max_tokens=1000):
+            answer += chunk
+            self._partial[job_id] = answer
+            self._publish(job_id, "delta", {"text": chunk})
+
+        if not answer.strip():
+            raise RuntimeError("LLM вернула пустой ответ")
+
+        result = clean_llm_response(answer)
+        await async_service.save_summary(book_id, table, SUMMARY_KIND, result)
+        return result
+
+    async def _notify(self, job: Optional[Dict[str, Any]]):
+        if not job:
+            return
+        for callback in self._callbacks:
+            try:
+                await asyncio.to_thread(callback, job)
+            except Exception as e:
+                logger.error(f"Обработчик завершения задачи #{job['id']}: {e}")
+
+
+analysis_queue = AnalysisQueue(
+    workers=settings.ANALYSIS_WORKERS,
+    max_attempts=settings.ANALYSIS_MAX_ATTEMPTS,
+    poll_interval=settings.ANALYSIS_POLL_INTERVAL,
+    retry_delay=settings.ANALYSIS_RETRY_DELAY,
+)
@@ -0,0 +1,136 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+from app.services.embedding_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+def context_hash(doc_ids: List[str]) -> str:
+    """Хэш набора найденных документов (порядок важен - он влияет на ответ LLM)."""
+    return hashlib.md5("\x1f".join(doc_ids).encode()).hexdigest()
+
+
+class AnswerCache:
+    """
+    Кэш готовых ответов LLM для RAG-запросов.
+
+    Ключ - (scope, нормализованный запрос, хэш id документов контекста): один и тот же
+    вопрос с тем же контекстом и тем же промптом (scope) дает тот же ответ.
+    Если передан эмбеддинг запроса и задан similarity_threshold, кэш попадает и на
+    близкие по смыслу формулировки с тем же контекстом.
+    При смене версии коллекции Chroma кэш целиком сбрасывается.
+    """
+    def __init__(self, max_size: int, ttl: float, similarity_threshold: float = 0.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._data: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._version: Any = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _check_version(self, version):
+        # Вызывается под self._lock
+        if version != self._version:
+            if self._data:
+                self.invalidations += 1
+                logger.info("♻️ Коллекция RAG изменилась - кэш ответов сброшен")
+            self._data.clear()
+            self._version = version
+
+    def get(
+        self,
+        scope: str,
+        query: str,
+        doc_ids: List[str],
+        version: Any,
+        embedding: Optional[List[float]] = None,
+    ) -> Optional[str]:
+        if self.max_size <= 0:
+            return None
+        ctx = context_hash(doc_ids)
+        key = (scope, normalize_query(query), ctx)
+        now = time.time()
+        with self._lock:
+            self._check_version(version)
+            item = self._data.get(key)
+            if item is not None and now - item[0] > self.ttl:
+                del self._data[key]
+                item = None
+            if item is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+
+            if embedding is not None and self.similarity_threshold > 0:
+                best_key, best_sim = None, self.similarity_threshold
+                for other_key, (ts, _, other_emb) in self._data.items():
+                    if other_key[0] != scope or other_key[2] != ctx or other_emb is None:
+                        continue
+                    if now - ts > self.ttl:
+                        continue
+                    # Эмбеддинги нормализованы - скалярное произведение равно косинусу
+                    sim = sum(a * b for a, b in zip(embedding, other_emb))
+                    if sim >= best_sim:
+                        best_key, best_sim = other_key, sim
+                if best_key is not None:
+                    self._data.move_to_end(best_key)
+                    self.hits += 1
+                    self.semantic_hits += 1
+                    return self._data[best_key][1]
+
+            self.misses += 1
+            return None
+
+    def put(
+        self,
+        scope: str,
+        query: str,
+        doc_ids: List[str],
+        version: Any,
+        answer: str,
+        embedding: Optional[List[float]] = None,
+    ):
+        if self.max_size <= 0:
+            return
+        key = (scope, normalize_query(query), context_hash(doc_ids))
+        with self._lock:
+            self._check_version(version)
+            self._data[key] = (time.time(), answer, embedding)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+# Общий кэш процесса (FastAPI + Telegram-бот)
+answer_cache = AnswerCache(
+    max_size=settings.ANSWER_CACHE_SIZE,
+    ttl=settings.ANSWER_CACHE_TTL,
+    similarity_threshold=settings.ANSWER_CACHE_SIMILARITY,
+)
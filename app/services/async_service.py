@@ -0,0 +1,141 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+from app.services.sql_service import sql_service
+from app.services.rag_system import get_rag_system
+from app.services import pdf_service
+from app.services.pdf_text_cache import pdf_text_cache
+
+logger = logging.getLogger(__name__)
+
+# Отдельные ограниченные пулы: медленный RAG (эмбеддинги + Chroma) не должен
+# занимать потоки, нужные для быстрых SQL-запросов, и наоборот.
+# SQL-пул по размеру совпадает с пулом соединений PostgreSQL.
+_sql_executor = ThreadPoolExecutor(max_workers=settings.DB_POOL_MAX_SIZE, thread_name_prefix="sql")
+_rag_executor = ThreadPoolExecutor(max_workers=settings.RAG_EXECUTOR_WORKERS, thread_name_prefix="rag")
+_pdf_executor = ThreadPoolExecutor(max_workers=settings.PDF_EXECUTOR_WORKERS, thread_name_prefix="pdf")
+
+
+async def _run(executor: ThreadPoolExecutor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+# --- SQL ---
+
+async def search_books(field: str, value: str, table: str = "unit", ranked: bool = False) -> List[Dict[str, Any]]:
+    return await _run(_sql_executor, sql_service.search_books, field, value, table, ranked)
+
+
+async def get_book_text(book_id: int, table: str = "unit") -> tuple:
+    return await _run(_sql_executor, sql_service.get_book_text, book_id, table)
+
+
+async def get_available_tables() -> List[str]:
+    return await _run(_sql_executor, sql_service.get_available_tables)
+
+
+# --- RAG ---
+
+# Модель загружается лениво внутри пула - первый запрос не блокирует event loop
+
+async def warmup_rag() -> None:
+    await _run(_rag_executor, get_rag_system)
+
+
+async def rag_search(query: str, top_k: int = 5) -> str:
+    return await _run(_rag_executor, lambda: get_rag_system().search(query, top_k))
+
+
+async def rag_search_flexible(query: str, top_k: int = 5) -> str:
+    return await _run(_rag_executor, lambda: get_rag_system().search_flexible(query, top_k))
+
+
+def _retrieve(query: str, top_k: int, flexible: bool) -> Dict[str, Any]:
+    rag = get_rag_system()
+    if flexible:
+        context, doc_ids = rag.search_flexible_with_ids(query, top_k)
+    else:
+        context, doc_ids = rag.search_with_ids(query, top_k)
+    return {
+        "context": context,
+        "doc_ids": doc_ids,
+        "embedding": rag.query_embedding(query),
+        "version": rag.collection_version(),
+    }
+
+
+async def rag_retrieve(query: str, top_k: int = 5, flexible: bool = False) -> Dict[str, Any]:
+    """Поиск контекста вместе с id документов, эмбеддингом запроса и версией коллекции (для кэша ответов)."""
+    return await _run(_rag_executor, _retrieve, query, top_k, flexible)
+
+
+# --- PDF ---
+
+async def download_pdf_text(url: str) -> str:
+    """
+    Текст PDF по ссылке. Сначала дисковый кэш (свежая запись - без сети, устаревшая -
+    условный GET); иначе потоковое скачивание во временный файл и разбор PDF в отдельном пуле.
+    """
+    cached = await _run(_pdf_executor, pdf_text_cache.lookup, url)
+    if cached and pdf_text_cache.is_fresh(cached):
+        return cached["text"]
+    
+    download = await pdf_service.fetch_pdf_async(url, pdf_text_cache.conditional_headers(cached))
+    if download.status_code == 304 and cached:
+        await _run(_pdf_executor, pdf_text_cache.touch, url, cached)
+        return cached["text"]
+    
+    try:
+        text = await _run(_pdf_executor, pdf_service.extract_pdf_text, download.path, url)
+    finally:
+        download.cleanup()
+    if text != pdf_service.EXTRACT_FAILED_MESSAGE:
+        await _run(
+            _pdf_executor, pdf_text_cache.store, url, download.sha256, text,
+            download.etag, download.last_modified,
+        )
+    return text
+
+
+# --- Кэш кратких содержаний (в PostgreSQL) ---
+
+async def get_cached_summary(book_id: int, table: str, kind: str) -> Optional[str]:
+    return await _run(_sql_executor, sql_service.get_cached_summary, book_id, table, kind)
+
+
+async def save_summary(book_id: int, table: str, kind: str, summary: str) -> None:
+    await _run(_sql_executor, sql_service.save_summary, book_id, table, kind, summary)
+
+
+# --- Очередь задач анализа (в PostgreSQL) ---
+
+async def enqueue_analysis_job(table: str, book_id: int, chat_id: Optional[int] = None) -> Dict[str, Any]:
+    return await _run(_sql_executor, sql_service.enqueue_analysis_job, table, book_id, chat_id)
+
+
+async def claim_analysis_job() -> Optional[Dict[str, Any]]:
+    return await _run(_sql_executor, sql_service.claim_analysis_job)
+
+
+async def finish_analysis_job(job_id: int, status: str, result: Optional[str] = None,
+                              error: Optional[str] = None, delay: float = 0.0) -> Optional[Dict[str, Any]]:
+    return await _run(_sql_executor, sql_service.finish_analysis_job, job_id, status, result, error, delay)
+
+
+async def requeue_running_jobs() -> int:
+    return await _run(_sql_executor, sql_service.requeue_running_jobs)
+
+
+async def get_analysis_job(job_id: int) -> Optional[Dict[str, Any]]:
+    return await _run(_sql_executor, sql_service.get_analysis_job, job_id)
+
+
+def shutdown():
+    """Останавливает пулы потоков (при остановке приложения)."""
+    for executor in (_sql_executor, _rag_executor, _pdf_executor):
+        executor.shutdown(wait=False, cancel_futures=True)
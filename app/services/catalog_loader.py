@@ -0,0 +1,177 @@
+"""
+Потоковая загрузка каталога в PostgreSQL через COPY FROM STDIN.
+
+Записи читаются из любого iterable (в т.ч. генератора), пишутся в staging-таблицу,
+на ней строятся индексы, после чего staging атомарно подменяет рабочую таблицу.
+Читатели всё время видят либо старый, либо новый каталог - пустой таблицы нет.
+Пустой источник (0 строк) таблицу не подменяет; распознанный текст книг (pdf_ocr)
+переносится из старой таблицы в новую.
+"""
+import io
+import logging
+import time
+from typing import Dict, Iterable, Iterator, Optional
+
+from app.services.catalog_schema import (
+    CATALOG_COLUMNS, TRGM_FIELDS,
+    add_search_column, create_search_indexes, trgm_index_name, tsv_index_name,
+)
+
+logger = logging.getLogger(__name__)
+
+# Колонки, которые заполняются при импорте (id генерируется)
+LOAD_COLUMNS = [
+    "title", "author", "subject", "grnti", "bbk",
+    "author_sign", "systematic_code", "owners", "pdf_url", "pdf_ocr",
+]
+
+
+class EmptyCatalogError(ValueError):
+    """В источнике нет ни одной записи - рабочая таблица остается прежней."""
+
+
+def _copy_value(value) -> str:
+    """Экранирование значения для текстового формата COPY."""
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class _CopyStream(io.TextIOBase):
+    """File-like объект для copy_expert: строки TSV генерируются по мере чтения."""
+
+    def __init__(self, records: Iterator[Dict]):
+        self._records = records
+        self._buffer = ""
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size: int = -1) -> str:
+        parts = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            item = next(self._records, None)
+            if item is None:
+                break
+            line = "\t".join(_copy_value(item.get(col)) for col in LOAD_COLUMNS) + "\n"
+            parts.append(line)
+            length += len(line)
+            self.count += 1
+        data = "".join(parts)
+        if size < 0:
+            self._buffer = ""
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+    def readline(self, size: int = -1) -> str:
+        return self.read(size)
+
+
+# Устойчивый ключ книги: ссылка на PDF, а без нее - название (id в staging генерируются заново)
+_BOOK_KEY_EXPR = "CASE WHEN {t}.pdf_url IS NOT NULL THEN 'url:' || {t}.pdf_url ELSE 'title:' || {t}.title END"
+
+
+def _carry_over_ocr(cur, staging: str, table_name: str) -> int:
+    """
+    Переносит pdf_ocr из рабочей таблицы в staging (в каталоге, из которого идет импорт,
+    распознанного текста нет - он появляется позже, при OCR). id в staging генерируются
+    заново и сдвигаются при любой вставке/удалении в источнике, поэтому книги сопоставляются
+    по ссылке на PDF (или по названию, если ссылки нет). Из дубликатов берется запись с меньшим id.
+    """
+    cur.execute("SELECT to_regclass(%s)", (table_name,))
+    if cur.fetchone()[0] is None:
+        return 0
+    cur.execute(f"""
+        UPDATE {staging} s SET pdf_ocr = o.pdf_ocr
+        FROM (
+            SELECT DISTINCT ON (book_key) book_key, pdf_ocr
+            FROM (
+                SELECT {_BOOK_KEY_EXPR.format(t='live')} AS book_key, live.pdf_ocr, live.id
+                FROM {table_name} live
+                WHERE live.pdf_ocr IS NOT NULL
+            ) keyed
+            WHERE book_key IS NOT NULL
+            ORDER BY book_key, id
+        ) o
+        WHERE s.pdf_ocr IS NULL AND {_BOOK_KEY_EXPR.format(t='s')} = o.book_key
+    """)
+    return cur.rowcount
+
+
+def _swap_tables(cur, staging: str, table_name: str):
+    """Подменяет рабочую таблицу staging-таблицей (в текущей транзакции)."""
+    cur.execute(f"DROP TABLE IF EXISTS {table_name}")
+    cur.execute(f"ALTER TABLE {staging} RENAME TO {table_name}")
+    # Возвращаем индексам/последовательности канонические имена,
+    # иначе следующий импорт не сможет создать их на новой staging-таблице
+    for field in TRGM_FIELDS:
+        cur.execute(f"ALTER INDEX {trgm_index_name(staging, field)} RENAME TO {trgm_index_name(table_name, field)}")
+    cur.execute(f"ALTER INDEX {tsv_index_name(staging)} RENAME TO {tsv_index_name(table_name)}")
+    cur.execute(f"ALTER INDEX {staging}_pkey RENAME TO {table_name}_pkey")
+    cur.execute(f"ALTER SEQUENCE {staging}_id_seq RENAME TO {table_name}_id_seq")
+
+
+def bulk_load_catalog(conn, table_name: str, records: Iterable[Dict], buffer_size: Optional[int] = None) -> int:
+    """
+    Загружает записи каталога в table_name через COPY + staging + атомарную подмену.
+
+    Args:
+        conn: соединение psycopg2.
+        table_name: имя рабочей таблицы (уже провалидированное).
+        records: iterable словарей с ключами из LOAD_COLUMNS.
+        buffer_size: размер блока чтения для COPY (байт).
+
+    Returns:
+        Количество загруженных строк.
+
+    Raises:
+        EmptyCatalogError: в records нет записей (рабочая таблица не тронута).
+    """
+    staging = f"{table_name}_staging"
+    started = time.perf_counter()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {staging}")
+            cur.execute(f"CREATE TABLE {staging} ({CATALOG_COLUMNS})")
+            # search_tsv вычисляется прямо во время COPY, без перезаписи таблицы потом
+            add_search_column(cur, staging)
+
+            stream = _CopyStream(iter(records))
+            cur.copy_expert(
+                f"COPY {staging} ({', '.join(LOAD_COLUMNS)}) FROM STDIN",
+                stream,
+                size=buffer_size or 1024 * 1024,
+            )
+            loaded = time.perf_counter()
+            if stream.count == 0:
+                # Пустой или нераспознанный файл не должен подменить рабочий каталог пустым
+                raise EmptyCatalogError(f"{table_name}: в источнике 0 записей - таблица не заменена")
+
+            # Распознанный текст из старой таблицы (до индексов - обновление дешевле)
+            carried = _carry_over_ocr(cur, staging, table_name)
+
+            # Индексы строим после загрузки - так в разы быстрее, чем поддерживать их при вставке
+            create_search_indexes(cur, staging)
+            _swap_tables(cur, staging, table_name)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    elapsed = time.perf_counter() - started
+    rate = stream.count / (loaded - started) if loaded > started else 0
+    logger.info(
+        f"🐘 COPY {table_name}: {stream.count} строк, {rate:.0f} строк/с "
+        f"(всего с индексами {elapsed:.1f} с, перенесено pdf_ocr: {carried})"
+    )
+    return stream.count
@@ -0,0 +1,125 @@
+"""
+Схема таблиц каталога и поисковые индексы.
+
+Общая для скриптов импорта (1_process_catalogs.py, 2_import_sql.py) и SQLService:
+- pg_trgm GIN-индексы на author/title/subject/bbk/grnti ускоряют ILIKE '%...%'
+  и similarity-ранжирование;
+- колонка search_tsv (tsvector, русская конфигурация) + GIN-индекс для полнотекстового поиска.
+
+Здесь же служебные таблицы: кэш кратких содержаний и очередь задач анализа книг.
+"""
+
+# Поля, по которым строятся триграммные индексы
+TRGM_FIELDS = ["author", "title", "subject", "bbk", "grnti"]
+
+# Конфигурация полнотекстового поиска
+TS_CONFIG = "russian"
+
+CATALOG_COLUMNS = """
+    id SERIAL PRIMARY KEY,
+    title TEXT, author TEXT, subject TEXT,
+    grnti TEXT, bbk TEXT, author_sign TEXT,
+    systematic_code TEXT, owners TEXT,
+    pdf_url TEXT, pdf_ocr TEXT
+"""
+
+SEARCH_TSV_EXPR = f"""
+    setweight(to_tsvector('{TS_CONFIG}', coalesce(title, '')), 'A') ||
+    setweight(to_tsvector('{TS_CONFIG}', coalesce(author, '')), 'A') ||
+    setweight(to_tsvector('{TS_CONFIG}', coalesce(subject, '')), 'B')
+"""
+
+
+# Служебные таблицы (не каталоги) - не показываются в списке баз
+SUMMARY_TABLE = "book_summaries"
+JOBS_TABLE = "analysis_jobs"
+SERVICE_TABLES = {SUMMARY_TABLE, JOBS_TABLE}
+
+# Ключ источника краткого содержания: при переимпорте каталога id переназначаются,
+# а после OCR меняется текст - сохраненное резюме должно перестать совпадать
+SUMMARY_SOURCE_KEY_EXPR = "md5(coalesce(b.title, '') || coalesce(b.pdf_url, '') || md5(coalesce(b.pdf_ocr, '')))"
+
+
+def trgm_index_name(table_name: str, field: str) -> str:
+    return f"{table_name}_{field}_trgm_idx"
+
+
+def tsv_index_name(table_name: str) -> str:
+    return f"{table_name}_search_tsv_idx"
+
+
+def create_catalog_table(cur, table_name: str):
+    """Создает таблицу каталога, если её нет."""
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({CATALOG_COLUMNS})")
+
+
+def add_search_column(cur, table_name: str):
+    """Добавляет вычисляемую колонку search_tsv (если её ещё нет)."""
+    cur.execute(f"""
+        ALTER TABLE {table_name}
+        ADD COLUMN IF NOT EXISTS search_tsv tsvector
+        GENERATED ALWAYS AS ({SEARCH_TSV_EXPR}) STORED
+    """)
+
+
+def create_search_indexes(cur, table_name: str):
+    """
+    Создает расширение pg_trgm, колонку search_tsv и GIN-индексы.
+    Идемпотентно: повторный вызов ничего не пересоздает.
+    """
+    cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    add_search_column(cur, table_name)
+    for field in TRGM_FIELDS:
+        cur.execute(
+            f"CREATE INDEX IF NOT EXISTS {trgm_index_name(table_name, field)} "
+            f"ON {table_name} USING gin ({field} gin_trgm_ops)"
+        )
+    cur.execute(
+        f"CREATE INDEX IF NOT EXISTS {tsv_index_name(table_name)} "
+        f"ON {table_name} USING gin (search_tsv)"
+    )
+    cur.execute(f"ANALYZE {table_name}")
+
+
+def create_summary_table(cur):
+    """Таблица кэша кратких содержаний книг (ключ - каталог, id книги, вид промпта)."""
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {SUMMARY_TABLE} (
+            catalog_table TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            source_key TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (catalog_table, book_id, kind)
+        )
+    """)
+
+
+def create_jobs_table(cur):
+    """
+    Очередь задач анализа книг. Частичный уникальный индекс гарантирует не больше
+    одной активной (queued/running) задачи на книгу - повторные запросы к ней присоединяются.
+    run_after - не раньше какого времени задачу можно взять (отсрочка повторных попыток).
+    """
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {JOBS_TABLE} (
+            id SERIAL PRIMARY KEY,
+            catalog_table TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            notify_chats BIGINT[] NOT NULL DEFAULT '{{}}',
+            run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    # Таблицы, созданные до появления отсрочки
+    cur.execute(f"ALTER TABLE {JOBS_TABLE} ADD COLUMN IF NOT EXISTS run_after TIMESTAMPTZ NOT NULL DEFAULT now()")
+    cur.execute(f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS {JOBS_TABLE}_active_idx
+        ON {JOBS_TABLE} (catalog_table, book_id) WHERE status IN ('queued', 'running')
+    """)
@@ -0,0 +1,151 @@
+"""
+Быстрая классификация кропов химического конвейера: похож ли кроп на рисунок
+молекулы, стоит ли отправлять его в MolScribe.
+
+DeepSeek размечает как equation/formula/image/figure и математические формулы,
+и фотографии, и просто абзацы текста - MolScribe на них тратит время и выдает
+мусорные SMILES. Сигналы (по области детекции, без отступа):
+- доля "чернил" (порог Оцу): плотный текст - много, пустая область - почти ноль;
+- доля небелого фона и цветных пикселей: фотографии и иллюстрации;
+- доля тонких штрихов в длинных прямых линиях по вертикали и диагоналям
+  (30/45/60 градусов и зеркально) - связи молекулы; в тексте и формулах
+  таких линий почти нет (горизонтальные не учитываются: дроби, тире, стрелки);
+- соотношение сторон: узкие широкие строки (формулы) требуют вдвое больше линий.
+Классы: molecule, equation, text, photo, empty. Оценка "молекулярности" >= 1 - molecule.
+
+Модуль без зависимостей от настроек приложения (только numpy и PIL),
+чтобы его можно было импортировать и из отдельного окружения MolScribe.
+"""
+import math
+from typing import Dict, Tuple
+
+import numpy as np
+from PIL import Image
+
+MOLECULE = "molecule"
+CLASSES = (MOLECULE, "equation", "text", "photo", "empty")
+
+THRESHOLDS = {
+    "empty_ink": 0.002,     # меньше чернил - пустая область
+    "photo_cover": 0.45,    # доля не-фона больше - фото/заливка
+    "photo_colour": 0.05,   # доля цветных пикселей (сверх оттенка бумаги)
+    "text_ink": 0.18,       # плотный абзац текста
+    "molecule_lines": 0.025,  # доля тонких штрихов в длинных линиях
+    "wide_aspect": 6.0,     # ширина/высота, начиная с которой порог линий удваивается
+}
+
+# Масштаб, к которому приводятся длины (кропы режутся со страниц в 300 DPI)
+REF_DPI = 300
+# Линия считается длинной с 45 px при 300 DPI - длиннее диагоналей букв основного текста
+LONG_LINE = 45
+# Штрихи толще ~9 px при 300 DPI - заливка/тень, а не линия
+THICK_STROKE = 4
+MAX_SIDE = 640
+# Меньше по любой стороне - вырожденная рамка (после округления координат), считаем пустой
+MIN_SIDE = 4
+LINE_ANGLES = (90, 30, 45, 60, 120, 135, 150)
+
+
+def _shift(mask: np.ndarray, dx: int, dy: int) -> np.ndarray:
+    """out[y, x] = mask[y + dy, x + dx] (за границей - False)."""
+    h, w = mask.shape
+    out = np.zeros_like(mask)
+    if abs(dx) >= w or abs(dy) >= h:
+        return out
+    out[max(0, -dy):h - max(0, dy), max(0, -dx):w - max(0, dx)] = \
+        mask[max(0, dy):h - max(0, -dy), max(0, dx):w - max(0, -dx)]
+    return out
+
+
+def _dilate(mask: np.ndarray) -> np.ndarray:
+    out = mask.copy()
+    for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+        out |= _shift(mask, dx, dy)
+    return out
+
+
+def _erode(mask: np.ndarray, r: int) -> np.ndarray:
+    out = mask.copy()
+    for dx in range(-r, r + 1):
+        for dy in range(-r, r + 1):
+            out &= _shift(mask, dx, dy)
+    return out
+
+
+def _otsu(lum: np.ndarray) -> int:
+    hist = np.bincount(lum.astype(np.uint8).ravel(), minlength=256).astype(np.float64)
+    p = hist / hist.sum()
+    w = np.cumsum(p)
+    mu = np.cumsum(p * np.arange(256))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mu[-1] * w - mu) ** 2 / (w * (1 - w))
+    return int(np.nanargmax(between)) if np.isfinite(between).any() else 127
+
+
+def _line_ratio(thin: np.ndarray, length: int) -> float:
+    """Доля тонких штрихов, лежащих на прямых отрезках длиной >= length в направлениях LINE_ANGLES."""
+    total = int(thin.sum())
+    if not total:
+        return 0.0
+    mask = _dilate(thin)  # допуск на сглаживание и JPEG
+    on_lines = 0
+    for angle in LINE_ANGLES:
+        cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+        starts = mask.copy()
+        for i in range(1, length + 1):
+            starts &= _shift(mask, int(round(i * cos)), int(round(i * sin)))
+        on_lines += int((starts & thin).sum())
+    return on_lines / total
+
+
+def crop_signals(image: Image.Image, dpi: int = REF_DPI) -> Dict[str, float]:
+    """Сырые значения сигналов для области кропа."""
+    image = image.convert("RGB")
+    scale = min(1.0, MAX_SIDE / max(image.size))
+    if scale < 1.0:
+        image = image.resize(
+            (max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.BILINEAR
+        )
+    unit = scale * dpi / REF_DPI
+
+    rgb = np.asarray(image, dtype=np.int16)
+    lum = rgb.mean(axis=2)
+    background = np.percentile(lum, 90)
+    ink = lum <= _otsu(lum)
+    thick = _erode(ink, max(1, int(round(THICK_STROKE * unit))))
+    thin = ink & ~_dilate(_dilate(thick))
+    chroma = rgb.max(axis=2) - rgb.min(axis=2)
+
+    return {
+        "ink": float(ink.mean()),
+        "cover": float((lum < 0.8 * background).mean()),
+        "colour": float((chroma > np.median(chroma) + 40).mean()),
+        "lines": _line_ratio(thin, max(4, int(round(LONG_LINE * unit)))),
+        "aspect": image.width / image.height,
+    }
+
+
+def classify_crop(image: Image.Image, dpi: int = REF_DPI) -> Tuple[str, float, Dict[str, float]]:
+    """
+    Класс области кропа и оценка "молекулярности" (>= 1 - молекула).
+    Returns: (класс из CLASSES, оценка, сигналы)
+    """
+    if min(image.size) < MIN_SIDE:
+        return "empty", 0.0, {}
+    signals = crop_signals(image, dpi)
+    lines_threshold = THRESHOLDS["molecule_lines"]
+    if signals["aspect"] > THRESHOLDS["wide_aspect"]:
+        lines_threshold *= 2
+    score = signals["lines"] / lines_threshold
+
+    if signals["ink"] < THRESHOLDS["empty_ink"]:
+        label = "empty"
+    elif signals["cover"] > THRESHOLDS["photo_cover"] or signals["colour"] > THRESHOLDS["photo_colour"]:
+        label = "photo"
+    elif signals["ink"] > THRESHOLDS["text_ink"]:
+        label = "text"
+    elif score >= 1.0:
+        label = MOLECULE
+    else:
+        label = "equation"
+    return label, score, signals
@@ -0,0 +1,118 @@
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(text: str) -> str:
+    """Нормализация запроса для ключа кэша: регистр и лишние пробелы не важны."""
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class EmbeddingCache:
+    """
+    LRU-кэш эмбеддингов запросов с ограничением по размеру и TTL.
+    Потокобезопасен: им одновременно пользуются FastAPI и поток Telegram-бота.
+    Опционально сохраняется на диск и подгружается при старте.
+    """
+    def __init__(self, max_size: int, ttl: float, path: Optional[str] = None, namespace: str = ""):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        # Эмбеддинги разных моделей несовместимы - в файле храним, для какой модели кэш
+        self.namespace = namespace
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load()
+
+    def get(self, text: str) -> Optional[List[float]]:
+        key = normalize_query(text)
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or now - item[0] > self.ttl:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, text: str, embedding: List[float]):
+        key = normalize_query(text)
+        with self._lock:
+            self._data[key] = (time.time(), embedding)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                payload = pickle.load(f)
+            if payload.get("namespace") != self.namespace:
+                logger.info("Кэш эмбеддингов создан для другой модели - игнорируем.")
+                return
+            now = time.time()
+            with self._lock:
+                for key, (ts, emb) in payload.get("items", []):
+                    if now - ts <= self.ttl:
+                        self._data[key] = (ts, emb)
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
+            logger.info(f"📦 Загружен кэш эмбеддингов: {len(self._data)} запросов")
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить кэш эмбеддингов {self.path}: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            items = list(self._data.items())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump({"namespace": self.namespace, "items": items}, f)
+            os.replace(tmp_path, self.path)
+            logger.info(f"💾 Кэш эмбеддингов сохранен: {len(items)} запросов")
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить кэш эмбеддингов {self.path}: {e}")
+
+
+# Общий кэш процесса (FastAPI + Telegram-бот)
+query_embedding_cache = EmbeddingCache(
+    max_size=settings.EMBEDDING_CACHE_SIZE,
+    ttl=settings.EMBEDDING_CACHE_TTL,
+    path=settings.EMBEDDING_CACHE_PATH or None,
+    namespace=settings.EMBEDDING_MODEL_PATH,
+)
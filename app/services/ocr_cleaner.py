@@ -0,0 +1,216 @@
+"""
+Очистка OCR-текста нейросетью (стадия 2 конвейера scripts/2_run_ocr_cleaning.py).
+
+Бэкенды:
+- server: HTTP-сервер llama.cpp (OpenAI-совместимый /v1/chat/completions).
+  Части книги отправляются параллельно, до OCR_LLM_PARALLEL запросов сразу -
+  сервер должен быть запущен с тем же числом слотов и continuous batching:
+      llama-server -m model.gguf -c 16384 --parallel 4 -cb
+- local: модель в процессе через llama-cpp-python (последовательно, как раньше).
+
+Текст делится на части по абзацам/предложениям, а не слепо по 2000 символов;
+max_tokens ограничен относительно длины части, чтобы модель не "разговорилась".
+"""
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import httpx
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+OCR_PROMPT = """Исправь ошибки OCR (распознавания текста). Склей разорванные слова. Исправь пунктуацию.
+НЕ удаляй информацию. Верни только исправленный текст.
+
+ТЕКСТ:
+{text}
+"""
+
+_PARAGRAPH_RE = re.compile(r"\n\s*\n|\f")
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+")
+
+
+def _hard_split(text: str, max_chars: int) -> List[str]:
+    """Последний вариант для сверхдлинных "предложений": режем по пробелу."""
+    parts = []
+    while len(text) > max_chars:
+        cut = text.rfind(" ", 0, max_chars)
+        if cut <= 0:
+            cut = max_chars
+        parts.append(text[:cut])
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+def split_into_chunks(text: str, max_chars: int) -> List[str]:
+    """
+    Делит текст на части не длиннее max_chars по границам абзацев (и страниц),
+    длинные абзацы - по границам предложений. Соседние короткие абзацы склеиваются.
+    """
+    pieces = []
+    for paragraph in _PARAGRAPH_RE.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in _SENTENCE_RE.split(paragraph):
+            pieces.extend(_hard_split(sentence, max_chars) if len(sentence) > max_chars else [sentence])
+
+    chunks, current, length = [], [], 0
+    for piece in pieces:
+        if current and length + len(piece) + 2 > max_chars:
+            chunks.append("\n\n".join(current))
+            current, length = [], 0
+        current.append(piece)
+        length += len(piece) + 2
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (для русского текста ~3 символа на токен)."""
+    return len(text) // 3 + 1
+
+
+class CleaningStats:
+    """Счетчики очистки: токены, время, скорость."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.chunks = 0
+        self.completion_tokens = 0
+        self.fallbacks = 0
+
+    def add(self, tokens: int, fallback: bool = False):
+        with self._lock:
+            self.chunks += 1
+            self.completion_tokens += tokens
+            self.fallbacks += int(fallback)
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.completion_tokens / self.elapsed if self.elapsed else 0.0
+
+    def eta(self, remaining_chunks: int) -> float:
+        """Оценка оставшегося времени (сек) по средней скорости обработки частей."""
+        if not self.chunks:
+            return 0.0
+        return remaining_chunks * self.elapsed / self.chunks
+
+
+class OCRCleaner:
+    def __init__(
+        self,
+        backend: str = "server",
+        base_url: Optional[str] = None,
+        parallel: Optional[int] = None,
+        max_tokens_ratio: Optional[float] = None,
+    ):
+        self.backend = backend
+        self.max_tokens_ratio = max_tokens_ratio or settings.OCR_MAX_TOKENS_RATIO
+        if backend == "server":
+            self.parallel = parallel or settings.OCR_LLM_PARALLEL
+            self.http = httpx.Client(
+                base_url=base_url or settings.OCR_LLM_URL,
+                timeout=httpx.Timeout(600.0, connect=10.0),
+                limits=httpx.Limits(max_connections=self.parallel, max_keepalive_connections=self.parallel),
+            )
+            self.llm = None
+        else:
+            self.parallel = 1
+            self.http = None
+            self.llm = self._load_local_model()
+
+    @staticmethod
+    def _load_local_model():
+        """Загрузка модели через llama-cpp-python"""
+        from llama_cpp import Llama
+
+        if not os.path.exists(settings.MODEL_PATH):
+            raise FileNotFoundError(f"Модель не найдена: {settings.MODEL_PATH} (положите {settings.MODEL_NAME} в models/)")
+        logger.info(f"💾 Загрузка модели из: {settings.MODEL_PATH}")
+        # n_gpu_layers=-1 задействует все слои на GPU, если драйвера настроены
+        return Llama(model_path=settings.MODEL_PATH, n_ctx=8192, n_gpu_layers=-1, verbose=False)
+
+    def _max_tokens(self, text: str) -> int:
+        return int(estimate_tokens(text) * self.max_tokens_ratio) + 64
+
+    def clean_chunk(self, text: str) -> Tuple[str, int, bool]:
+        """
+        Очищает одну часть. Returns: (текст, сгенерировано токенов, fallback).
+        При ошибке или обрезке по max_tokens возвращается исходный текст -
+        неисправленный фрагмент лучше потерянного.
+        """
+        messages = [{"role": "user", "content": OCR_PROMPT.format(text=text)}]
+        max_tokens = self._max_tokens(text)
+        try:
+            if self.http is not None:
+                response = self.http.post("/v1/chat/completions", json={
+                    "model": settings.LLM_MODEL_NAME,
+                    "messages": messages,
+                    "temperature": 0.1,
+                    "max_tokens": max_tokens,
+                })
+                response.raise_for_status()
+                data = response.json()
+            else:
+                data = self.llm.create_chat_completion(messages=messages, temperature=0.1, max_tokens=max_tokens)
+
+            choice = data["choices"][0]
+            tokens = (data.get("usage") or {}).get("completion_tokens") or estimate_tokens(choice["message"]["content"])
+            if choice.get("finish_reason") == "length":
+                logger.warning("⚠️ Ответ обрезан по max_tokens - оставляем исходный фрагмент")
+                return text, tokens, True
+            return choice["message"]["content"].strip(), tokens, False
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка LLM: {e}")
+            return text, 0, True
+
+    def clean_chunks(
+        self,
+        items: Iterable[Tuple[int, str]],
+        on_done: Callable[[int, str], None],
+        stats: Optional[CleaningStats] = None,
+    ) -> CleaningStats:
+        """
+        Очищает части (индекс, текст), держа в работе до parallel запросов.
+        on_done(индекс, текст) вызывается в основном потоке по мере готовности
+        (порядок восстанавливается по индексу на стороне вызывающего).
+        """
+        stats = stats or CleaningStats()
+        with ThreadPoolExecutor(max_workers=self.parallel, thread_name_prefix="ocr-llm") as pool:
+            pending = {}
+            it = iter(items)
+            while True:
+                for i, text in it:
+                    pending[pool.submit(self.clean_chunk, text)] = i
+                    if len(pending) >= self.parallel:
+                        break
+                if not pending:
+                    break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    i = pending.pop(future)
+                    cleaned, tokens, fallback = future.result()
+                    stats.add(tokens, fallback)
+                    on_done(i, cleaned)
+        return stats
+
+    def close(self):
+        if self.http is not None:
+            self.http.close()
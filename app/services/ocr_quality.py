@@ -0,0 +1,184 @@
+"""
+Быстрая оценка качества OCR-текста: нужна ли части книги очистка нейросетью.
+
+Большинство книг в коллекции - "цифровые" PDF, и текст pdftotext/PyMuPDF у них
+уже чистый; LLM для таких частей только тратит время. Сигналы "грязного" текста:
+- мусорные символы: не \w (буквы/цифры любого алфавита), не пробелы и не пунктуация -
+  правило clean_text из convert_pdf.py, плюс типографские знаки (кавычки, тире, ±, № и т.п.);
+- слова со смешанной латиницей и кириллицей (типичная ошибка распознавания);
+- низкая доля частотных русских слов (словарь);
+- раздробленные строки (много коротких строк);
+- переносы слов на конце строки.
+Каждый сигнал делится на свой порог, оценка - максимум: >= 1 - часть отправляется в LLM.
+Классы символов считаются векторно: numpy по кодовым точкам, каждая уникальная
+кодовая точка классифицируется один раз.
+"""
+import re
+from typing import Dict, Optional, Set
+
+import numpy as np
+
+from app.core.config import settings
+
+# Пороги сигналов (значение сигнала / порог >= 1 - текст "грязный")
+THRESHOLDS = {
+    "garbage": 0.02,      # доля мусорных символов
+    "mixed_script": 0.01, # доля слов со смешанными алфавитами
+    "dict_miss": 0.88,    # доля слов вне словаря частотных слов (при достаточном числе слов)
+    "short_lines": 0.45,  # доля коротких строк
+    "hyphens": 0.35,      # переносов на строку
+}
+
+# Минимум кириллических слов, чтобы доверять словарному сигналу
+MIN_WORDS_FOR_DICT = 40
+SHORT_LINE = 25
+
+# Частотные слова русского языка (служебные и общеупотребительные)
+COMMON_WORDS: Set[str] = set("""
+и в во не на с со что по как а к ко из у о об за от для это так но же его ее её их или при все всё всех
+всего был была были было быть может также только уже если то он она они оно мы вы я ты который которая
+которое которые которого которой котором которых этого этот эта это эти этой этом этих того тот та те тем
+том той чем где когда после до между под над без через более менее очень можно нужно есть нет один одна
+одно два две год года лет время раз другие других другой свой своей своих свои себя себе еще ещё даже ли
+бы ни там тут здесь каждый такой такие такого такая первый первая второй часть года также поэтому однако
+потому чтобы того всегда затем кроме около против среди вместе сам сама само сами этим ним ней нем них
+ими им ему ей её вот наш наша наши ваш был бывает будет будут являются является данный данные данных
+случае образом виде работы работа системы система развития развитие рис таблица глава
+""".split())
+
+_WORD_RE = re.compile(r"[A-Za-zА-Яа-яЁё]+")
+_CYR_RE = re.compile(r"[А-Яа-яЁё]")
+_LAT_RE = re.compile(r"[A-Za-z]")
+# Перенос слова на конце строки: только в пределах абзаца (без пустой строки) и только
+# между буквами - числовые диапазоны (1990-\n2000, стр. 15-\n20) не трогаются
+_HYPHEN_BREAK_RE = re.compile(r"(?<!\w)([^\W\d_]+)-\n[ \t]*([^\W\d_]+)(?!\w)")
+# Диапазон чисел, разорванный на конце строки: дефис остается, перевод строки убирается
+_NUMBER_RANGE_BREAK_RE = re.compile(r"(\d)-\n[ \t]*(\d)")
+
+# Части, с которыми дефис на конце строки - настоящий, а не перенос (Северо-запад, кто-либо).
+# Короткие частицы ("-то") - только после местоимений: "мес-\nто" - это перенос.
+HYPHEN_PREFIXES: Set[str] = set("""
+северо юго западно восточно кое кой
+""".split())
+HYPHEN_SUFFIXES: Set[str] = set("""
+либо нибудь
+""".split())
+HYPHEN_PRONOUNS: Set[str] = set("""
+кто что где когда как куда откуда почему зачем чей чья чьё чьи какой какая какое какие сколько
+""".split())
+HYPHEN_COMPOUNDS: Set[str] = {"из-за", "из-под"}
+# Первая часть сложного прилагательного (научно-, социально-, темно-) оканчивается на о/е;
+# более короткая или иначе оканчивающаяся часть - обрывок слова, перенос
+COMPOUND_HEAD_ENDINGS = ("о", "е")
+MIN_COMPOUND_HEAD = 4
+_VOWELS = frozenset("аеёиоуыэюяaeiouy")
+
+# "Хорошие" символы кроме \w и пробелов: пунктуация clean_text и типографика
+_GOOD_PUNCT = frozenset(".,!?;:()-" + "[]–—«»„“”‘’\"'/%№+=*<>…§°±×·&")
+
+_dictionary_words: Optional[Set[str]] = None
+
+
+def _dictionary() -> Set[str]:
+    """Встроенный словарь + (опционально) файл OCR_DICTIONARY_PATH, по слову на строку. Собирается один раз."""
+    global _dictionary_words
+    if _dictionary_words is None:
+        words = COMMON_WORDS
+        path = settings.OCR_DICTIONARY_PATH
+        if path:
+            with open(path, "r", encoding="utf-8") as f:
+                words = COMMON_WORDS | {line.strip().lower() for line in f if line.strip()}
+        _dictionary_words = words
+    return _dictionary_words
+
+
+def _is_good_char(code: int) -> bool:
+    c = chr(code)
+    return c.isalnum() or c == "_" or c.isspace() or c in _GOOD_PUNCT
+
+
+def _garbage_ratio(text: str) -> float:
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    if codes.size == 0:
+        return 0.0
+    # Уникальных кодовых точек немного (сотни) - классифицируем их, а не каждый символ
+    unique, inverse = np.unique(codes, return_inverse=True)
+    good = np.fromiter((_is_good_char(int(c)) for c in unique), dtype=bool, count=unique.size)
+    return float(1.0 - good[inverse].mean())
+
+
+def chunk_signals(text: str) -> Dict[str, float]:
+    """Сырые значения сигналов качества для части текста."""
+    words = _WORD_RE.findall(text)
+    mixed = sum(1 for w in words if _CYR_RE.search(w) and _LAT_RE.search(w))
+    cyr_words = [w.lower() for w in words if _CYR_RE.search(w)]
+
+    dictionary = _dictionary()
+    if len(cyr_words) >= MIN_WORDS_FOR_DICT:
+        dict_miss = 1.0 - sum(1 for w in cyr_words if w in dictionary) / len(cyr_words)
+    else:
+        dict_miss = 0.0
+
+    lines = [line for line in text.split("\n") if line.strip()]
+    short = sum(1 for line in lines if len(line.strip()) < SHORT_LINE)
+
+    return {
+        "garbage": _garbage_ratio(text),
+        "mixed_script": mixed / len(words) if words else 0.0,
+        "dict_miss": dict_miss,
+        "short_lines": short / len(lines) if lines else 0.0,
+        "hyphens": len(_HYPHEN_BREAK_RE.findall(text)) / len(lines) if lines else 0.0,
+    }
+
+
+def dirtiness(text: str) -> float:
+    """Оценка "грязности": максимум нормированных сигналов (>= 1 - нужна очистка LLM)."""
+    signals = chunk_signals(text)
+    return max(signals[name] / threshold for name, threshold in THRESHOLDS.items())
+
+
+def needs_cleaning(text: str) -> bool:
+    return dirtiness(text) >= 1.0
+
+
+def _is_fragment(head: str) -> bool:
+    """Часть до дефиса не может быть первой частью составного слова - это обрывок при переносе."""
+    return (
+        not any(c in _VOWELS for c in head)
+        or len(head) < MIN_COMPOUND_HEAD
+        or not head.endswith(COMPOUND_HEAD_ENDINGS)
+    )
+
+
+def _join_hyphen_break(match: "re.Match") -> str:
+    head, tail = match.group(1), match.group(2)
+    lhead, ltail = head.lower(), tail.lower()
+    # Настоящий дефис: имя собственное/аббревиатура после него или известное составное слово
+    if (
+        tail[0].isupper()
+        or lhead in HYPHEN_PREFIXES
+        or ltail in HYPHEN_SUFFIXES
+        or (ltail == "то" and lhead in HYPHEN_PRONOUNS)
+        or f"{lhead}-{ltail}" in HYPHEN_COMPOUNDS
+    ):
+        return f"{head}-{tail}"
+    # Склеиваем только слово из словаря или явный обрывок; при сомнении дефис остается
+    if lhead + ltail in _dictionary() or _is_fragment(lhead):
+        return head + tail
+    return f"{head}-{tail}"
+
+
+def light_clean(text: str) -> str:
+    """
+    Дешевая правка "чистых" частей без LLM: склеивает переносы слов и
+    строки внутри абзацев (как делала бы модель), убирает разрывы страниц.
+    Дефис в составных словах (Северо-запад, кто-то, научно-технический) и
+    числовых диапазонах сохраняется; при сомнении дефис не убирается.
+    """
+    text = text.replace("\f", "\n\n")
+    text = _HYPHEN_BREAK_RE.sub(_join_hyphen_break, text)
+    text = _NUMBER_RANGE_BREAK_RE.sub(r"\1-\2", text)
+    paragraphs = re.split(r"\n\s*\n", text)
+    return "\n\n".join(
+        re.sub(r"[ \t]*\n[ \t]*", " ", p).strip() for p in paragraphs if p.strip()
+    )
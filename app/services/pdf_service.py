@@ -0,0 +1,210 @@
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+from dataclasses import dataclass
+from typing import Dict, Optional, Union
+
+import httpx
+import requests
+
+from app.core.config import settings
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+logger = logging.getLogger(__name__)
+
+# Сколько страниц PDF разбираем для анализа (не больше; обычно раньше хватает PDF_ANALYSIS_CHARS)
+MAX_PAGES = 40
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+EXTRACT_FAILED_MESSAGE = "⚠️ Не удалось извлечь читаемый текст из PDF (проблема с кодировкой или защитой)."
+
+
+def is_garbage_text(text: str) -> bool:
+    """Проверяет, похож ли текст на мусор (мало кириллицы)."""
+    if not text or len(text) < 50: return True
+    cyrillic_count = len(re.findall(r'[а-яА-ЯёЁ]', text))
+    # Если кириллицы меньше 5%, считаем что кодировка битая (для русских книг)
+    if cyrillic_count / len(text) < 0.05:
+        return True
+    return False
+
+
+def extract_pdf_text(source: Union[str, bytes], url: str = "", max_chars: Optional[int] = None) -> str:
+    """
+    Извлекает текст из PDF (fitz -> pypdf). CPU-bound.
+    source - путь к файлу (PDF открывается без чтения в память целиком) или байты.
+    Страницы разбираются по одной и только пока не набрано max_chars символов
+    (но не больше MAX_PAGES страниц).
+    """
+    if not fitz and not pypdf:
+        raise ImportError("Библиотеки fitz и pypdf не установлены.")
+
+    if max_chars is None:
+        max_chars = settings.PDF_ANALYSIS_CHARS
+
+    def collect(page_texts) -> str:
+        pages, total = [], 0
+        for i, page_text in enumerate(page_texts):
+            if i >= MAX_PAGES or total >= max_chars:
+                break
+            pages.append(page_text)
+            total += len(page_text) + 1
+        return "\n".join(pages)
+
+    extracted_text = ""
+
+    # 1. Пробуем fitz (PyMuPDF)
+    if fitz:
+        try:
+            doc = fitz.open(source) if isinstance(source, str) else fitz.open(stream=source, filetype="pdf")
+            with doc:
+                extracted_text = collect(
+                    "\n".join(b[4] for b in page.get_text("blocks", sort=True))
+                    for page in doc
+                )
+        except Exception as e:
+            logger.error(f"Fitz extract error: {e}")
+
+    # 2. Если fitz не справился (мусор или пусто), пробуем pypdf
+    if is_garbage_text(extracted_text) and pypdf:
+        logger.info("Fitz returned garbage/empty. Trying pypdf...")
+        try:
+            reader = pypdf.PdfReader(source if isinstance(source, str) else io.BytesIO(source))
+            extracted_text = collect(page.extract_text() or "" for page in reader.pages)
+        except Exception as e:
+            logger.error(f"pypdf extract error: {e}")
+
+    # 3. Финальная проверка
+    if is_garbage_text(extracted_text):
+        logger.warning(f"Failed to extract readable text from {url}")
+        return EXTRACT_FAILED_MESSAGE
+
+    logger.info(f"PDF Text Preview (200 chars): {extracted_text[:200]}")
+    return extracted_text
+
+
+class PDFTooLargeError(Exception):
+    """PDF больше PDF_MAX_DOWNLOAD_MB - скачивание прервано."""
+
+
+@dataclass
+class PDFDownload:
+    """Результат скачивания PDF во временный файл (path=None, если сервер ответил 304)."""
+    status_code: int
+    path: Optional[str]
+    sha256: Optional[str] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    def cleanup(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _max_download_bytes() -> int:
+    return settings.PDF_MAX_DOWNLOAD_MB * 1024 * 1024
+
+
+def _check_declared_size(url: str, headers) -> None:
+    declared = headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > _max_download_bytes():
+        raise PDFTooLargeError(f"PDF слишком большой ({int(declared) // (1024 * 1024)} МБ): {url}")
+
+
+class _LimitedWriter:
+    """Пишет поток во временный файл, считая sha256 и обрывая загрузку сверх лимита."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.size = 0
+        self.hash = hashlib.sha256()
+        self.file = tempfile.NamedTemporaryFile(prefix="pdf_", suffix=".pdf", delete=False)
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > _max_download_bytes():
+            raise PDFTooLargeError(f"PDF больше {settings.PDF_MAX_DOWNLOAD_MB} МБ: {self.url}")
+        self.hash.update(chunk)
+        self.file.write(chunk)
+
+    def finish(self, status_code: int, headers) -> PDFDownload:
+        self.file.close()
+        return PDFDownload(
+            status_code=status_code,
+            path=self.file.name,
+            sha256=self.hash.hexdigest(),
+            etag=headers.get("etag"),
+            last_modified=headers.get("last-modified"),
+        )
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.file.name):
+            os.remove(self.file.name)
+
+
+def download_pdf_text(url: str) -> str:
+    """Скачивает PDF (потоково, во временный файл) и извлекает текст (fitz -> pypdf)."""
+    if not fitz and not pypdf:
+        raise ImportError("Библиотеки fitz и pypdf не установлены.")
+
+    download = None
+    try:
+        with requests.get(url, timeout=30, verify=False, stream=True) as response:
+            response.raise_for_status()
+            _check_declared_size(url, response.headers)
+            writer = _LimitedWriter(url)
+            try:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    writer.write(chunk)
+            except Exception:
+                writer.abort()
+                raise
+            download = writer.finish(response.status_code, response.headers)
+        return extract_pdf_text(download.path, url)
+    except Exception as e:
+        logger.error(f"Error downloading PDF {url}: {e}")
+        raise e
+    finally:
+        if download:
+            download.cleanup()
+
+
+async def fetch_pdf_async(url: str, headers: Optional[Dict[str, str]] = None) -> PDFDownload:
+    """
+    Асинхронно скачивает PDF через httpx.AsyncClient во временный файл (не блокирует
+    event loop и не держит файл в памяти). Размер ограничен PDF_MAX_DOWNLOAD_MB.
+    headers - заголовки условного GET; при 304 файла нет, вызывающий берет текст из кэша.
+    Временный файл удаляет вызывающий (PDFDownload.cleanup).
+    """
+    try:
+        async with httpx.AsyncClient(timeout=30.0, verify=False, follow_redirects=True) as client:
+            async with client.stream("GET", url, headers=headers or None) as response:
+                if response.status_code == 304:
+                    return PDFDownload(status_code=304, path=None)
+                response.raise_for_status()
+                _check_declared_size(url, response.headers)
+                writer = _LimitedWriter(url)
+                try:
+                    async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        writer.write(chunk)
+                except BaseException:
+                    writer.abort()
+                    raise
+                return writer.finish(response.status_code, response.headers)
+    except Exception as e:
+        logger.error(f"Error downloading PDF {url}: {e}")
+        raise e
@@ -0,0 +1,96 @@
+"""
+Дисковый кэш текста, извлеченного из PDF по ссылке.
+
+meta/<sha1(url)>.json - валидаторы HTTP (ETag, Last-Modified), время последней проверки
+и хэш содержимого PDF; text/<sha256(pdf)>.txt - сам текст (content-addressed:
+одинаковые PDF по разным ссылкам хранятся один раз).
+Пока запись свежая - сеть не трогаем; устаревшую перепроверяем условным GET (304 - текст из кэша).
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PDFTextCache:
+    def __init__(self, root: str, revalidate_after: float):
+        self.root = root
+        self.revalidate_after = revalidate_after
+
+    def _meta_path(self, url: str) -> str:
+        return os.path.join(self.root, "meta", hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+    def _text_path(self, digest: str) -> str:
+        return os.path.join(self.root, "text", digest[:2], digest + ".txt")
+
+    @staticmethod
+    def _write_atomic(path: str, data: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def lookup(self, url: str) -> Optional[Dict]:
+        """Запись кэша для url (meta + text) или None."""
+        try:
+            with open(self._meta_path(url), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(self._text_path(meta["digest"]), "r", encoding="utf-8") as f:
+                meta["text"] = f.read()
+            return meta
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def is_fresh(self, entry: Dict) -> bool:
+        return time.time() - entry.get("checked_at", 0) < self.revalidate_after
+
+    @staticmethod
+    def conditional_headers(entry: Optional[Dict]) -> Dict[str, str]:
+        """Заголовки условного GET для перепроверки записи."""
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(self, url: str, digest: str, text: str, etag: Optional[str], last_modified: Optional[str]):
+        """digest - sha256 содержимого PDF (считается при скачивании)."""
+        try:
+            text_path = self._text_path(digest)
+            if not os.path.exists(text_path):
+                self._write_atomic(text_path, text)
+            meta = {
+                "url": url,
+                "digest": digest,
+                "etag": etag,
+                "last_modified": last_modified,
+                "checked_at": time.time(),
+            }
+            self._write_atomic(self._meta_path(url), json.dumps(meta, ensure_ascii=False))
+            logger.info(f"💾 Текст PDF сохранен в кэш: {url}")
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить текст PDF в кэш ({url}): {e}")
+
+    def touch(self, url: str, entry: Dict):
+        """Отмечает запись как перепроверенную (сервер ответил 304)."""
+        meta = {k: v for k, v in entry.items() if k != "text"}
+        meta["checked_at"] = time.time()
+        try:
+            self._write_atomic(self._meta_path(url), json.dumps(meta, ensure_ascii=False))
+        except OSError as e:
+            logger.warning(f"Не удалось обновить кэш PDF ({url}): {e}")
+
+
+pdf_text_cache = PDFTextCache(
+    root=settings.PDF_TEXT_CACHE_DIR,
+    revalidate_after=settings.PDF_TEXT_CACHE_REVALIDATE,
+)
@@ -1,11 +1,20 @@
+import hashlib
 import logging
 import os
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple
+
 import chromadb
 from sentence_transformers import SentenceTransformer
 from app.core.config import settings
+from app.services.embedding_cache import query_embedding_cache
 
 logger = logging.getLogger(__name__)
 
+# Константа сглаживания Reciprocal Rank Fusion (стандартное значение из литературы)
+RRF_K = 60
+
 class RAGSystem:
     def __init__(self):
         logger.info("Инициализация RAGSystem...")
@@ -26,8 +35,19 @@ class RAGSystem:
         # 2. Подключение к БД
         self.client = chromadb.PersistentClient(path=settings.CHROMA_PATH)
         self.collection = self.client.get_or_create_collection(name="library_collection")
+        # Счетчик записей в коллекцию из этого процесса (для инвалидации кэша ответов)
+        self._revision = 0
         logger.info(f"✅ RAG подключен: {settings.CHROMA_PATH}")
 
+    def collection_version(self) -> tuple:
+        """
+        Версия содержимого коллекции: меняется при записи из этого процесса,
+        а также при импорте отдельным скриптом (число записей, mtime файла Chroma).
+        """
+        sqlite_path = os.path.join(settings.CHROMA_PATH, "chroma.sqlite3")
+        mtime = os.path.getmtime(sqlite_path) if os.path.exists(sqlite_path) else 0
+        return (self._revision, self.collection.count(), mtime)
+
     def add_document(self, text: str, source: str, title: str = "Unknown"):
         """Добавляет документ. Важно: добавляем префикс passage: для E5"""
         # E5 ожидает "passage: " для документов
@@ -37,9 +57,9 @@ class RAGSystem:
         embedding = self.model.encode(content_to_embed, normalize_embeddings=True).tolist()
         
         # Генерируем ID
-        import hashlib
         doc_id = hashlib.md5((title + source + text[:50]).encode()).hexdigest()
         
+        self._revision += 1
         self.collection.upsert(
             ids=[doc_id],
             documents=[text], # Сохраняем оригинальный текст (без passage:) для чтения
@@ -47,24 +67,9 @@ class RAGSystem:
             embeddings=[embedding]
         )
     
-    def add_book(self, book_data: dict):
-        """
-        Добавляет книгу с полными метаданными в ChromaDB.
-        
-        Args:
-            book_data: Словарь с полями:
-                - title: название книги
-                - author: автор
-                - subject: рубрика/тема
-                - grnti: код ГРНТИ
-                - bbk: код ББК
-                - author_sign: авторский знак
-                - systematic_code: систематический шифр
-                - owners: держатель (библиотека)
-                - pdf_url: ссылка на PDF
-                - pdf_ocr: распознанный текст (опционально)
-        """
-        # Формируем текстовое представление книги для поиска
+    @staticmethod
+    def _book_to_text(book_data: dict) -> str:
+        """Формирует текстовое представление книги для поиска."""
         text_parts = [
             f"Книга: {book_data.get('title', '')}",
             f"Автор: {book_data.get('author', '')}",
@@ -92,65 +97,218 @@ class RAGSystem:
         if book_data.get('pdf_ocr'):
             text_parts.append(f"\nРаспознанный текст:\n{book_data.get('pdf_ocr', '')}")
         
-        text = "\n".join(text_parts)
+        return "\n".join(text_parts)
+
+    @staticmethod
+    def _book_metadata(book_data: dict) -> dict:
+        return {
+            "title": book_data.get("title", ""),
+            "author": book_data.get("author", ""),
+            "subject": book_data.get("subject", ""),
+            "grnti": book_data.get("grnti", ""),
+            "bbk": book_data.get("bbk", ""),
+            "author_sign": book_data.get("author_sign", ""),
+            "systematic_code": book_data.get("systematic_code", ""),
+            "owners": book_data.get("owners", ""),
+            "pdf_url": book_data.get("pdf_url", ""),
+        }
+
+    @staticmethod
+    def _book_id(book_data: dict) -> str:
+        return hashlib.md5((book_data.get('title', '') + book_data.get('author', '')).encode()).hexdigest()
+
+    def add_book(self, book_data: dict):
+        """
+        Добавляет книгу с полными метаданными в ChromaDB.
+        
+        Args:
+            book_data: Словарь с полями:
+                - title: название книги
+                - author: автор
+                - subject: рубрика/тема
+                - grnti: код ГРНТИ
+                - bbk: код ББК
+                - author_sign: авторский знак
+                - systematic_code: систематический шифр
+                - owners: держатель (библиотека)
+                - pdf_url: ссылка на PDF
+                - pdf_ocr: распознанный текст (опционально)
+        """
+        text = self._book_to_text(book_data)
         
         # Генерируем эмбеддинг
         content_to_embed = f"passage: {text}"
         embedding = self.model.encode(content_to_embed, normalize_embeddings=True).tolist()
         
-        # Генерируем ID
-        import hashlib
-        doc_id = hashlib.md5((book_data.get('title', '') + book_data.get('author', '')).encode()).hexdigest()
-        
         # Сохраняем в ChromaDB
+        self._revision += 1
         self.collection.upsert(
-            ids=[doc_id],
+            ids=[self._book_id(book_data)],
             documents=[text],
-            metadatas=[{
-                "title": book_data.get("title", ""),
-                "author": book_data.get("author", ""),
-                "subject": book_data.get("subject", ""),
-                "grnti": book_data.get("grnti", ""),
-                "bbk": book_data.get("bbk", ""),
-                "author_sign": book_data.get("author_sign", ""),
-                "systematic_code": book_data.get("systematic_code", ""),
-                "owners": book_data.get("owners", ""),
-                "pdf_url": book_data.get("pdf_url", ""),
-            }],
+            metadatas=[self._book_metadata(book_data)],
             embeddings=[embedding]
         )
         
         logger.info(f"✅ Добавлена книга: {book_data.get('title', 'Unknown')[:50]}...")
 
-    def search(self, query: str, top_k: int = 5) -> str:
-        """Поиск. Важно: добавляем префикс query: для E5"""
+    def add_books_batch(
+        self,
+        books: Iterable[dict],
+        batch_size: Optional[int] = None,
+        upsert_batch_size: Optional[int] = None,
+    ) -> int:
+        """
+        Пакетная загрузка книг в ChromaDB.
+        
+        Книги векторизуются пачками через SentenceTransformer.encode(batch_size=...)
+        и записываются в коллекцию крупными upsert-ами, без накладных расходов
+        на каждый вызов. Принимает любой iterable (в т.ч. генератор из курсора БД).
+        
+        Returns:
+            Количество загруженных книг.
+        """
+        records = (
+            (self._book_id(book), self._book_to_text(book), self._book_metadata(book))
+            for book in books
+        )
+        return self._upsert_batched(records, batch_size, upsert_batch_size)
+
+    def add_documents_batch(
+        self,
+        documents: Iterable[dict],
+        batch_size: Optional[int] = None,
+        upsert_batch_size: Optional[int] = None,
+    ) -> int:
+        """
+        Пакетный аналог add_document.
+        
+        Args:
+            documents: iterable словарей с ключами text, source, title.
+        
+        Returns:
+            Количество загруженных документов.
+        """
+        records = (
+            (
+                hashlib.md5((doc.get('title', 'Unknown') + doc['source'] + doc['text'][:50]).encode()).hexdigest(),
+                doc['text'],
+                {"source": doc['source'], "title": doc.get('title', 'Unknown')},
+            )
+            for doc in documents
+        )
+        return self._upsert_batched(records, batch_size, upsert_batch_size)
+
+    def _upsert_batched(
+        self,
+        records: Iterable[Tuple[str, str, dict]],
+        batch_size: Optional[int],
+        upsert_batch_size: Optional[int],
+    ) -> int:
+        """Векторизует (id, text, metadata) пачками и делает bulk upsert в Chroma."""
+        batch_size = batch_size or settings.RAG_ENCODE_BATCH_SIZE
+        upsert_batch_size = upsert_batch_size or settings.RAG_UPSERT_BATCH_SIZE
+        # Chroma ограничивает размер одного upsert
+        try:
+            upsert_batch_size = min(upsert_batch_size, self.client.get_max_batch_size())
+        except Exception:
+            pass
+
+        total = 0
+        ids, texts, metadatas = [], [], []
+
+        def flush():
+            nonlocal total
+            if not ids:
+                return
+            # Дубликаты id внутри одного upsert Chroma не принимает - оставляем последний
+            unique = {doc_id: i for i, doc_id in enumerate(ids)}
+            idx = sorted(unique.values())
+            embeddings = self.model.encode(
+                [f"passage: {texts[i]}" for i in idx],
+                batch_size=batch_size,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            ).tolist()
+            self._revision += 1
+            self.collection.upsert(
+                ids=[ids[i] for i in idx],
+                documents=[texts[i] for i in idx],
+                metadatas=[metadatas[i] for i in idx],
+                embeddings=embeddings
+            )
+            total += len(ids)
+            logger.info(f"✅ RAG: загружено {total} записей")
+            ids.clear()
+            texts.clear()
+            metadatas.clear()
+
+        for doc_id, text, meta in records:
+            ids.append(doc_id)
+            texts.append(text)
+            metadatas.append(meta)
+            if len(ids) >= upsert_batch_size:
+                flush()
+        flush()
+        return total
+
+    def _encode_queries(self, queries: List[str]) -> List[List[float]]:
+        """
+        Векторизует запросы (уже с префиксом "query: ") через общий LRU-кэш.
+        Промахи кэша кодируются одной пачкой.
+        """
+        vectors = [query_embedding_cache.get(q) for q in queries]
+        missing = [i for i, vec in enumerate(vectors) if vec is None]
+        if missing:
+            # Векторизуем с нормализацией!
+            encoded = self.model.encode(
+                [queries[i] for i in missing],
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            ).tolist()
+            for i, vec in zip(missing, encoded):
+                vectors[i] = vec
+                query_embedding_cache.put(queries[i], vec)
+        return vectors
+
+    @staticmethod
+    def _format_context(items: List[Tuple[str, dict, str]]) -> str:
+        """Формирует контекст для LLM из найденных (id, metadata, document)."""
+        context = ""
+        for _, meta, doc in items:
+            context += f"\n[Источник: {meta.get('title', 'Книга')}]\n{doc}\n"
+        
+        if not context:
+            return "В базе знаний нет релевантной информации."
+            
+        return context
+
+    def _search_items(self, query: str, top_k: int) -> List[Tuple[str, dict, str]]:
         # E5 ожидает "query: " для поисковых запросов
         query_to_embed = f"query: {query}"
         
-        # Векторизуем с нормализацией!
-        query_vec = self.model.encode(query_to_embed, normalize_embeddings=True).tolist()
+        query_vec = self._encode_queries([query_to_embed])[0]
         
         results = self.collection.query(
             query_embeddings=[query_vec],
             n_results=top_k
         )
         
-        context = ""
+        items = []
         if results and results['documents']:
             for i, doc in enumerate(results['documents'][0]):
-                meta = results['metadatas'][0][i]
-                context += f"\n[Источник: {meta.get('title', 'Книга')}]\n{doc}\n"
-                
-        if not context:
-            return "В базе знаний нет релевантной информации."
-            
-        return context
+                items.append((results['ids'][0][i], results['metadatas'][0][i], doc))
+        return items
+
+    def search(self, query: str, top_k: int = 5) -> str:
+        """Поиск. Важно: добавляем префикс query: для E5"""
+        return self._format_context(self._search_items(query, top_k))
+
+    def search_with_ids(self, query: str, top_k: int = 5) -> Tuple[str, List[str]]:
+        """Как search, но дополнительно возвращает id найденных документов."""
+        items = self._search_items(query, top_k)
+        return self._format_context(items), [item[0] for item in items]
         
-    def search_flexible(self, query: str, top_k: int = 5) -> str:
-        """
-        Гибкий поиск с несколькими стратегиями.
-        Полезно для коротких запросов типа "Гагарин Ю.А."
-        """
+    def _search_flexible_items(self, query: str, top_k: int) -> List[Tuple[str, dict, str]]:
         # Стратегия 1: Прямой поиск
         query_variants = [f"query: {query}"]
         
@@ -164,39 +322,91 @@ class RAGSystem:
             if cleaned != query:
                 query_variants.append(f"query: {cleaned}")
         
-        # Ищем по всем вариантам и собираем уникальные результаты
+        # Все варианты векторизуем одной пачкой и ищем одним запросом к Chroma
+        query_vecs = self._encode_queries(query_variants)
+        results = self.collection.query(
+            query_embeddings=query_vecs,
+            n_results=top_k
+        )
+        
+        # Объединяем выдачи вариантов через Reciprocal Rank Fusion:
+        # документ, найденный высоко сразу несколькими вариантами, поднимается выше.
+        # Сырые расстояния разных вариантов между собой не сравнимы.
         all_results = {}
         
-        for variant in query_variants:
-            query_vec = self.model.encode(variant, normalize_embeddings=True).tolist()
-            
-            results = self.collection.query(
-                query_embeddings=[query_vec],
-                n_results=top_k
-            )
-            
-            if results and results['documents']:
-                for i, doc in enumerate(results['documents'][0]):
-                    doc_id = results['ids'][0][i] if 'ids' in results else str(i)
-                    if doc_id not in all_results:  # Избегаем дубликатов
-                        meta = results['metadatas'][0][i]
-                        score = results['distances'][0][i] if 'distances' in results else 0
-                        all_results[doc_id] = {
+        if results and results['documents']:
+            for v, docs in enumerate(results['documents']):
+                for rank, doc in enumerate(docs):
+                    doc_id = results['ids'][v][rank]
+                    distance = results['distances'][v][rank] if results.get('distances') else 0
+                    item = all_results.get(doc_id)
+                    if item is None:
+                        item = all_results[doc_id] = {
+                            'id': doc_id,
                             'doc': doc,
-                            'meta': meta,
-                            'score': score
+                            'meta': results['metadatas'][v][rank],
+                            'rrf': 0.0,
+                            'distance': distance
                         }
+                    item['rrf'] += 1.0 / (RRF_K + rank + 1)
+                    item['distance'] = min(item['distance'], distance)
         
-        if not all_results:
-            return "В базе знаний нет релевантной информации."
-        
-        # Сортируем по релевантности и формируем контекст
-        sorted_results = sorted(all_results.values(), key=lambda x: x['score'])[:top_k]
-        
-        context = ""
-        for item in sorted_results:
-            meta = item['meta']
-            doc = item['doc']
-            context += f"\n[Источник: {meta.get('title', 'Книга')}]\n{doc}\n"
-        
-        return context
\ No newline at end of file
+        # Сортируем по RRF (при равенстве - по лучшему расстоянию)
+        sorted_results = sorted(all_results.values(), key=lambda x: (-x['rrf'], x['distance']))[:top_k]
+        return [(item['id'], item['meta'], item['doc']) for item in sorted_results]
+
+    def search_flexible(self, query: str, top_k: int = 5) -> str:
+        """
+        Гибкий поиск с несколькими стратегиями.
+        Полезно для коротких запросов типа "Гагарин Ю.А."
+        """
+        return self._format_context(self._search_flexible_items(query, top_k))
+
+    def search_flexible_with_ids(self, query: str, top_k: int = 5) -> Tuple[str, List[str]]:
+        """Как search_flexible, но дополнительно возвращает id найденных документов."""
+        items = self._search_flexible_items(query, top_k)
+        return self._format_context(items), [item[0] for item in items]
+
+    def query_embedding(self, query: str) -> List[float]:
+        """Эмбеддинг запроса (после поиска берется из кэша эмбеддингов)."""
+        return self._encode_queries([f"query: {query}"])[0]
+
+
+# ==============================================================================
+# ОБЩИЙ ЭКЗЕМПЛЯР НА ПРОЦЕСС
+# ==============================================================================
+# FastAPI и Telegram-бот работают в одном процессе: модель (~2 ГБ) и
+# PersistentClient на chromadb_store должны существовать в единственном экземпляре.
+
+_rag_system: Optional[RAGSystem] = None
+_rag_lock = threading.Lock()
+
+
+def _rss_mb() -> Optional[float]:
+    """Пиковый RSS процесса в МБ (где доступен модуль resource)."""
+    try:
+        import resource
+        import sys
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # На macOS ru_maxrss в байтах, на Linux - в килобайтах
+        return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+    except (ImportError, AttributeError):
+        return None
+
+
+def get_rag_system() -> RAGSystem:
+    """Возвращает общий RAGSystem, загружая модель при первом обращении."""
+    global _rag_system
+    if _rag_system is None:
+        with _rag_lock:
+            if _rag_system is None:
+                rss_before = _rss_mb()
+                started = time.perf_counter()
+                _rag_system = RAGSystem()
+                elapsed = time.perf_counter() - started
+                rss_after = _rss_mb()
+                if rss_before is not None and rss_after is not None:
+                    logger.info(f"⏱ RAGSystem загружен за {elapsed:.1f} с, RSS {rss_before:.0f} -> {rss_after:.0f} МБ")
+                else:
+                    logger.info(f"⏱ RAGSystem загружен за {elapsed:.1f} с")
+    return _rag_system
@@ -0,0 +1,235 @@
+"""
+Разбор каталогов в формате Rusmark (ИРБИС) и потоковый ввод/вывод записей.
+
+Записи читаются из файла построчно и отдаются генератором по одной,
+результат пишется в NDJSON (одна JSON-запись на строку) - память не зависит
+от размера выгрузки.
+"""
+import json
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, TextIO
+
+RECORD_SEPARATOR = "*****"
+
+FIELDS = {
+    '200': 'title',
+    '700': 'author',
+    '606': 'subject',
+    '964': 'grnti',
+    '621': 'bbk',
+    '902': 'owners',
+    '908': 'author_sign',
+    '906': 'systematic_code',
+    '955': 'pdf_url'
+}
+
+# Предкомпилированные шаблоны
+_LINE_RE = re.compile(r"#(\d+):\s*(.*)")
+# Подполе: ^<код><значение до следующего ^>. Один проход по строке дает все подполя.
+_SUBFIELD_RE = re.compile(r'\^([^^])([^^]*)')
+_SPLIT_RE = re.compile(r'\^.')
+
+def tokenize_subfields(value):
+    """Разбивает значение поля на список (код, значение) за один проход."""
+    return _SUBFIELD_RE.findall(value)
+
+def _subfield_dict(tokens, non_empty=False, any_case=False):
+    """Словарь подполей (при повторе кода побеждает последнее, как dict(re.findall(...)))."""
+    result = {}
+    for code, val in tokens:
+        if non_empty and not val:
+            continue
+        if 'A' <= code <= 'Z' or (any_case and 'a' <= code <= 'z'):
+            result[code] = val
+    return result
+
+def _first_subfield(tokens, code):
+    for c, val in tokens:
+        if c == code and val:
+            return val
+    return None
+
+def clean_subfields(tag, value, tokens=None):
+    if tag == '700':
+        if tokens is None: tokens = tokenize_subfields(value)
+        subfields = _subfield_dict(tokens, non_empty=True)
+        last_name = subfields.get('A', '').strip()
+        initials = subfields.get('B', '').strip()
+        full_name = subfields.get('G', '').strip()
+        desc = subfields.get('C', '').strip()
+        result = last_name
+        if initials: result += f" {initials}"
+        if full_name: result += f" ({full_name})"
+        if desc: result += f", {desc}"
+        return result.strip(', ')
+    elif tag == '955' or tag == '902':
+        if tokens is None: tokens = tokenize_subfields(value)
+        val = _first_subfield(tokens, 'A')
+        return val.strip() if val else ''
+    else:
+        parts = _SPLIT_RE.split(value)
+        return ' '.join(part.strip() for part in parts if part).strip()
+
+# Поля, подполя которых нужны для формирования заголовка
+_TITLE_TAGS = ('200', '210', '601', '461')
+
+def parse_marc_record(block):
+    record = {}
+    fields210 = {}
+    title_fields = {}
+
+    for line in block.strip().split("\n"):
+        if not line.strip():
+            continue
+        match = _LINE_RE.match(line)
+        if not match:
+            continue
+        tag, value = match.groups()
+
+        tokens = None
+        if tag in _TITLE_TAGS or tag in ('700', '955', '902'):
+            tokens = tokenize_subfields(value)
+
+        if tag == '210':
+            fields210 = _subfield_dict(tokens, non_empty=True)
+
+        if tag in FIELDS:
+            value_clean = clean_subfields(tag, value, tokens)
+            key = FIELDS[tag]
+            if key in record:
+                record[key] += "; " + value_clean
+            else:
+                record[key] = value_clean
+
+        if tag in _TITLE_TAGS:
+            title_fields.setdefault(tag, []).append(tokens)
+
+    # Логика формирования заголовка
+    title_str = None
+
+    for tokens in title_fields.get('200', ()):
+        subfields = _subfield_dict(tokens)
+        title = subfields.get('A', '').strip()
+        note = subfields.get('E', '').strip()
+        author = subfields.get('F', '').strip()
+        if title:
+            title_str = title
+            if note: title_str += f" : {note}"
+            if author: title_str += f" / {author}"
+            city = fields210.get('A', '').strip()
+            publ = fields210.get('C', '').strip()
+            year = fields210.get('D', '').strip()
+            pub_parts = []
+            if city: pub_parts.append(city)
+            if publ: pub_parts.append(publ)
+            pub_info = ' : '.join(pub_parts)
+            if year: pub_info += f", {year}"
+            if pub_info: title_str += f". - {pub_info}."
+            break
+
+    if not title_str or not title_str.strip():
+        for tokens in title_fields.get('601', ()):
+            subfields = _subfield_dict(tokens)
+            parts = []
+            for code in ['P', 'E', 'D', 'S']:
+                if val_part := subfields.get(code, '').strip(): parts.append(val_part)
+            title_str = ', '.join(parts)
+            if title_str.strip(): break
+
+    if not title_str or not title_str.strip():
+        for tokens in title_fields.get('461', ()):
+            subfields = _subfield_dict(tokens, any_case=True)
+            parts = []
+            for key in ['c', 'e', 'd', 'f', 'g']:
+                val_part = subfields.get(key, '').strip() or subfields.get(key.upper(), '').strip()
+                if val_part: parts.append(val_part)
+            title_str = ', '.join(parts)
+            if title_str.strip(): break
+
+    if title_str: record['title'] = title_str
+    return record
+
+# ==============================================================================
+# ПОТОКОВОЕ ЧТЕНИЕ / ЗАПИСЬ
+# ==============================================================================
+
+def iter_rusmark_blocks(f: TextIO) -> Iterator[str]:
+    """Отдает текстовые блоки записей (между разделителями *****), читая файл построчно."""
+    lines = []
+    for line in f:
+        while RECORD_SEPARATOR in line:
+            head, line = line.split(RECORD_SEPARATOR, 1)
+            lines.append(head)
+            block = "".join(lines)
+            lines = []
+            if block.strip():
+                yield block
+        lines.append(line)
+    block = "".join(lines)
+    if block.strip():
+        yield block
+
+def iter_rusmark_records(f: TextIO) -> Iterator[Dict]:
+    """Генератор разобранных записей Rusmark из открытого файла."""
+    for block in iter_rusmark_blocks(f):
+        record = parse_marc_record(block)
+        if record:
+            yield record
+
+def _parse_blocks(blocks: List[str]) -> List[Dict]:
+    """Разбор пачки блоков в процессе-воркере."""
+    return [record for record in map(parse_marc_record, blocks) if record]
+
+def iter_rusmark_records_parallel(f: TextIO, workers: int, chunk_size: int = 2000) -> Iterator[Dict]:
+    """
+    Параллельный вариант iter_rusmark_records: пачки блоков разбираются в пуле процессов,
+    записи отдаются в исходном порядке. В полете держится не больше 2*workers пачек,
+    поэтому память остается ограниченной и на многогигабайтных выгрузках.
+    """
+    if workers <= 1:
+        yield from iter_rusmark_records(f)
+        return
+
+    blocks = iter_rusmark_blocks(f)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        while True:
+            while len(pending) < workers * 2:
+                chunk = list(islice(blocks, chunk_size))
+                if not chunk:
+                    break
+                pending.append(pool.submit(_parse_blocks, chunk))
+            if not pending:
+                break
+            yield from pending.popleft().result()
+
+def write_ndjson(records: Iterable[Dict], f: TextIO) -> int:
+    """Пишет записи в NDJSON (по одной на строку). Возвращает количество записей."""
+    count = 0
+    for record in records:
+        f.write(json.dumps(record, ensure_ascii=False))
+        f.write("\n")
+        count += 1
+    return count
+
+def iter_ndjson(path: str) -> Iterator[Dict]:
+    """Построчно читает NDJSON-файл."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+class NDJSONReader:
+    """
+    Переиспользуемый источник записей из NDJSON-файла: каждый проход
+    заново открывает файл, поэтому один и тот же каталог можно стримить
+    и в Postgres, и в RAG, не держа его в памяти.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def __iter__(self) -> Iterator[Dict]:
+        return iter_ndjson(self.path)
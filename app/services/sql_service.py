@@ -1,98 +1,368 @@
 import psycopg2
+import psycopg2.pool
+from psycopg2 import sql
 import logging
-from typing import List, Dict, Any
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional
 from app.core.config import settings
+from app.services.catalog_schema import (
+    TRGM_FIELDS, TS_CONFIG, SERVICE_TABLES, SUMMARY_TABLE, SUMMARY_SOURCE_KEY_EXPR, JOBS_TABLE,
+    create_summary_table, create_jobs_table,
+)
 
 logger = logging.getLogger(__name__)
 
 class SQLService:
-    def _get_connection(self):
-        return psycopg2.connect(
-            dbname=settings.DB_NAME,
-            user=settings.DB_USER,
-            password=settings.DB_PASS,
-            host=settings.DB_HOST
-        )
+    """
+    Доступ к PostgreSQL через ограниченный пул соединений.
+    Пул общий для потока Telegram-бота и event loop FastAPI, поэтому
+    используется ThreadedConnectionPool + семафор на максимальный размер.
+    """
+    def __init__(self):
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(settings.DB_POOL_MAX_SIZE)
+        self._stats_lock = threading.Lock()
+        self._stats = {"checkouts": 0, "in_use": 0, "stale_replaced": 0, "wait_timeouts": 0}
+        self._summary_table_ready = False
+        self._jobs_table_ready = False
+
+    def _get_pool(self):
+        # Пул создаем лениво, чтобы импорт сервиса не падал, если БД недоступна
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(
+                        settings.DB_POOL_MIN_SIZE,
+                        settings.DB_POOL_MAX_SIZE,
+                        dbname=settings.DB_NAME,
+                        user=settings.DB_USER,
+                        password=settings.DB_PASS,
+                        host=settings.DB_HOST
+                    )
+                    logger.info(f"🐘 Пул PostgreSQL создан ({settings.DB_POOL_MIN_SIZE}..{settings.DB_POOL_MAX_SIZE})")
+        return self._pool
+
+    @staticmethod
+    def _is_alive(conn) -> bool:
+        """Проверка "протухшего" соединения (разрыв по таймауту, рестарт сервера)."""
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @contextmanager
+    def _connection(self):
+        """Выдает соединение из пула и гарантированно возвращает его обратно."""
+        if not self._slots.acquire(timeout=settings.DB_POOL_TIMEOUT):
+            with self._stats_lock:
+                self._stats["wait_timeouts"] += 1
+            raise psycopg2.pool.PoolError("Нет свободных соединений в пуле PostgreSQL")
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            if not self._is_alive(conn):
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+                with self._stats_lock:
+                    self._stats["stale_replaced"] += 1
+            with self._stats_lock:
+                self._stats["checkouts"] += 1
+                self._stats["in_use"] += 1
+            broken = False
+            try:
+                yield conn
+                conn.commit()
+            except psycopg2.Error:
+                broken = True
+                raise
+            finally:
+                if not broken and not conn.closed:
+                    conn.rollback()
+                pool.putconn(conn, close=broken or bool(conn.closed))
+                with self._stats_lock:
+                    self._stats["in_use"] -= 1
+        finally:
+            self._slots.release()
+
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """Статистика пула соединений."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["min_size"] = settings.DB_POOL_MIN_SIZE
+        stats["max_size"] = settings.DB_POOL_MAX_SIZE
+        pool = self._pool
+        stats["idle"] = len(pool._pool) if pool is not None else 0
+        stats["opened"] = (len(pool._pool) + len(pool._used)) if pool is not None else 0
+        return stats
+
+    def close(self):
+        """Закрывает все соединения пула (при остановке приложения)."""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
 
     def get_available_tables(self) -> List[str]:
         """Получает список всех таблиц с книгами в БД"""
         try:
-            conn = self._get_connection()
-            cur = conn.cursor()
-            # Запрос к системному каталогу Postgres для получения списка таблиц
-            cur.execute("""
-                SELECT table_name 
-                FROM information_schema.tables 
-                WHERE table_schema = 'public'
-            """)
-            rows = cur.fetchall()
-            cur.close()
-            conn.close()
-            # Фильтруем только наши таблицы (можно добавить логику, если есть лишние)
-            return [row[0] for row in rows]
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    # Запрос к системному каталогу Postgres для получения списка таблиц
+                    cur.execute("""
+                        SELECT table_name 
+                        FROM information_schema.tables 
+                        WHERE table_schema = 'public'
+                    """)
+                    rows = cur.fetchall()
+            # Фильтруем только наши таблицы (служебные - не каталоги)
+            return [row[0] for row in rows if row[0] not in SERVICE_TABLES]
         except Exception as e:
             logger.error(f"Ошибка при получении списка таблиц: {e}")
             return ["unit"] # Возвращаем дефолтную, если база недоступна
 
-    def search_books(self, field: str, value: str, table: str = "unit") -> List[Dict[str, Any]]:
+    def search_books(self, field: str, value: str, table: str = "unit", ranked: bool = False) -> List[Dict[str, Any]]:
         """
         Поиск книг в PostgreSQL.
-        field: author, title, subject, bbk, grnti, systematic_code
+        field: author, title, subject, bbk, grnti, systematic_code, all (полнотекстовый)
+        ranked: сортировать по релевантности (word_similarity по pg_trgm / ts_rank по search_tsv).
+                Если индексов нет (таблица создана до их появления), откатывается на обычный ILIKE.
         """
         # Маппинг полей для защиты от SQL-инъекций
         field_map = {
             "author": "author", "title": "title", "subject": "subject",
             "bbk": "bbk", "grnti": "grnti", "code": "systematic_code",
-            "year": "year" # Если есть
+            "year": "year", # Если есть
+            "all": "search_tsv"
         }
         db_field = field_map.get(field)
         
         if not db_field:
             return []
 
-        try:
-            conn = self._get_connection()
-            cur = conn.cursor()
-            
-            # Используем безопасную подстановку имени таблицы (через форматирование, т.к. имя валидировано)
-            # И безопасную подстановку значения (через параметры)
-            query = f"""
-                SELECT id, title, author, systematic_code, bbk, grnti, subject, owners, pdf_url, pdf_ocr, author_sign 
-                FROM {table} 
-                WHERE {db_field} ILIKE %s 
+        uses_indexes = db_field == "search_tsv" or (ranked and db_field in TRGM_FIELDS)
+        columns = "id, title, author, systematic_code, bbk, grnti, subject, owners, pdf_url, pdf_ocr, author_sign"
+
+        # table приходит от клиента - подставляется только как идентификатор (sql.Identifier),
+        # значение - через параметры
+        if db_field == "search_tsv":
+            query = sql.SQL("""
+                SELECT {columns}
+                FROM {table}, websearch_to_tsquery({ts_config}, %s) AS q
+                WHERE search_tsv @@ q
+                ORDER BY ts_rank(search_tsv, q) DESC
                 LIMIT 10
-            """
-            cur.execute(query, (f"%{value}%",))
-            rows = cur.fetchall()
-            
-            results = []
-            for row in rows:
-                results.append({
-                    "id": row[0], "title": row[1], "author": row[2], "systematic_code": row[3],
-                    "bbk": row[4], "grnti": row[5], "subject": row[6],
-                    "owners": row[7], "pdf_url": row[8], "has_text": bool(row[9]), # Флаг, есть ли текст
-                    "author_sign": row[10] if len(row) > 10 else None
-                })
-            
-            cur.close()
-            conn.close()
-            return results
+            """)
+            params = (value,)
+        elif ranked and db_field in TRGM_FIELDS:
+            # ILIKE и <% (word_similarity) обслуживаются GIN-индексом gin_trgm_ops
+            query = sql.SQL("""
+                SELECT {columns}
+                FROM {table}
+                WHERE {field} ILIKE %s OR %s <%% {field}
+                ORDER BY word_similarity(%s, {field}) DESC, id
+                LIMIT 10
+            """)
+            params = (f"%{value}%", value, value)
+        else:
+            query = sql.SQL("""
+                SELECT {columns}
+                FROM {table}
+                WHERE {field} ILIKE %s
+                LIMIT 10
+            """)
+            params = (f"%{value}%",)
+        query = query.format(
+            columns=sql.SQL(columns), table=sql.Identifier(table),
+            field=sql.Identifier(db_field), ts_config=sql.Literal(TS_CONFIG),
+        )
+
+        try:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, params)
+                    rows = cur.fetchall()
+        except psycopg2.Error as e:
+            if uses_indexes:
+                logger.warning(f"Ранжированный поиск недоступен ({table}): {e}. Используем ILIKE.")
+                fallback_field = "title" if db_field == "search_tsv" else field
+                return self.search_books(fallback_field, value, table, ranked=False)
+            logger.error(f"SQL Error ({table}): {e}")
+            return []
         except Exception as e:
             logger.error(f"SQL Error ({table}): {e}")
             return []
 
+        results = []
+        for row in rows:
+            results.append({
+                "id": row[0], "title": row[1], "author": row[2], "systematic_code": row[3],
+                "bbk": row[4], "grnti": row[5], "subject": row[6],
+                "owners": row[7], "pdf_url": row[8], "has_text": bool(row[9]), # Флаг, есть ли текст
+                "author_sign": row[10] if len(row) > 10 else None
+            })
+        return results
+
     def get_book_text(self, book_id: int, table: str = "unit") -> tuple:
         """Получает полный текст книги и ссылку по ID"""
         try:
-            conn = self._get_connection()
-            cur = conn.cursor()
-            cur.execute(f"SELECT pdf_ocr, pdf_url FROM {table} WHERE id = %s", (book_id,))
-            row = cur.fetchone()
-            cur.close()
-            conn.close()
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        sql.SQL("SELECT pdf_ocr, pdf_url FROM {} WHERE id = %s").format(sql.Identifier(table)),
+                        (book_id,)
+                    )
+                    row = cur.fetchone()
             return (row[0], row[1]) if row else (None, None)
         except Exception as e:
             logger.error(f"Error getting book text: {e}")
             return (None, None)
 
-sql_service = SQLService()
\ No newline at end of file
+    # --- Кэш кратких содержаний ---
+
+    def _ensure_summary_table(self, conn):
+        if self._summary_table_ready:
+            return
+        with conn.cursor() as cur:
+            create_summary_table(cur)
+        conn.commit()
+        self._summary_table_ready = True
+
+    def get_cached_summary(self, book_id: int, table: str, kind: str) -> Optional[str]:
+        """
+        Сохраненное краткое содержание книги (один SQL-запрос).
+        Резюме действительно, только пока название/ссылка/текст книги не менялись.
+        table приходит от клиента - подставляется только как идентификатор (sql.Identifier).
+        """
+        try:
+            with self._connection() as conn:
+                self._ensure_summary_table(conn)
+                with conn.cursor() as cur:
+                    cur.execute(sql.SQL("""
+                        SELECT s.summary
+                        FROM {summary} s JOIN {table} b ON b.id = s.book_id
+                        WHERE s.catalog_table = %s AND s.book_id = %s AND s.kind = %s
+                          AND s.source_key = {source_key}
+                    """).format(
+                        summary=sql.Identifier(SUMMARY_TABLE),
+                        table=sql.Identifier(table),
+                        source_key=sql.SQL(SUMMARY_SOURCE_KEY_EXPR),
+                    ), (table, book_id, kind))
+                    row = cur.fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            logger.error(f"Error getting cached summary: {e}")
+            return None
+
+    def save_summary(self, book_id: int, table: str, kind: str, summary: str):
+        """Сохраняет краткое содержание книги (перезаписывая прежнее)."""
+        try:
+            with self._connection() as conn:
+                self._ensure_summary_table(conn)
+                with conn.cursor() as cur:
+                    cur.execute(sql.SQL("""
+                        INSERT INTO {summary} (catalog_table, book_id, kind, source_key, summary)
+                        SELECT %s, b.id, %s, {source_key}, %s FROM {table} b WHERE b.id = %s
+                        ON CONFLICT (catalog_table, book_id, kind) DO UPDATE
+                        SET source_key = EXCLUDED.source_key, summary = EXCLUDED.summary, created_at = now()
+                    """).format(
+                        summary=sql.Identifier(SUMMARY_TABLE),
+                        table=sql.Identifier(table),
+                        source_key=sql.SQL(SUMMARY_SOURCE_KEY_EXPR),
+                    ), (table, kind, summary, book_id))
+        except Exception as e:
+            logger.error(f"Error saving summary: {e}")
+
+    # --- Очередь задач анализа ---
+    # В отличие от методов выше, ошибки БД здесь не глотаются - их обрабатывает очередь.
+
+    _JOB_COLUMNS = "id, catalog_table, book_id, status, attempts, result, error, notify_chats, created_at, updated_at"
+
+    def _ensure_jobs_table(self, conn):
+        if self._jobs_table_ready:
+            return
+        with conn.cursor() as cur:
+            create_jobs_table(cur)
+        conn.commit()
+        self._jobs_table_ready = True
+
+    def _job_dict(self, row) -> Optional[Dict[str, Any]]:
+        if not row:
+            return None
+        job = dict(zip([c.strip() for c in self._JOB_COLUMNS.split(",")], row))
+        for key in ("created_at", "updated_at"):
+            job[key] = job[key].isoformat() if job[key] else None
+        return job
+
+    def enqueue_analysis_job(self, table: str, book_id: int, chat_id: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Ставит книгу в очередь анализа. Если по книге уже есть активная задача,
+        возвращается она (чат добавляется в список для уведомления).
+        """
+        chats = [chat_id] if chat_id is not None else []
+        with self._connection() as conn:
+            self._ensure_jobs_table(conn)
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    INSERT INTO {JOBS_TABLE} AS j (catalog_table, book_id, notify_chats)
+                    VALUES (%s, %s, %s::BIGINT[])
+                    ON CONFLICT (catalog_table, book_id) WHERE status IN ('queued', 'running')
+                    DO UPDATE SET
+                        notify_chats = ARRAY(SELECT DISTINCT unnest(j.notify_chats || EXCLUDED.notify_chats)),
+                        updated_at = now()
+                    RETURNING {self._JOB_COLUMNS}
+                """, (table, book_id, chats))
+                return self._job_dict(cur.fetchone())
+
+    def claim_analysis_job(self) -> Optional[Dict[str, Any]]:
+        """Забирает следующую задачу из очереди (SKIP LOCKED - воркеры не мешают друг другу)."""
+        with self._connection() as conn:
+            self._ensure_jobs_table(conn)
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    UPDATE {JOBS_TABLE}
+                    SET status = 'running', attempts = attempts + 1, updated_at = now()
+                    WHERE id = (
+                        SELECT id FROM {JOBS_TABLE} WHERE status = 'queued' AND run_after <= now()
+                        ORDER BY id FOR UPDATE SKIP LOCKED LIMIT 1
+                    )
+                    RETURNING {self._JOB_COLUMNS}
+                """)
+                return self._job_dict(cur.fetchone())
+
+    def finish_analysis_job(self, job_id: int, status: str, result: Optional[str] = None,
+                            error: Optional[str] = None, delay: float = 0.0) -> Optional[Dict[str, Any]]:
+        """Переводит задачу в status (done / failed / queued для повтора не раньше чем через delay сек)."""
+        with self._connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    UPDATE {JOBS_TABLE}
+                    SET status = %s, result = %s, error = %s, updated_at = now(),
+                        run_after = now() + make_interval(secs => %s)
+                    WHERE id = %s
+                    RETURNING {self._JOB_COLUMNS}
+                """, (status, result, error, delay, job_id))
+                return self._job_dict(cur.fetchone())
+
+    def requeue_running_jobs(self) -> int:
+        """После перезапуска задачи в статусе running никто не выполняет - возвращаем их в очередь."""
+        with self._connection() as conn:
+            self._ensure_jobs_table(conn)
+            with conn.cursor() as cur:
+                cur.execute(f"UPDATE {JOBS_TABLE} SET status = 'queued', updated_at = now() WHERE status = 'running'")
+                return cur.rowcount
+
+    def get_analysis_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with self._connection() as conn:
+            self._ensure_jobs_table(conn)
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT {self._JOB_COLUMNS} FROM {JOBS_TABLE} WHERE id = %s", (job_id,))
+                return self._job_dict(cur.fetchone())
+
+sql_service = SQLService()
@@ -0,0 +1,111 @@
+"""
+Извлечение текста из PDF для OCR-конвейера (scripts/2_run_ocr_cleaning.py)
+и учет прогресса по книгам.
+
+Бэкенды: PyMuPDF (по умолчанию, работает везде) и pdftotext (опционально:
+settings.PDFTOTEXT_PATH или pdftotext из PATH). Текст пишется во временный файл
+и атомарно переименовывается - недописанный файл не будет принят за готовый.
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from app.core.config import settings
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("pymupdf", "pdftotext")
+
+
+def find_pdftotext() -> Optional[str]:
+    """Путь к pdftotext: из настроек (Windows-сборка в ocr_engine) или из PATH."""
+    if os.path.exists(settings.PDFTOTEXT_PATH):
+        return settings.PDFTOTEXT_PATH
+    return shutil.which("pdftotext")
+
+
+def extract_pdf_file(pdf_path: str, out_path: str, backend: str = "pymupdf") -> Dict[str, Any]:
+    """
+    Извлекает текст PDF в out_path. Страницы разделяются символом \\f (как у pdftotext).
+    Returns: {"pages": ..., "chars": ...}
+    """
+    tmp_path = out_path + ".tmp"
+    pages = chars = 0
+
+    if backend == "pdftotext":
+        exe = find_pdftotext()
+        if not exe:
+            raise FileNotFoundError(f"pdftotext не найден: {settings.PDFTOTEXT_PATH}")
+        subprocess.run([exe, "-enc", "UTF-8", pdf_path, tmp_path], check=True, capture_output=True)
+        with open(tmp_path, "r", encoding="utf-8", errors="replace") as f:
+            text = f.read()
+        pages, chars = text.count("\f"), len(text)
+    else:
+        if fitz is None:
+            raise ImportError("PyMuPDF (fitz) не установлен.")
+        # Постранично: в памяти одна страница, а не весь документ
+        with fitz.open(pdf_path) as doc, open(tmp_path, "w", encoding="utf-8") as out:
+            for page in doc:
+                text = page.get_text("text")
+                out.write(text)
+                out.write("\f")
+                pages += 1
+                chars += len(text) + 1
+
+    os.replace(tmp_path, out_path)
+    return {"pages": pages, "chars": chars}
+
+
+def extract_job(name: str, pdf_path: str, out_path: str, backend: str) -> Dict[str, Any]:
+    """Задача для пула процессов: ошибки возвращаются в результате, а не пробрасываются."""
+    started = time.perf_counter()
+    try:
+        info = extract_pdf_file(pdf_path, out_path, backend)
+        return {"name": name, "path": out_path, "seconds": time.perf_counter() - started, **info}
+    except Exception as e:
+        return {"name": name, "path": out_path, "error": f"{type(e).__name__}: {e}"}
+
+
+class OCRProgress:
+    """
+    Прогресс OCR-конвейера по книгам (JSON-файл): стадия (extracted / cleaned / failed),
+    число частей, время обновления. Потокобезопасен, сохраняется после каждого изменения,
+    поэтому прерванный запуск продолжается с того же места.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._books: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._books = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Не удалось прочитать прогресс {path}: {e}")
+
+    def get(self, name: str) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._books.get(name, {}))
+
+    def update(self, name: str, **fields):
+        with self._lock:
+            book = self._books.setdefault(name, {})
+            book.update(fields)
+            book["updated_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._books, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
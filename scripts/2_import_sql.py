@@ -2,80 +2,49 @@ import json
 import psycopg2
 import os
 import sys
+import time
 
 # Добавляем путь к проекту для импорта settings
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from app.core.config import settings
+from app.services.catalog_loader import bulk_load_catalog
+from app.services.rusmark import NDJSONReader
 
 def load_json(json_path):
     with open(json_path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def create_table(conn):
-    """Создает таблицу csl, если её нет"""
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS csl (
-            id SERIAL PRIMARY KEY,
-            title TEXT,
-            author TEXT,
-            subject TEXT,
-            grnti TEXT,
-            bbk TEXT,
-            author_sign TEXT,
-            systematic_code TEXT,
-            owners TEXT,
-            pdf_url TEXT,
-            pdf_ocr TEXT
-        )
-    """)
-    conn.commit()
-    cur.close()
-    print("✅ Таблица csl готова")
-
 def insert_books(data, conn):
-    cur = conn.cursor()
-    
-    # Очищаем таблицу перед импортом
-    cur.execute("TRUNCATE TABLE csl RESTART IDENTITY")
-    
-    for book in data:
-        cur.execute("""
-            INSERT INTO csl (title, author, subject, grnti, bbk, author_sign, systematic_code, owners, pdf_url, pdf_ocr)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (
-            book.get("title"),
-            book.get("author"),
-            book.get("subject"),
-            book.get("grnti"),
-            book.get("bbk"),
-            book.get("author_sign"),
-            book.get("systematic_code"),
-            book.get("owners"),
-            book.get("pdf_url"),
-            book.get("pdf_ocr")
-        ))
-    
-    conn.commit()
-    cur.close()
-    print(f"✅ Импортировано записей: {len(data)}")
+    """
+    Загружает книги в csl через COPY FROM STDIN.
+    Данные пишутся в staging-таблицу и подменяют csl атомарно,
+    поэтому во время импорта поиск продолжает работать по старым данным.
+    """
+    started = time.perf_counter()
+    count = bulk_load_catalog(conn, "csl", data)
+    elapsed = time.perf_counter() - started
+    print(f"✅ Импортировано записей: {count} ({elapsed:.1f} с, {count / elapsed if elapsed else 0:.0f} строк/с)")
 
 if __name__ == "__main__":
     # Определяем пути относительно текущего скрипта
     script_dir = os.path.dirname(os.path.abspath(__file__))
     project_root = os.path.dirname(script_dir)
+    ndjson_path = os.path.join(project_root, "uploads", "input_catalogs", "books.ndjson")
     json_path = os.path.join(project_root, "uploads", "input_catalogs", "books.json")
     
-    print(f"📖 Загрузка данных из: {json_path}")
-    
-    if not os.path.exists(json_path):
-        print(f"❌ Файл не найден: {json_path}")
+    # NDJSON (результат 1_process_catalogs.py) стримится с диска, JSON - грузится целиком
+    if os.path.exists(ndjson_path):
+        print(f"📖 Загрузка данных из: {ndjson_path}")
+        books = NDJSONReader(ndjson_path)
+    elif os.path.exists(json_path):
+        print(f"📖 Загрузка данных из: {json_path}")
+        books = load_json(json_path)
+        print(f"📚 Найдено книг: {len(books)}")
+    else:
+        print(f"❌ Файл не найден: {ndjson_path} / {json_path}")
         print("Сначала запустите: python scripts/1_process_catalogs.py")
         exit(1)
     
-    books = load_json(json_path)
-    print(f"📚 Найдено книг: {len(books)}")
-    
     # Подключаемся к PostgreSQL
     print(f"🔌 Подключение к PostgreSQL: {settings.DB_HOST}/{settings.DB_NAME}")
     
@@ -87,7 +56,6 @@ if __name__ == "__main__":
             password=settings.DB_PASS
         )
         
-        create_table(conn)
         insert_books(books, conn)
         
         conn.close()
@@ -1,108 +1,256 @@
-import sys
-import os
+"""
+ШАГ 2 (OCR): извлечение текста из PDF и очистка нейросетью.
+
+Конвейер: текст PDF извлекается в пуле процессов (PyMuPDF или pdftotext),
+готовые книги попадают в ограниченную очередь, из которой их забирает стадия
+очистки LLM. Пока модель чистит одну книгу, следующие уже извлекаются.
+Части книги отправляются на llama.cpp сервер параллельно (см. app/services/ocr_cleaner.py),
+уже чистые части (оценка app/services/ocr_quality.py) в LLM не попадают.
+Прогресс хранится по книгам (uploads/ocr_progress.json) и по частям
+(<книга>.partial.jsonl) - прерванный запуск продолжается с места остановки.
+
+Запуск:
+    python scripts/2_run_ocr_cleaning.py --workers 4 --backend pymupdf --parallel 4
+"""
+import argparse
+import json
 import logging
-from llama_cpp import Llama
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from app.core.config import settings
+from app.services.text_extraction import BACKENDS, OCRProgress, extract_job
+from app.services.ocr_cleaner import CleaningStats, OCRCleaner, split_into_chunks
+from app.services.ocr_quality import light_clean, needs_cleaning
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def load_model():
-    """Загрузка модели через llama-cpp-python"""
-    if not os.path.exists(settings.MODEL_PATH):
-        logger.error(f"❌ ОШИБКА: Модель не найдена по пути: {settings.MODEL_PATH}")
-        logger.error(f"   Положите файл {settings.MODEL_NAME} в папку models/")
-        sys.exit(1)
-        
-    logger.info(f"💾 Загрузка модели из: {settings.MODEL_PATH}")
-    # n_gpu_layers=-1 задействует все слои на GPU, если драйвера настроены
-    return Llama(
-        model_path=settings.MODEL_PATH,
-        n_ctx=8192,      # Контекст
-        n_gpu_layers=-1, # Максимум на GPU
-        verbose=False
-    )
+PROGRESS_PATH = os.path.join(settings.UPLOAD_ROOT, "ocr_progress.json")
 
-def clean_chunk_with_llm(llm, text):
-    """Очистка текста через прямой вызов модели"""
-    prompt = f"""Исправь ошибки OCR (распознавания текста). Склей разорванные слова. Исправь пунктуацию.
-НЕ удаляй информацию. Верни только исправленный текст.
+# Конец очереди извлеченных книг
+_DONE = None
 
-ТЕКСТ:
-{text}
-"""
-    try:
-        response = llm.create_chat_completion(
-            messages=[
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.1,
-            max_tokens=None # Лимит по контексту
-        )
-        return response['choices'][0]['message']['content'].strip()
-    except Exception as e:
-        logger.error(f"⚠️ Ошибка LLM: {e}")
-        return text # Если упало, возвращаем как есть
-
-def process_book(llm, filename):
-    pdf_path = os.path.join(settings.BOOKS_DIR, filename)
-    txt_name = filename.replace(".pdf", ".txt")
-    
-    # 1. Извлечение (pdftotext)
-    dirty_path = os.path.join(settings.TEMP_TXT_DIR, txt_name)
-    
-    print(f"\n📘 Книга: {filename}")
+# ==============================================================================
+# СТАДИЯ 1: ИЗВЛЕЧЕНИЕ ТЕКСТА (пул процессов)
+# ==============================================================================
+
+def extraction_stage(books, workers, backend, out_queue, progress):
+    """
+    Извлекает текст книг в пуле процессов и кладет результаты в out_queue.
+    Очередь ограничена: если очистка отстает, извлечение ждет, а не убегает вперед.
+    """
     try:
-        if not os.path.exists(dirty_path):
-            print("   🔨 Извлекаем текст...")
-            subprocess_args = [settings.PDFTOTEXT_PATH, "-enc", "UTF-8", pdf_path, dirty_path]
-            # Проверка наличия pdftotext
-            if not os.path.exists(settings.PDFTOTEXT_PATH):
-                 logger.error(f"❌ pdftotext не найден: {settings.PDFTOTEXT_PATH}")
-                 return
-                 
-            import subprocess
-            subprocess.run(subprocess_args, check=True)
-    except Exception as e:
-        logger.error(f"❌ Ошибка pdftotext: {e}")
-        return
+        todo = []
+        for name in books:
+            dirty_path = os.path.join(settings.TEMP_TXT_DIR, name.replace(".pdf", ".txt"))
+            if os.path.exists(dirty_path):
+                # Уже извлечено в прошлом запуске
+                out_queue.put({"name": name, "path": dirty_path, "cached": True})
+            else:
+                todo.append((name, dirty_path))
+        if not todo:
+            return
 
-    # 2. Очистка (LLM)
+        # spawn: воркеры не наследуют память основного процесса (модель LLM, CUDA)
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            pending = set()
+            it = iter(todo)
+            while True:
+                for name, dirty_path in it:
+                    pdf_path = os.path.join(settings.BOOKS_DIR, name)
+                    pending.add(pool.submit(extract_job, name, pdf_path, dirty_path, backend))
+                    if len(pending) >= workers * 2:
+                        break
+                if not pending:
+                    break
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    result = future.result()
+                    if result.get("error"):
+                        logger.error(f"❌ Извлечение {result['name']}: {result['error']}")
+                        progress.update(result["name"], stage="failed", error=result["error"])
+                        continue
+                    rate = result["pages"] / result["seconds"] if result["seconds"] else 0
+                    print(f"   🔨 Извлечено: {result['name']} ({result['pages']} стр., {rate:.1f} стр/с)")
+                    progress.update(result["name"], stage="extracted", pages=result["pages"], chars=result["chars"])
+                    out_queue.put(result)
+    finally:
+        out_queue.put(_DONE)
+
+# ==============================================================================
+# СТАДИЯ 2: ОЧИСТКА НЕЙРОСЕТЬЮ
+# ==============================================================================
+
+def load_partial(partial_path, header):
+    """
+    Уже очищенные части книги (после прерванного запуска): индекс -> текст.
+    Если книга делилась на части иначе (другой OCR_CHUNK_CHARS) - начинаем заново.
+    """
+    done = {}
+    if os.path.exists(partial_path):
+        with open(partial_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue  # недописанная последняя строка
+                if "header" in item:
+                    if item["header"] != header:
+                        return {}
+                    continue
+                done[item["i"]] = item["text"]
+    return done
+
+def clean_book(cleaner, name, dirty_path, progress, prefilter=True):
+    txt_name = name.replace(".pdf", ".txt")
     clean_path = os.path.join(settings.CLEAN_TXT_DIR, txt_name)
-    if os.path.exists(clean_path):
-        print("   ⏩ Уже очищено.")
-        return
+    partial_path = clean_path + ".partial.jsonl"
 
+    print(f"\n📘 Книга: {name}")
     with open(dirty_path, "r", encoding="utf-8") as f:
         dirty_text = f.read()
 
-    # Делим на чанки по 2000 символов (чуть меньше, чтобы вошло в промпт)
-    chunk_size = 2000
-    chunks = [dirty_text[i:i+chunk_size] for i in range(0, len(dirty_text), chunk_size)]
-    
-    print(f"   🧹 Очистка нейросетью ({len(chunks)} частей)...")
-    full_clean = []
-    
-    for i, chunk in enumerate(chunks):
-        print(f"     Часть {i+1}/{len(chunks)}", end="\r")
-        cleaned = clean_chunk_with_llm(llm, chunk)
-        full_clean.append(cleaned)
-    
+    # Части по границам абзацев/предложений
+    chunks = split_into_chunks(dirty_text, settings.OCR_CHUNK_CHARS)
+    header = {"chunks": len(chunks), "max_chars": settings.OCR_CHUNK_CHARS}
+
+    done = load_partial(partial_path, header)
+    if done:
+        print(f"   ↪️ Продолжаем: уже очищено {len(done)}/{len(chunks)} частей")
+    else:
+        with open(partial_path, "w", encoding="utf-8") as partial:
+            partial.write(json.dumps({"header": header}) + "\n")
+    # Чистые части (цифровые PDF) не отправляем в LLM - только склеиваем переносы
+    todo = [i for i in range(len(chunks)) if i not in done]
+    if prefilter:
+        dirty = [i for i in todo if needs_cleaning(chunks[i])]
+    else:
+        dirty = todo
+    skipped = len(todo) - len(dirty)
+    skip_rate = skipped / len(todo) if todo else 0.0
+    print(
+        f"   🧹 Очистка нейросетью: {len(dirty)} из {len(todo)} частей "
+        f"(пропущено как чистые: {skipped}, {skip_rate:.0%}; параллельно {cleaner.parallel})..."
+    )
+    progress.update(
+        name, stage="cleaning", chunks_total=len(chunks), chunks_done=len(done),
+        chunks_skipped=skipped, skip_rate=round(skip_rate, 3),
+    )
+
+    stats = CleaningStats()
+    remaining = len(dirty)
+
+    with open(partial_path, "a", encoding="utf-8") as partial:
+        def save(i, text):
+            done[i] = text
+            partial.write(json.dumps({"i": i, "text": text}, ensure_ascii=False) + "\n")
+            partial.flush()
+
+        dirty_set = set(dirty)
+        for i in todo:
+            if i not in dirty_set:
+                save(i, light_clean(chunks[i]))
+        progress.update(name, chunks_done=len(done))
+
+        def on_done(i, text):
+            save(i, text)
+            progress.update(name, chunks_done=len(done))
+            left = len(chunks) - len(done)
+            print(
+                f"     Часть {len(done)}/{len(chunks)} | {stats.tokens_per_second:.1f} ток/с | "
+                f"осталось ~{stats.eta(left) / 60:.1f} мин   ",
+                end="\r",
+            )
+
+        cleaner.clean_chunks(((i, chunks[i]) for i in dirty), on_done, stats)
+
     with open(clean_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(full_clean))
-    print(f"\n   ✅ Готово: {clean_path}")
+        f.write("\n\n".join(done[i] for i in range(len(chunks))))
+    os.remove(partial_path)
+    progress.update(
+        name, stage="cleaned",
+        tokens_per_second=round(stats.tokens_per_second, 1),
+        fallbacks=stats.fallbacks,
+    )
+    print(
+        f"\n   ✅ Готово: {clean_path} ({remaining} частей через LLM за {stats.elapsed / 60:.1f} мин, "
+        f"{stats.tokens_per_second:.1f} ток/с, без исправления: {stats.fallbacks}, пропущено чистых: {skipped})"
+    )
 
 def main():
-    llm = load_model()
-    
-    files = [f for f in os.listdir(settings.BOOKS_DIR) if f.endswith(".pdf")]
+    parser = argparse.ArgumentParser(description="Извлечение текста из PDF и очистка OCR нейросетью")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                        help="Процессов для извлечения текста")
+    parser.add_argument("--backend", choices=BACKENDS, default="pymupdf",
+                        help="pymupdf (встроенный) или pdftotext (poppler)")
+    parser.add_argument("--queue-size", type=int, default=4,
+                        help="Сколько извлеченных книг может ждать очистки")
+    parser.add_argument("--llm-backend", choices=("server", "local"), default=settings.OCR_LLM_BACKEND,
+                        help="server - llama.cpp HTTP (параллельные слоты), local - llama-cpp-python в процессе")
+    parser.add_argument("--parallel", type=int, default=settings.OCR_LLM_PARALLEL,
+                        help="Одновременных запросов к llama.cpp серверу")
+    parser.add_argument("--no-prefilter", action="store_true",
+                        help="Отправлять в LLM все части, даже уже чистые")
+    args = parser.parse_args()
+
+    progress = OCRProgress(PROGRESS_PATH)
+    files = sorted(f for f in os.listdir(settings.BOOKS_DIR) if f.endswith(".pdf"))
     if not files:
         print(f"⚠️ Нет PDF в папке {settings.BOOKS_DIR}")
-        
-    for f in files:
-        process_book(llm, f)
+        return
+
+    books = []
+    for name in files:
+        clean_path = os.path.join(settings.CLEAN_TXT_DIR, name.replace(".pdf", ".txt"))
+        if os.path.exists(clean_path):
+            progress.update(name, stage="cleaned")
+            continue
+        books.append(name)
+    print(f"📚 Книг: {len(files)}, к обработке: {len(books)} (уже очищено: {len(files) - len(books)})")
+    if not books:
+        return
+
+    extracted = queue.Queue(maxsize=args.queue_size)
+    producer = threading.Thread(
+        target=extraction_stage,
+        args=(books, args.workers, args.backend, extracted, progress),
+        name="pdf-extract",
+        daemon=True,
+    )
+    # Извлечение стартует сразу и идет параллельно загрузке модели
+    producer.start()
+    try:
+        cleaner = OCRCleaner(backend=args.llm_backend, parallel=args.parallel)
+    except Exception as e:
+        logger.error(f"❌ ОШИБКА: {e}")
+        sys.exit(1)
+
+    started = time.perf_counter()
+    cleaned = 0
+    while True:
+        item = extracted.get()
+        if item is _DONE:
+            break
+        try:
+            clean_book(cleaner, item["name"], item["path"], progress,
+                       prefilter=settings.OCR_PREFILTER and not args.no_prefilter)
+            cleaned += 1
+        except Exception as e:
+            logger.error(f"❌ Ошибка очистки {item['name']}: {e}")
+            progress.update(item["name"], stage="failed", error=str(e))
+    producer.join()
+    cleaner.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"\n🏁 Очищено книг: {cleaned} за {elapsed / 60:.1f} мин")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,16 +1,17 @@
 import sys
 import os
+import time
 import psycopg2
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from app.core.config import settings
-from app.services.rag_system import RAGSystem
+from app.services.rag_system import get_rag_system
 
 def main():
     print("🚀 ШАГ 3: Загрузка книг в ChromaDB с полными метаданными")
     
     # Инициализируем RAG систему
-    rag = RAGSystem()
+    rag = get_rag_system()
     
     # Подключаемся к PostgreSQL
     print(f"🔌 Подключение к PostgreSQL: {settings.DB_HOST}/{settings.DB_NAME}")
@@ -27,46 +28,53 @@ def main():
         print("\nСначала запустите: python scripts/2_import_sql.py")
         return
     
+    # Считаем книги, затем читаем их серверным курсором, чтобы не держать всё в памяти
     cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM csl")
+    total = cursor.fetchone()[0]
+    cursor.close()
     
-    # Получаем все книги
+    if not total:
+        conn.close()
+        print("⚠️ В базе данных нет книг.")
+        print("Сначала запустите: python scripts/2_import_sql.py")
+        return
+    
+    print(f"📚 Найдено книг в базе: {total}")
+    print("🔄 Начинаем индексацию...")
+    
+    cursor = conn.cursor(name="ingest_fulltext")
+    cursor.itersize = settings.RAG_UPSERT_BATCH_SIZE
     cursor.execute("""
         SELECT title, author, subject, grnti, bbk, author_sign, 
                systematic_code, owners, pdf_url, pdf_ocr
         FROM csl
     """)
     
-    books = cursor.fetchall()
-    conn.close()
+    def iter_books():
+        for row in cursor:
+            yield {
+                "title": row[0] or "",
+                "author": row[1] or "",
+                "subject": row[2] or "",
+                "grnti": row[3] or "",
+                "bbk": row[4] or "",
+                "author_sign": row[5] or "",
+                "systematic_code": row[6] or "",
+                "owners": row[7] or "",
+                "pdf_url": row[8] or "",
+                "pdf_ocr": row[9] or "",
+            }
     
-    if not books:
-        print("⚠️ В базе данных нет книг.")
-        print("Сначала запустите: python scripts/2_import_sql.py")
-        return
+    started = time.perf_counter()
+    count = rag.add_books_batch(iter_books())
+    elapsed = time.perf_counter() - started
     
-    print(f"📚 Найдено книг в базе: {len(books)}")
-    print("🔄 Начинаем индексацию...")
-    
-    for i, row in enumerate(books, 1):
-        book_data = {
-            "title": row[0] or "",
-            "author": row[1] or "",
-            "subject": row[2] or "",
-            "grnti": row[3] or "",
-            "bbk": row[4] or "",
-            "author_sign": row[5] or "",
-            "systematic_code": row[6] or "",
-            "owners": row[7] or "",
-            "pdf_url": row[8] or "",
-            "pdf_ocr": row[9] or "",
-        }
-        
-        rag.add_book(book_data)
-        
-        if i % 100 == 0:
-            print(f"✅ Обработано: {i}/{len(books)}")
+    cursor.close()
+    conn.close()
     
-    print(f"🎉 Загрузка завершена! Всего книг: {len(books)}")
+    print(f"🎉 Загрузка завершена! Всего книг: {count}")
+    print(f"⏱ {elapsed:.1f} с, {count / elapsed if elapsed else 0:.1f} книг/с")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,34 +1,104 @@
 import os
 import re
+import sys
 import json
+import hashlib
+import argparse
 import torch
 import fitz  # PyMuPDF
-import sys
-import io
+import queue
+import threading
+from collections import Counter
 from PIL import Image, ImageDraw
 from transformers import AutoModel, AutoTokenizer
 from tqdm import tqdm
 
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app.services.crop_classifier import MOLECULE, classify_crop
+from app.services.text_extraction import OCRProgress
+
 # --- НАСТРОЙКИ ---
 BASE_OUT = "outputs/chem_results"
 CONFIG = {
     "model_name": "deepseek-ai/DeepSeek-OCR-2",
+    "model_revision": None,  # Коммит модели на HF (remote code); None - последняя версия
     "input_dir": "uploads/input_pdfs",
     "json_dir": os.path.join(BASE_OUT, "json"),     # Финальные данные
     "crops_dir": os.path.join(BASE_OUT, "crops"),   # Вырезанные формулы
-    "debug_dir": os.path.join(BASE_OUT, "debug"),   # Картинки с рамками
-    "temp_dir": os.path.join(BASE_OUT, "temp"),     # Промежуточные страницы
+    "debug_dir": os.path.join(BASE_OUT, "debug"),   # Картинки с рамками и ответ модели .mmd (только с --debug)
+    "temp_dir": os.path.join(BASE_OUT, "temp"),     # Текущая страница для model.infer (один файл на весь запуск)
+    "pages_dir": os.path.join(BASE_OUT, "pages"),   # Постраничный журнал незавершенных PDF (<sha256>.jsonl)
+    "manifest": os.path.join(BASE_OUT, "manifest.json"),  # Статус PDF: хэш, стадия, страниц готово
+    "debug": False,       # Сохранять отладочные картинки и ответы модели
     "dpi": 300,
+    "prefetch_pages": 2,  # Сколько страниц растеризуется заранее, пока модель занята
     "device": "cuda:0"
 }
 
+# Конец потока страниц
+_DONE = None
+
+GROUNDING_RE = re.compile(r'<\|ref\|>(.*?)<\|/ref\|>\s*<\|det\|>\[\[(\d+),\s*(\d+),\s*(\d+),\s*(\d+)\]\]<\|/det\|>')
+STRUCTURE_TAGS = ("equation", "formula", "image", "figure")
+
+def parse_grounding(ocr_result):
+    """Блоки из ответа модели: [{"tag", "coords": (x1, y1, x2, y2)}], координаты 0-999."""
+    if not ocr_result:
+        return []
+    return [
+        {"tag": tag, "coords": (int(x1), int(y1), int(x2), int(y2))}
+        for tag, x1, y1, x2, y2 in GROUNDING_RE.findall(ocr_result)
+    ]
+
+def file_sha256(path):
+    """Хэш содержимого PDF: измененный файл (тот же name, другой хэш) обрабатывается заново."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_pages(pages_path, header):
+    """
+    Уже обработанные страницы из журнала (после прерванного запуска): номер -> результат.
+    Если журнал от другой версии файла или других настроек (header) - начинаем заново.
+    """
+    done = {}
+    if os.path.exists(pages_path):
+        with open(pages_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue  # недописанная последняя строка
+                if "header" in item:
+                    if item["header"] != header:
+                        return {}
+                    continue
+                done[item["page"]] = item
+    return done
+
+def save_page_image(image):
+    """
+    Страница для model.infer. Remote code DeepSeek-OCR подставляет image_file в диалог
+    как строку (f'{image_file}') и открывает по пути, поэтому объект в памяти не подходит.
+    Один файл перезаписывается на каждой странице; BMP без сжатия - запись и чтение
+    сводятся к копированию пикселей (в отличие от JPEG).
+    """
+    path = os.path.join(CONFIG["temp_dir"], "current_page.bmp")
+    image.save(path, format="BMP")
+    return path
+
 class ChemPipeline:
     def __init__(self):
         print(f"Инициализация DeepSeek-OCR-2 на {CONFIG['device']}...")
-        self.tokenizer = AutoTokenizer.from_pretrained(CONFIG["model_name"], trust_remote_code=True)
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            CONFIG["model_name"], trust_remote_code=True, revision=CONFIG["model_revision"]
+        )
         self.model = AutoModel.from_pretrained(
             CONFIG["model_name"],
             trust_remote_code=True,
+            revision=CONFIG["model_revision"],
             _attn_implementation='eager',
             torch_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
             device_map=CONFIG["device"]
@@ -38,66 +108,132 @@ class ChemPipeline:
         os.makedirs(CONFIG["input_dir"], exist_ok=True)
         os.makedirs(CONFIG["json_dir"], exist_ok=True)
         os.makedirs(CONFIG["crops_dir"], exist_ok=True)
-        os.makedirs(CONFIG["debug_dir"], exist_ok=True)
+        os.makedirs(CONFIG["pages_dir"], exist_ok=True)
+        self.manifest = OCRProgress(CONFIG["manifest"])
         os.makedirs(CONFIG["temp_dir"], exist_ok=True)
+        if CONFIG["debug"]:
+            os.makedirs(CONFIG["debug_dir"], exist_ok=True)
+
+    def iter_pages(self, pdf_path, skip=()):
+        """Растеризует страницы по одной: в памяти только текущая страница, а не весь документ."""
+        zoom = fitz.Matrix(CONFIG["dpi"]/72, CONFIG["dpi"]/72)
+        with fitz.open(pdf_path) as doc:
+            for page_num in range(len(doc)):
+                if page_num in skip:
+                    continue
+                pix = doc[page_num].get_pixmap(matrix=zoom)
+                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+                del pix
+                yield page_num, img
+
+    def pdf_to_images(self, pdf_path, skip=()):
+        """
+        Страницы PDF с упреждением: фоновый поток растеризует следующие страницы,
+        пока модель обрабатывает текущую. Очередь ограничена prefetch_pages,
+        поэтому пик памяти не зависит от длины документа.
+        Страницы из skip (уже обработанные) не растеризуются.
+        Yields: (номер страницы, PIL.Image)
+        """
+        pages = queue.Queue(maxsize=max(1, CONFIG["prefetch_pages"]))
+        stop = threading.Event()
+        errors = []
 
-    def pdf_to_images(self, pdf_path):
-        doc = fitz.open(pdf_path)
-        images = []
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            pix = page.get_pixmap(matrix=fitz.Matrix(CONFIG["dpi"]/72, CONFIG["dpi"]/72))
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            images.append(img)
-        doc.close()
-        return images
-
-    def detect_formulas(self, image_path):
-        """Запускает модель и перехватывает её текстовый вывод."""
+        def render():
+            try:
+                for item in self.iter_pages(pdf_path, skip):
+                    # put с таймаутом, чтобы поток не завис, если потребитель остановился
+                    while not stop.is_set():
+                        try:
+                            pages.put(item, timeout=0.5)
+                            break
+                        except queue.Full:
+                            continue
+                    if stop.is_set():
+                        return
+            except Exception as e:
+                errors.append(e)
+            finally:
+                while not stop.is_set():
+                    try:
+                        pages.put(_DONE, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+
+        worker = threading.Thread(target=render, name="pdf-render", daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = pages.get()
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            stop.set()
+            worker.join()
+        if errors:
+            raise errors[0]
+
+    def detect_formulas(self, image):
+        """
+        Запускает модель на странице (PIL.Image) и возвращает текст с разметкой grounding.
+        eval_mode=True - модель возвращает ответ, а не печатает его в stdout
+        (и сама ничего не сохраняет: ветка save_results до этого не доходит).
+        Отладочные файлы пишет extract_crops_and_debug.
+        """
         prompt = "<image>\n<|grounding|>Please identify all equations, formulas, images and text blocks with coordinates."
-        
-        f = io.StringIO()
+
         with torch.no_grad():
-            with sys_stdout_context(f):
-                res = self.model.infer(
-                    self.tokenizer,
-                    prompt=prompt,
-                    image_file=image_path,
-                    base_size=1024,
-                    image_size=768,
-                    crop_mode=True,
-                    output_path=CONFIG["temp_dir"], # Логи модели во временную папку
-                    save_results=True
-                )
-        
-        final_res = res if res else f.getvalue()
-        return final_res
+            res = self.model.infer(
+                self.tokenizer,
+                prompt=prompt,
+                image_file=save_page_image(image),
+                base_size=1024,
+                image_size=768,
+                crop_mode=True,
+                output_path=CONFIG["temp_dir"],
+                save_results=False,
+                eval_mode=True
+            )
+        return res or ""
 
     def extract_crops_and_debug(self, image, ocr_result, pdf_name, page_num):
-        if not ocr_result: return []
-        
-        pattern = r'<\|ref\|>(.*?)<\|/ref\|>\s*<\|det\|>\[\[(\d+),\s*(\d+),\s*(\d+),\s*(\d+)\]\]<\|/det\|>'
-        matches = re.findall(pattern, ocr_result)
-        
+        if CONFIG["debug"]:
+            # Аналог result.mmd модели, но отдельный файл на каждую страницу
+            mmd_path = os.path.join(CONFIG["debug_dir"], f"layout_{pdf_name}_p{page_num}.mmd")
+            with open(mmd_path, "w", encoding="utf-8") as f:
+                f.write(ocr_result or "")
+
+        regions = parse_grounding(ocr_result)
+        if not regions: return []
+
         crops = []
         w, h = image.size
-        debug_img = image.copy()
-        draw = ImageDraw.Draw(debug_img)
-        
-        for i, (tag, x1, y1, x2, y2) in enumerate(matches):
+        draw = None
+        if CONFIG["debug"]:
+            debug_img = image.copy()
+            draw = ImageDraw.Draw(debug_img)
+
+        for i, region in enumerate(regions):
+            tag = region["tag"]
+            x1, y1, x2, y2 = region["coords"]
             box = (
-                int(int(x1) * w / 1000),
-                int(int(y1) * h / 1000),
-                int(int(x2) * w / 1000),
-                int(int(y2) * h / 1000)
+                int(x1 * w / 1000),
+                int(y1 * h / 1000),
+                int(x2 * w / 1000),
+                int(y2 * h / 1000)
             )
-            
-            color = "red" if tag in ["equation", "formula", "image"] else "blue"
-            draw.rectangle(box, outline=color, width=3)
-            draw.text((box[0], box[1] - 15), f"{tag}_{i}", fill=color)
 
-            if tag in ["equation", "formula", "image", "figure"]:
-                area_ratio = (int(x2)-int(x1)) * (int(y2)-int(y1)) / 1000000
+            if draw is not None:
+                color = "red" if tag in ["equation", "formula", "image"] else "blue"
+                draw.rectangle(box, outline=color, width=3)
+                draw.text((box[0], box[1] - 15), f"{tag}_{i}", fill=color)
+
+            if tag in STRUCTURE_TAGS:
+                # Вырожденная рамка (нулевая ширина/высота после округления) - вырезать нечего
+                if box[2] <= box[0] or box[3] <= box[1]:
+                    continue
+                area_ratio = (x2-x1) * (y2-y1) / 1000000
                 if area_ratio > 0.99:
                     continue
 
@@ -105,51 +241,91 @@ class ChemPipeline:
                 pad = 150
                 bx = (max(0, box[0]-pad), max(0, box[1]-pad), min(w, box[2]+pad), min(h, box[3]+pad))
                 crop = image.crop(bx)
-                
+                # Похоже ли на рисунок молекулы (оценивается область без отступа) - для отбора в MolScribe
+                # Ошибка классификатора не должна останавливать конвейер: кроп остается кандидатом
+                try:
+                    label, score, _ = classify_crop(image.crop(box), CONFIG["dpi"])
+                except Exception as e:
+                    print(f"  ⚠️ Классификатор упал на {tag}_{i}: {e} - считаем молекулой")
+                    label, score = MOLECULE, 1.0
+
                 crop_name = f"{pdf_name}_p{page_num}_{tag}_{i}.jpg"
                 crop_path = os.path.join(CONFIG["crops_dir"], crop_name)
                 crop.save(crop_path)
-                crops.append({"path": crop_path, "box": box, "type": tag})
-                print(f"  [+] Вырезано ({tag}): {crop_name}")
-        
-        debug_path = os.path.join(CONFIG["debug_dir"], f"layout_{pdf_name}_p{page_num}.jpg")
-        debug_img.save(debug_path)
+                crops.append({
+                    "path": crop_path, "box": box, "crop_box": bx, "type": tag,
+                    "class": label, "molecule_score": round(score, 2)
+                })
+                print(f"  [+] Вырезано ({tag} -> {label}): {crop_name}")
+
+        if draw is not None:
+            debug_path = os.path.join(CONFIG["debug_dir"], f"layout_{pdf_name}_p{page_num}.jpg")
+            debug_img.save(debug_path)
         return crops
 
     def process_all(self):
-        pdf_files = [f for f in os.listdir(CONFIG["input_dir"]) if f.endswith(".pdf")]
+        """
+        Обрабатывает все PDF с продолжением после сбоя: результат каждой страницы сразу
+        дописывается в журнал pages/<sha256>.jsonl, при повторном запуске готовые
+        страницы пропускаются. Неизмененные PDF (тот же хэш, стадия done) пропускаются целиком.
+        """
+        pdf_files = sorted(f for f in os.listdir(CONFIG["input_dir"]) if f.endswith(".pdf"))
         for pdf_file in pdf_files:
-            results = []
-            images = self.pdf_to_images(os.path.join(CONFIG["input_dir"], pdf_file))
-            
-            for page_num, img in enumerate(images):
-                print(f"--- Обработка {pdf_file} [Стр {page_num+1}/{len(images)}] ---")
-                temp_path = os.path.join(CONFIG["temp_dir"], f"current_p{page_num}.jpg")
-                img.save(temp_path)
-                
-                ocr_output = self.detect_formulas(temp_path)
-                crops = self.extract_crops_and_debug(img, ocr_output, pdf_file, page_num)
-                
-                results.append({
-                    "page": page_num,
-                    "text_content": ocr_output,
-                    "structures": crops
-                })
-            
+            pdf_path = os.path.join(CONFIG["input_dir"], pdf_file)
             out_file = os.path.join(CONFIG["json_dir"], f"{pdf_file}.json")
-            with open(out_file, "w", encoding="utf-8") as f:
+            sha256 = file_sha256(pdf_path)
+
+            entry = self.manifest.get(pdf_file)
+            if entry.get("sha256") == sha256 and entry.get("stage") == "done" and os.path.exists(out_file):
+                print(f"⏭️ Уже обработан: {pdf_file}")
+                continue
+
+            with fitz.open(pdf_path) as doc:
+                total_pages = len(doc)
+
+            header = {"pdf": pdf_file, "sha256": sha256, "pages": total_pages, "dpi": CONFIG["dpi"]}
+            pages_path = os.path.join(CONFIG["pages_dir"], f"{sha256}.jsonl")
+            done = load_pages(pages_path, header)
+            if done:
+                print(f"↪️ Продолжаем {pdf_file}: уже обработано {len(done)}/{total_pages} стр.")
+            else:
+                with open(pages_path, "w", encoding="utf-8") as log:
+                    log.write(json.dumps({"header": header}, ensure_ascii=False) + "\n")
+            self.manifest.update(pdf_file, sha256=sha256, stage="processing", pages=total_pages, pages_done=len(done))
+
+            with open(pages_path, "a", encoding="utf-8") as log:
+                for page_num, img in self.pdf_to_images(pdf_path, skip=done):
+                    print(f"--- Обработка {pdf_file} [Стр {page_num+1}/{total_pages}] ---")
+                    ocr_output = self.detect_formulas(img)
+                    crops = self.extract_crops_and_debug(img, ocr_output, pdf_file, page_num)
+
+                    result = {
+                        "page": page_num,
+                        "text_content": ocr_output,
+                        "structures": crops
+                    }
+                    log.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    log.flush()
+                    done[page_num] = result
+                    self.manifest.update(pdf_file, pages_done=len(done))
+
+            results = [done[n] for n in sorted(done)]
+            tmp_file = out_file + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
                 json.dump(results, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, out_file)
+            os.remove(pages_path)
+            counts = Counter(struct.get("class", "?") for page in results for struct in page["structures"])
+            self.manifest.update(pdf_file, stage="done", crop_classes=dict(counts))
             print(f"🏁 Готово! JSON: {out_file}")
-
-class sys_stdout_context:
-    def __init__(self, new_target):
-        self.new_target = new_target
-        self.old_target = sys.stdout
-    def __enter__(self):
-        sys.stdout = self.new_target
-    def __exit__(self, type, value, traceback):
-        sys.stdout = self.old_target
+            print("   Классы кропов: " + ", ".join(f"{label}: {n}" for label, n in sorted(counts.items())))
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Поиск химических структур в PDF (DeepSeek-OCR-2)")
+    parser.add_argument("--debug", action="store_true",
+                        help="Сохранять страницы с рамками и ответы модели (.mmd) в debug_dir")
+    args = parser.parse_args()
+    CONFIG["debug"] = args.debug
+
     pipeline = ChemPipeline()
     pipeline.process_all()
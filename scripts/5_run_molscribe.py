@@ -1,7 +1,29 @@
+"""
+ШАГ 2 (химия): распознавание структур на кропах DeepSeek (MolScribe -> SMILES).
+
+Кропы собираются из всех JSON сразу и идут в модель пакетами (predict_images):
+пока модель считает один пакет, пул потоков уже декодирует следующий.
+На CPU torch использует все ядра (--threads).
+В MolScribe идут только кропы, похожие на рисунок молекулы
+(app/services/crop_classifier.py); --all отключает отбор.
+
+Запуск:
+    python scripts/5_run_molscribe.py --batch-size 16 --workers 4
+"""
 import os
 import sys
 import json
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
 import torch
+from PIL import Image
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app.services.crop_classifier import MOLECULE, classify_crop
 
 # Добавляем путь к склонированному репозиторию MolScribe, чтобы импорты работали
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'MolScribe')))
@@ -18,6 +40,7 @@ except ImportError as e:
 # Настройки
 RESULTS_DIR = "outputs/chem_results/json" # Папка с JSON от DeepSeek
 WEIGHTS_DIR = "MolScribe/weights"
+CROP_PAD = 150  # Отступ кропа в 4_chem_pipeline.py (для JSON без crop_box)
 
 def find_weights():
     if not os.path.exists(WEIGHTS_DIR):
@@ -30,7 +53,106 @@ def find_weights():
 
 MOLSCRIBE_WEIGHTS = find_weights()
 
-def process_chemistry():
+def is_annotated(struct):
+    """Кроп уже прошел MolScribe (есть SMILES или модель ничего не распознала)."""
+    return 'smiles' in struct or struct.get('ocsr') == 'done'
+
+def load_image(path):
+    """Кроп в RGB (как внутри MolScribe.predict_image_file) или None, если файл не читается."""
+    image = cv2.imread(path)
+    if image is None:
+        return None
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+def collect_crops(json_files):
+    """
+    Все еще не размеченные кропы из всех JSON.
+    Returns: (data: json_file -> содержимое, crops: [(json_file, struct, путь)])
+    """
+    data, crops = {}, []
+    for json_file in json_files:
+        with open(os.path.join(RESULTS_DIR, json_file), 'r', encoding='utf-8') as f:
+            data[json_file] = json.load(f)
+        for page in data[json_file]:
+            for struct in page.get('structures', []):
+                # Только еще не размеченные кропы: повторный запуск не гоняет модель заново
+                if is_annotated(struct):
+                    continue
+                # Пробуем оба варианта ключа: 'path' и 'image_path'
+                img_p = struct.get('path') or struct.get('image_path')
+                if img_p and os.path.exists(img_p):
+                    crops.append((json_file, struct, img_p))
+    return data, crops
+
+def classify_struct(struct, img_p):
+    """
+    Класс кропа (кэшируется в JSON). Оценивается область детекции без отступа:
+    рамка box в координатах страницы, кроп начинается с crop_box.
+    """
+    if 'class' in struct:
+        return struct['class']
+    try:
+        with Image.open(img_p) as image:
+            region = image
+            box = struct.get('box')
+            if box:
+                crop_box = struct.get('crop_box') or (max(0, box[0] - CROP_PAD), max(0, box[1] - CROP_PAD))
+                ox, oy = crop_box[0], crop_box[1]
+                region = image.crop((box[0] - ox, box[1] - oy, box[2] - ox, box[3] - oy))
+            label, score, _ = classify_crop(region)
+    except Exception as e:
+        # Не смогли оценить - пусть решает MolScribe
+        print(f"  ⚠️ Не удалось классифицировать {img_p}: {e}")
+        return MOLECULE
+    struct['class'] = label
+    struct['molecule_score'] = round(score, 2)
+    return label
+
+def route_crops(crops, data, workers):
+    """
+    Оставляет только кропы класса molecule, остальные помечаются ocsr: skipped.
+    Returns: (кропы для MolScribe, счетчик по классам)
+    """
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="crop-classify") as pool:
+        classes = list(pool.map(lambda item: classify_struct(item[1], item[2]), crops))
+    counts = Counter(classes)
+    selected = []
+    for item, label in zip(crops, classes):
+        if label == MOLECULE:
+            selected.append(item)
+        else:
+            item[1]['ocsr'] = 'skipped'
+    # Классы сохраняются: повторный запуск их не пересчитывает
+    for json_file in {json_file for json_file, _, _ in crops}:
+        save_json(json_file, data[json_file])
+    return selected, counts
+
+def save_json(json_file, data):
+    path = os.path.join(RESULTS_DIR, json_file)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def predict_batch(model, images, batch_size):
+    """
+    Пакетное распознавание. Если пакет целиком упал (битый кроп) -
+    повторяем по одному, чтобы не терять остальные. Ошибка - None в ответе.
+    """
+    try:
+        return model.predict_images(images, batch_size=batch_size)
+    except Exception as e:
+        print(f"  ⚠️ Ошибка пакета ({e}), распознаю по одному")
+    outputs = []
+    for image in images:
+        try:
+            outputs.append(model.predict_images([image], batch_size=1)[0])
+        except Exception as e:
+            print(f"  ⚠️ Ошибка кропа: {e}")
+            outputs.append(None)
+    return outputs
+
+def process_chemistry(batch_size=16, workers=4, threads=None, route=True):
     print("--- [ШАГ 2] Запуск химического распознавания (MolScribe) ---")
     
     if not MOLSCRIBE_WEIGHTS:
@@ -40,9 +162,37 @@ def process_chemistry():
 
     print(f"🔎 Используются веса: {MOLSCRIBE_WEIGHTS}")
 
-    # 1. Инициализация (в molenv это будет Torch 1.13)
+    # 1. Ищем JSON файлы, созданные DeepSeek на первом шаге
+    json_files = sorted(f for f in os.listdir(RESULTS_DIR) if f.endswith(".json"))
+    
+    if not json_files:
+        print(f"⚠️ Нет JSON файлов в {RESULTS_DIR}. Сначала запустите Шаг 1 в основной среде!")
+        return
+
+    data, crops = collect_crops(json_files)
+    if not crops:
+        print("⏭️ Все кропы уже размечены")
+        return
+
+    # 2. Отбор: в тяжелую модель только похожие на молекулы (формулы, фото, текст - мимо)
+    candidates = len(crops)
+    skipped = 0
+    if route:
+        crops, counts = route_crops(crops, data, workers)
+        skipped = candidates - len(crops)
+        print("Классы кропов: " + ", ".join(f"{label}: {counts.get(label, 0)}" for label in sorted(counts)))
+        print(f"В MolScribe: {len(crops)} из {candidates} (пропущено: {skipped})")
+        if not crops:
+            return
+
+    # 3. Инициализация (в molenv это будет Torch 1.13)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(f"Используем устройство: {device}")
+    if device.type == "cpu":
+        # Без GPU - все ядра на матричные операции
+        torch.set_num_threads(threads or os.cpu_count() or 1)
+        print(f"Используем устройство: {device} (потоков torch: {torch.get_num_threads()})")
+    else:
+        print(f"Используем устройство: {device}")
     
     try:
         model = MolScribe(MOLSCRIBE_WEIGHTS, device=device)
@@ -50,40 +200,57 @@ def process_chemistry():
         print(f"❌ Ошибка инициализации MolScribe: {e}")
         return
 
-    # 2. Ищем JSON файлы, созданные DeepSeek на первом шаге
-    json_files = [f for f in os.listdir(RESULTS_DIR) if f.endswith(".json")]
-    
-    if not json_files:
-        print(f"⚠️ Нет JSON файлов в {RESULTS_DIR}. Сначала запустите Шаг 1 в основной среде!")
-        return
+    batches = [crops[i:i + batch_size] for i in range(0, len(crops), batch_size)]
+    print(f"Кропов к разметке: {len(crops)} из {len(json_files)} JSON (пакетов: {len(batches)} по {batch_size})")
 
-    for json_file in json_files:
-        path = os.path.join(RESULTS_DIR, json_file)
-        with open(path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        print(f"Обработка результатов для: {json_file}")
-        
-        updated = False
-        for page in data:
-            for struct in page.get('structures', []):
-                # Пробуем оба варианта ключа: 'path' и 'image_path'
-                img_p = struct.get('path') or struct.get('image_path')
-                
-                if img_p and os.path.exists(img_p):
-                    try:
-                        print(f"  Распознаю: {img_p}")
-                        output = model.predict_image_file(img_p)
-                        if output and 'smiles' in output:
-                            struct['smiles'] = output['smiles']
-                            updated = True
-                    except Exception as e:
-                        print(f"  ⚠️ Ошибка на {img_p}: {e}")
-        
-        if updated:
-            with open(path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-            print(f"✅ Файл обновлен: {path}")
+    # 4. Пакетное распознавание: декодирование следующего пакета идет параллельно модели
+    started = time.perf_counter()
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="crop-decode") as pool:
+        decoding = [pool.submit(load_image, img_p) for _, _, img_p in batches[0]]
+        for n, batch in enumerate(batches):
+            images = [future.result() for future in decoding]
+            if n + 1 < len(batches):
+                decoding = [pool.submit(load_image, img_p) for _, _, img_p in batches[n + 1]]
+
+            ready = []
+            for item, image in zip(batch, images):
+                if image is None:
+                    print(f"  ⚠️ Не удалось прочитать: {item[2]}")
+                else:
+                    ready.append((item, image))
+            if not ready:
+                continue
+
+            outputs = predict_batch(model, [image for _, image in ready], batch_size)
+            touched = set()
+            for ((json_file, struct, _), _), output in zip(ready, outputs):
+                if output is None:
+                    continue  # ошибка - попробуем в следующий запуск
+                if 'smiles' in output:
+                    struct['smiles'] = output['smiles']
+                struct['ocsr'] = 'done'
+                touched.add(json_file)
+            # Сохраняем после каждого пакета: прерванный запуск не теряет размеченное
+            for json_file in touched:
+                save_json(json_file, data[json_file])
+
+            done += len(ready)
+            rate = done / (time.perf_counter() - started)
+            print(f"  Пакет {n + 1}/{len(batches)} | кропов {done}/{len(crops)} | {rate:.2f} кроп/с")
+
+    elapsed = time.perf_counter() - started
+    print(f"✅ Размечено кропов: {done} за {elapsed:.1f} с ({done / elapsed if elapsed else 0:.2f} кроп/с)")
+    if skipped and done:
+        print(f"⏱️ Отбор сэкономил ~{skipped * elapsed / done:.0f} с работы MolScribe ({skipped} кропов)")
 
 if __name__ == "__main__":
-    process_chemistry()
+    parser = argparse.ArgumentParser(description="Распознавание химических структур на кропах (MolScribe)")
+    parser.add_argument("--batch-size", type=int, default=16, help="Кропов в одном пакете модели")
+    parser.add_argument("--workers", type=int, default=4, help="Потоков для чтения и декодирования кропов")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Потоков torch на CPU (по умолчанию - все ядра)")
+    parser.add_argument("--all", action="store_true",
+                        help="Отправлять в MolScribe все кропы, без отбора по классу")
+    args = parser.parse_args()
+    process_chemistry(batch_size=args.batch_size, workers=args.workers, threads=args.threads, route=not args.all)
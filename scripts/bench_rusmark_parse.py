@@ -0,0 +1,69 @@
+"""
+Микробенчмарк разбора Rusmark: генерирует синтетический каталог и меряет записей/с.
+
+Запуск:
+    python scripts/bench_rusmark_parse.py --records 200000 --workers 1 4
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app.services.rusmark import iter_rusmark_records_parallel
+
+WORDS = ["история", "физика", "химия", "Москва", "наука", "учебник", "сборник", "том", "основы", "теория"]
+
+
+def make_record(rnd: random.Random, i: int) -> str:
+    def words(n):
+        return " ".join(rnd.choice(WORDS) for _ in range(n))
+    return "\n".join([
+        f"#200: ^A{words(4)}^E{words(2)}^F{words(2)}",
+        f"#210: ^AМосква^C{words(1)}^D{1950 + i % 70}",
+        f"#700: ^A{words(1).capitalize()}^BИ.И.^GИван Иванович",
+        f"#606: ^A{words(2)}^B{words(1)}",
+        f"#621: ^A2{i % 10}.{i % 7}",
+        f"#964: ^A{i % 90}.{i % 30}",
+        f"#902: ^AБиблиотека {i % 5}^Bзал",
+        f"#955: ^Ahttp://lib.example/{i}.pdf",
+        "*****",
+    ]) + "\n"
+
+
+def generate(path: str, records: int, seed: int = 42):
+    rnd = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(records):
+            f.write(make_record(rnd, i))
+
+
+def bench(path: str, workers: int) -> float:
+    started = time.perf_counter()
+    with open(path, "r", encoding="utf-8") as f:
+        count = sum(1 for _ in iter_rusmark_records_parallel(f, workers))
+    elapsed = time.perf_counter() - started
+    rate = count / elapsed if elapsed else 0
+    print(f"   workers={workers}: {count} записей за {elapsed:.2f} с → {rate:.0f} записей/с")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк парсера Rusmark")
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "synthetic.txt")
+        print(f"🧪 Генерация синтетического каталога: {args.records} записей")
+        generate(path, args.records)
+        print(f"   Размер: {os.path.getsize(path) / 1024 / 1024:.1f} МБ")
+        for workers in args.workers:
+            bench(path, workers)
+
+
+if __name__ == "__main__":
+    main()
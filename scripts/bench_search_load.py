@@ -0,0 +1,68 @@
+"""
+Нагрузочный тест /api/search: N параллельных запросов, вывод p50/p99 задержки.
+
+Запуск (сервер должен быть поднят через uvicorn):
+    python scripts/bench_search_load.py --concurrency 32 --requests 320 --mode sql
+Для сравнения "до/после" прогоните скрипт на обеих версиях сервера с одинаковыми параметрами.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+async def run(args):
+    payload = {"query": args.query, "mode": args.mode, "table": args.table, "field": args.field}
+    latencies = []
+    errors = 0
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+        async def one():
+            nonlocal errors
+            async with sem:
+                started = time.perf_counter()
+                try:
+                    response = await client.post("/api/search", json=payload)
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - started)
+                except Exception:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(args.requests)))
+        total = time.perf_counter() - started
+
+    print(f"📊 /api/search mode={args.mode}, concurrency={args.concurrency}, requests={args.requests}")
+    print(f"   Успешно: {len(latencies)}, ошибок: {errors}, всего {total:.2f} с ({len(latencies) / total:.1f} rps)")
+    if latencies:
+        print(f"   p50: {percentile(latencies, 50) * 1000:.0f} мс")
+        print(f"   p99: {percentile(latencies, 99) * 1000:.0f} мс")
+        print(f"   mean: {statistics.mean(latencies) * 1000:.0f} мс, max: {max(latencies) * 1000:.0f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест /api/search")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--mode", default="sql", choices=["sql", "rag"])
+    parser.add_argument("--query", default="Гагарин")
+    parser.add_argument("--table", default="csl")
+    parser.add_argument("--field", default="author")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()